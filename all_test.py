@@ -16,6 +16,10 @@ from random import randint
 
 from project import db
 
+# Schema creation is an explicit step (flask --app project create-db), so make sure the tables exist for the tests
+with app.app_context():
+    project.create_all_tables()
+
 user_token = None
 
 telegram_webhook = {
@@ -323,3 +327,1227 @@ def test_message_has_been_deleted():
         token=user_token
     ).first().messages
     assert len(messages) == 0
+
+
+def test_image_policy_chooses_smallest_size_meeting_target():
+    # Check that the image policy picks the smallest photo size that is at least the target width
+    from project import image_policy, telegram_updates
+
+    photo_sizes = telegram_updates.parse_photo_sizes([
+        {"file_id": "small", "width": 90, "height": 60, "file_size": 1000},
+        {"file_id": "medium", "width": 800, "height": 533, "file_size": 40000},
+        {"file_id": "large", "width": 1280, "height": 853, "file_size": 90000},
+        {"file_id": "huge", "width": 2560, "height": 1706, "file_size": 300000},
+    ])
+
+    chosen = image_policy.choose_photo_size(photo_sizes, policy="target_width", target_width=1000)
+    assert chosen.file_id == "large"
+
+    chosen = image_policy.choose_photo_size(photo_sizes, policy="largest")
+    assert chosen.file_id == "huge"
+
+    # If nothing is wide enough we fall back to the largest size available
+    chosen = image_policy.choose_photo_size(photo_sizes, policy="target_width", target_width=5000)
+    assert chosen.file_id == "huge"
+
+
+def test_image_policy_reencodes_wide_images():
+    # Check that an image wider than the target is downscaled and re-encoded in place, and the saving counted
+    import os
+    import shutil
+    from PIL import Image
+    from project import image_policy, instrumentation
+
+    image_path = "media_uploads/test_reencode.jpg"
+    shutil.copy("test.jpg", image_path)
+    try:
+        bytes_saved_before = instrumentation.snapshot()['counters'].get('image_policy_bytes_saved_by_reencoding', 0)
+        bytes_saved = image_policy.reencode_image(image_path, target_width=200, quality=70)
+        assert bytes_saved > 0
+        with Image.open(image_path) as image:
+            assert image.width == 200 and image.format == "JPEG"
+        assert instrumentation.snapshot()['counters']['image_policy_bytes_saved_by_reencoding'] == bytes_saved_before + bytes_saved
+
+        # Already small enough, and re-encoding again at a higher quality wouldn't shrink it
+        assert image_policy.reencode_image(image_path, target_width=200, quality=95) == 0
+    finally:
+        os.remove(image_path)
+
+
+def test_telegram_update_parser():
+    # Check that updates are parsed into typed objects once, and malformed ones are rejected
+    from project import telegram_updates
+
+    update = telegram_updates.parse_update(dict(telegram_webhook, message=dict(telegram_webhook["message"], text="/imgbb SomeKey")))
+    assert update.chat_id == telegram_webhook["message"]["chat"]["id"]
+    assert (update.command, update.argument) == ("/imgbb", "somekey")
+    assert not hasattr(update, '__dict__')
+
+    venue = telegram_updates.parse_update({"message": {
+        "message_id": 1, "chat": {"id": 1}, "from": {"id": 1},
+        "location": {"latitude": 51.5, "longitude": -0.1}, "venue": {"title": "Home", "address": "1 Road"},
+    }})
+    assert venue.location.title == "Home" and venue.text is None and not venue.command
+
+    assert telegram_updates.parse_update({"update_id": 1, "edited_message": {}}) is None
+    for malformed in [[], {"message": {"chat": {"id": 1}}}, {"message": dict(telegram_webhook["message"], photo="a photo")}]:
+        with pytest.raises(telegram_updates.MalformedUpdateError):
+            telegram_updates.parse_update(malformed)
+
+
+def test_http_client_circuit_breaker_opens_after_failures():
+    # Check that the circuit breaker stops requests after repeated failures and lets a trial through after the reset period
+    from project import http_client
+
+    circuit_breaker = http_client.CircuitBreaker(failure_threshold=2, reset_seconds=60)
+    assert circuit_breaker.allow_request() is True
+
+    circuit_breaker.record_failure()
+    assert circuit_breaker.state == "closed"
+    circuit_breaker.record_failure()
+    assert circuit_breaker.state == "open"
+    assert circuit_breaker.allow_request() is False
+
+    # Pretend the reset period has passed
+    circuit_breaker.opened_at -= 60
+    assert circuit_breaker.state == "half_open"
+    assert circuit_breaker.allow_request() is True
+    assert circuit_breaker.allow_request() is False
+
+    circuit_breaker.record_success()
+    assert circuit_breaker.state == "closed"
+
+
+def test_asgi_send_and_retrieve_message_valid():
+    # Check that the async serving mode can store a message and deliver it, and still passes other routes to Flask
+    import anyio
+    import httpx
+    from project.asgi import asgi_app
+
+    telegram_webhook["message"]["text"] = "A message sent through the async server"
+
+    async def run():
+        async with httpx.AsyncClient(app=asgi_app, base_url="http://testserver") as client:
+            response = await client.get('/')
+            assert response.status_code == 200
+            assert 'API is running' in response.text
+
+            response = await client.post(
+                '/telegram/webhook/',
+                headers={
+                    "X-Telegram-Bot-Api-Secret-Token": envars.telegram_webhook_auth},
+                json=telegram_webhook
+            )
+            assert response.status_code == 200
+
+            response = await client.post(
+                '/get_new_messages/',
+                json={"user_id": user_token}
+            )
+            assert response.status_code == 200
+            assert response.json()["messages"]["count"] == 1
+            assert response.json()["messages"]["contents"][0]["contents"] == telegram_webhook["message"]["text"]
+
+    anyio.run(run)
+
+
+def test_asgi_handlers_wait_on_the_event_loop(monkeypatch):
+    # Check that webhooks served by the async server wait on Telegram without holding a thread, so far more of them than
+    # there are worker threads can be in flight at once, and that their queries use the aiosqlite driver
+    import threading
+    import anyio
+    import httpx
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from project import http_client, rate_limit
+    from project.asgi import asgi_app
+
+    with app.app_context():
+        chat_id = randint(100000000, 999999999)
+        user_id = project.create_new_user("telegram", str(chat_id)).id
+
+    sends_in_flight = 0
+    most_sends_in_flight = 0
+
+    async def slow_send_async(method, url, timeout, **kwargs):
+        nonlocal sends_in_flight, most_sends_in_flight
+        assert threading.current_thread() is threading.main_thread()
+        sends_in_flight += 1
+        most_sends_in_flight = max(most_sends_in_flight, sends_in_flight)
+        await anyio.sleep(0.5)
+        sends_in_flight -= 1
+        response = requests.Response()
+        response.status_code = 200
+        return response
+
+    monkeypatch.setattr(http_client, "send_async", slow_send_async)
+    monkeypatch.setattr(rate_limit, "check", lambda *args: True)
+
+    drivers_used = set()
+
+    def record_driver(connection, cursor, statement, parameters, context, executemany):
+        drivers_used.add(connection.dialect.driver)
+
+    requests_at_once = 100
+
+    async def send_help(client, responses):
+        update = {
+            "update_id": randint(100000000, 999999999),
+            "message": dict(telegram_webhook["message"], chat={"id": chat_id, "type": "private"}, text="/help"),
+        }
+        response = await client.post(
+            '/telegram/webhook/',
+            headers={"X-Telegram-Bot-Api-Secret-Token": envars.telegram_webhook_auth},
+            json=update
+        )
+        responses.append(response.status_code)
+
+    async def run():
+        responses = []
+        async with httpx.AsyncClient(app=asgi_app, base_url="http://testserver") as client:
+            async with anyio.create_task_group() as task_group:
+                for _ in range(requests_at_once):
+                    task_group.start_soon(send_help, client, responses)
+        return responses
+
+    event.listen(Engine, 'before_cursor_execute', record_driver)
+    try:
+        responses = anyio.run(run)
+    finally:
+        event.remove(Engine, 'before_cursor_execute', record_driver)
+
+    assert responses == [200] * requests_at_once
+    assert most_sends_in_flight == requests_at_once
+    assert drivers_used == {"aiosqlite"}
+
+    with app.app_context():
+        db.session.delete(User.query.filter_by(id=user_id).first())
+        db.session.commit()
+
+
+def test_beta_code_can_only_be_used_once():
+    # Check that a beta code can't be claimed twice
+    code_added = project.create_beta_code()
+    assert code_added in project.list_of_beta_codes()
+
+    assert project.use_beta_code(code_added) is True
+    assert project.use_beta_code(code_added) is False
+    assert code_added not in project.list_of_beta_codes()
+
+
+def test_beta_code_files_imported():
+    # Check that beta codes left over from the old file based store are moved into the database
+    import os
+
+    old_code = "oldfilecode"
+    open(f"{project.beta_codes_folder}/{old_code}.txt", "w").close()
+
+    assert project.import_beta_code_files() == 1
+    assert not os.path.exists(f"{project.beta_codes_folder}/{old_code}.txt")
+    assert project.use_beta_code(old_code) is True
+
+
+def test_janitor_purges_delivered_and_expired_messages():
+    # Check that the janitor removes delivered messages and undelivered messages past the retention period
+    from datetime import datetime, timedelta
+    from project import janitor
+
+    user_id = User.query.filter_by(token=user_token).first().id
+    old_timestamp = datetime.now() - timedelta(days=janitor.undelivered_message_retention_days + 1)
+    db.session.add(Message(user_id=user_id, provider="telegram", contents="delivered", timestamp=datetime.now(), delivered=True))
+    db.session.add(Message(user_id=user_id, provider="telegram", contents="expired", timestamp=old_timestamp))
+    db.session.add(Message(user_id=user_id, provider="telegram", contents="still waiting", timestamp=datetime.now()))
+    db.session.commit()
+
+    result = janitor.run_janitor()
+    assert result["delivered_messages_purged"] >= 1
+    assert result["undelivered_messages_expired"] >= 1
+
+    remaining = [message.contents for message in User.query.filter_by(token=user_token).first().messages]
+    assert remaining == ["still waiting"]
+
+    project.delete_all_messages(user_id)
+
+
+def test_janitor_runs_in_one_worker_at_a_time():
+    # Check that a scheduled run is skipped while another worker holds the janitor's lease, and goes ahead once it runs out
+    from datetime import datetime, timedelta
+    from project import janitor, Lease
+
+    with app.app_context():
+        assert janitor.claim_lease('janitor', 60)
+        lease = db.session.get(Lease, 'janitor')
+        lease.holder, lease.expires = "another-host:1234", datetime.now() + timedelta(minutes=5)
+        db.session.commit()
+
+    assert janitor.run_scheduled_janitor() is None
+
+    with app.app_context():
+        lease = db.session.get(Lease, 'janitor')
+        lease.expires = datetime.now() - timedelta(seconds=1)
+        db.session.commit()
+
+    assert janitor.run_scheduled_janitor()["duration_seconds"] >= 0
+
+    with app.app_context():
+        assert db.session.get(Lease, 'janitor').holder == janitor.get_lease_holder()
+        db.session.delete(db.session.get(Lease, 'janitor'))
+        db.session.commit()
+
+
+def test_rate_limit_poll_returns_429(monkeypatch):
+    # Check that polling too often is turned away with a 429
+    from project import rate_limit
+
+    monkeypatch.setitem(rate_limit.buckets, 'poll', {'capacity': 2, 'refill_per_second': 0.001})
+    status_codes = []
+    with app.test_client() as client:
+        for attempt in range(3):
+            response = client.post(
+                '/get_new_messages/',
+                json={"user_id": "a_token_that_polls_too_often"}
+            )
+            status_codes.append(response.status_code)
+
+    assert status_codes == [404, 404, 429]
+
+
+def test_rate_limit_webhook_drops_updates_with_200(monkeypatch):
+    # Check that a chat flooding the webhook has its updates dropped with a 200 (so Telegram doesn't redeliver them),
+    # and is told about it once
+    from project import rate_limit, telegram, instrumentation
+
+    chat_id = randint(100000000, 999999999)
+    sent = []
+    monkeypatch.setitem(rate_limit.buckets, 'webhook', {'capacity': 1, 'refill_per_second': 0.001})
+    monkeypatch.setattr(telegram, "send_message", lambda *args, **kwargs: sent.append(list(args) + list(kwargs.values())))
+    dropped_before = instrumentation.snapshot()['counters'].get('telegram_updates_dropped_rate_limited', 0)
+
+    status_codes = []
+    with app.test_client() as client:
+        for attempt in range(4):
+            response = client.post(
+                '/telegram/webhook/',
+                headers={"X-Telegram-Bot-Api-Secret-Token": envars.telegram_webhook_auth},
+                json={"update_id": attempt, "message": {"message_id": attempt, "chat": {"id": chat_id}, "from": {"id": chat_id}, "text": "/help"}}
+            )
+            status_codes.append(response.status_code)
+
+    assert status_codes == [200, 200, 200, 200]
+    assert instrumentation.snapshot()['counters']['telegram_updates_dropped_rate_limited'] == dropped_before + 3
+    assert [args for args in sent if project.message_string['sending_too_fast'] in args] == [
+        ['telegram', chat_id, project.message_string['sending_too_fast']]
+    ]
+
+
+def test_rate_limit_memory_backend_refills():
+    # Check that the token bucket refuses requests once empty and refills over time
+    import time
+    from project import rate_limit
+
+    backend = rate_limit.MemoryBackend()
+    assert backend.consume("key", capacity=1, refill_per_second=50) is True
+    assert backend.consume("key", capacity=1, refill_per_second=50) is False
+    time.sleep(0.05)
+    assert backend.consume("key", capacity=1, refill_per_second=50) is True
+
+
+def test_admin_session_cookie_skips_basic_auth():
+    # Check that after logging in with Basic auth the session cookie is enough on its own, until logging out
+    with app.test_client() as client:
+        response = client.get(
+            '/admin/health',
+            headers={"Authorization": f"Basic {valid_credentials}"}
+        )
+        assert response.status_code == 200
+
+        response = client.get('/admin/beta_codes')
+        assert response.status_code == 200
+
+        client.get('/admin/logout')
+        response = client.get('/admin/beta_codes')
+        assert response.status_code == 401
+
+
+def test_admin_lockout_after_failed_logins():
+    # Check that an IP that keeps failing to log in is locked out, even with the right password
+    from project import admin_auth, shared_state
+
+    brute_force_ip = {"REMOTE_ADDR": "10.0.0.42"}
+    with app.test_client() as client:
+        for attempt in range(admin_auth.lockout_failure_threshold):
+            response = client.get(
+                '/admin/beta_codes',
+                headers={"Authorization": f"Basic {invalid_credentials}"},
+                environ_base=brute_force_ip
+            )
+            assert response.status_code == 401
+
+        response = client.get(
+            '/admin/beta_codes',
+            headers={"Authorization": f"Basic {valid_credentials}"},
+            environ_base=brute_force_ip
+        )
+        assert response.status_code == 429
+
+    # The lockout is kept in shared state, so it holds in every worker, and it goes once it has expired
+    assert admin_auth.LoginAttemptTracker().is_locked_out("10.0.0.42")
+    shared_state.delete_value(admin_auth.login_attempt_tracker.lockout_key("10.0.0.42"))
+    assert not admin_auth.login_attempt_tracker.is_locked_out("10.0.0.42")
+
+
+def test_local_image_storage_is_content_addressed(monkeypatch):
+    # Check that the local backend is off unless the deployment turns it on, and then stores each image once under its
+    # hash and serves it with long-lived cache headers
+    import os
+    import shutil
+    from project import image_storage
+
+    monkeypatch.setattr(image_storage, "local_public_url", None)
+    assert not image_storage.backends['local'].is_available_for_user(None)
+    assert image_storage.backends['local'].upload("test.jpg") is False
+
+    monkeypatch.setattr(image_storage, "local_public_url", "https://images.example.com/images/")
+    assert image_storage.backends['local'].is_available_for_user(None)
+    image_url = image_storage.backends['local'].upload("test.jpg")
+    assert image_url.startswith("https://images.example.com/images/")
+    assert image_storage.backends['local'].upload("test.jpg") == image_url
+
+    image_name = image_url.split('/')[-1]
+    with app.test_client() as test_client:
+        response = test_client.get(f"/images/{image_name}")
+        assert response.status_code == 200
+        assert "immutable" in response.headers['Cache-Control']
+
+        response = test_client.get("/images/not-an-image.jpg")
+        assert response.status_code == 404
+
+    shutil.rmtree(os.path.dirname(image_storage.local_image_path(image_name)))
+
+
+def test_full_local_image_store_falls_back(monkeypatch, tmp_path):
+    # Check that once the local image store is full new images go to another backend, and nothing stored is deleted
+    import os
+    from project import image_storage
+
+    class FallbackBackend(image_storage.ImageStorageBackend):
+        name = "test_fallback"
+
+        def upload(self, image_path, user=None):
+            return "https://fallback.example.com/image.jpg"
+
+    monkeypatch.setattr(image_storage, "local_store_folder", str(tmp_path))
+    monkeypatch.setattr(image_storage, "local_public_url", "https://images.example.com/images/")
+    monkeypatch.setattr(image_storage, "_local_store_bytes", None)
+    monkeypatch.setattr(image_storage, "default_backend", "local")
+    monkeypatch.setattr(image_storage, "upload_fallback_backends", ["test_fallback"])
+    monkeypatch.setitem(image_storage.backends, "test_fallback", FallbackBackend())
+
+    # One image fits, and is then served from the store
+    monkeypatch.setattr(image_storage, "local_image_store_max_bytes", os.path.getsize("test.jpg") + 100)
+    image_url = image_storage.upload_image("test.jpg")
+    assert image_url.startswith("https://images.example.com/images/")
+    stored_path = image_storage.local_image_path(image_url.split('/')[-1])
+
+    # A different image doesn't fit, so goes to the fallback
+    other_image_path = tmp_path / "other.jpg"
+    other_image_path.write_bytes(open("test.jpg", 'rb').read() + b"different")
+    assert image_storage.upload_image(str(other_image_path)) == "https://fallback.example.com/image.jpg"
+
+    # The same image again is already there, and everything stored is kept
+    assert image_storage.upload_image("test.jpg") == image_url
+    assert os.path.exists(stored_path)
+
+
+def test_image_upload_hedges_past_slow_backend(monkeypatch):
+    # Check that a slow backend is hedged with the next one, and then tried last once it has missed its deadline
+    import time
+    from project import image_storage
+
+    class SlowBackend(image_storage.ImageStorageBackend):
+        name = "test_slow"
+
+        def upload(self, image_path, user=None):
+            time.sleep(1)
+            return "https://slow.example.com/image.jpg"
+
+    class FastBackend(image_storage.ImageStorageBackend):
+        name = "test_fast"
+
+        def upload(self, image_path, user=None):
+            return "https://fast.example.com/image.jpg"
+
+    monkeypatch.setitem(image_storage.backends, "test_slow", SlowBackend())
+    monkeypatch.setitem(image_storage.backends, "test_fast", FastBackend())
+    monkeypatch.setattr(image_storage, "default_backend", "test_slow")
+    monkeypatch.setattr(image_storage, "upload_fallback_backends", ["test_fast"])
+    monkeypatch.setattr(image_storage, "upload_strategy", "hedge")
+    monkeypatch.setattr(image_storage, "hedge_after_seconds", 0.1)
+    monkeypatch.setitem(image_storage.upload_deadline_seconds, "test_slow", 0.5)
+    monkeypatch.setattr(image_storage, "slow_backend_seconds", 0.2)
+
+    assert [backend.name for backend in image_storage.get_upload_candidates()] == ["test_slow", "test_fast"]
+    assert image_storage.upload_image("test.jpg") == "https://fast.example.com/image.jpg"
+
+    # Wait for the slow upload to miss its deadline, after which it should be tried last
+    monkeypatch.setattr(image_storage, "upload_strategy", "failover")
+    assert image_storage.upload_image("test.jpg") == "https://fast.example.com/image.jpg"
+    assert [backend.name for backend in image_storage.get_upload_candidates()] == ["test_fast", "test_slow"]
+
+
+def test_plugin_version_check_claimed_by_one_worker():
+    # Check that only one caller gets to check github for a new plugin version, and the result is shared
+    import time
+    from project import shared_state
+
+    for key in ['latest_plugin_version', 'latest_plugin_version_fresh', 'latest_plugin_version_check_claimed']:
+        shared_state.delete_value(key)
+
+    assert project.claim_plugin_version_check()
+    assert not project.claim_plugin_version_check()
+
+    project.store_latest_plugin_version("1.2.3")
+    assert not project.is_plugin_version_check_due()
+    assert project.get_cached_latest_plugin_version() == "1.2.3"
+    assert project.is_plugin_out_of_date("1.2.2")
+
+    # Values with a time to live disappear once it has passed
+    shared_state.set_value('test_expiring_value', 42, ttl_seconds=0.1)
+    assert shared_state.get_value('test_expiring_value') == 42
+    time.sleep(0.15)
+    assert shared_state.get_value('test_expiring_value') is None
+
+    # Counters keep the time to live they were created with
+    assert shared_state.increment_value('test_expiring_counter', ttl_seconds=0.1) == 1
+    assert shared_state.increment_value('test_expiring_counter', ttl_seconds=0.1) == 2
+    time.sleep(0.15)
+    assert shared_state.increment_value('test_expiring_counter', ttl_seconds=0.1) == 1
+
+
+def test_sharded_session_routes_users_and_messages(monkeypatch):
+    # Check that users and their messages land on the shard their provider id hashes to, and can be found again
+    import os
+    import tempfile
+    from datetime import datetime
+    from sqlalchemy import create_engine, select
+    from project import sharding
+
+    monkeypatch.setattr(sharding, "shard_count", 3)
+
+    with tempfile.TemporaryDirectory() as temporary_folder:
+        engines = {
+            shard_id: create_engine(f"sqlite:///{os.path.join(temporary_folder, f'shard{shard_id}.sqlite3')}")
+            for shard_id in sharding.shard_ids()
+        }
+        for engine in engines.values():
+            db.metadata.create_all(engine, tables=[User.__table__, Message.__table__])
+
+        session = sharding.ShardedSession(shards=engines)
+        try:
+            users = [
+                User(provider="telegram", provider_id=str(provider_id), token=f"sharding_test_token_{provider_id}")
+                for provider_id in range(100, 112)
+            ]
+            session.add_all(users)
+            session.commit()
+
+            for user in users:
+                assert sharding.shard_for_user_id(user.id) == sharding.shard_for_key(user.provider_id)
+                session.add(Message(user_id=user.id, provider="telegram", contents=f"note for {user.provider_id}", timestamp=datetime.now()))
+            session.commit()
+
+            for shard_id, engine in engines.items():
+                with engine.connect() as connection:
+                    shard_user_ids = connection.execute(select(User.__table__.c.id)).scalars().all()
+                assert all(sharding.shard_for_user_id(user_id) == shard_id for user_id in shard_user_ids)
+
+            # Routed by provider id, found by token on whichever shard it is on, and counted across every shard
+            user = session.execute(select(User).filter_by(provider_id="105")).scalars().one()
+            assert session.execute(select(User).filter_by(token="sharding_test_token_105")).scalars().one().id == user.id
+            assert session.execute(select(Message).filter_by(user_id=user.id)).scalars().one().contents == "note for 105"
+            assert sharding.count_rows(session, Message) == len(users)
+
+            # A worker that picks an id another worker has just taken tries again with the next one
+            taken_user_id, taken_provider_id = users[0].id, users[0].provider_id
+            session.expunge_all()
+            provider_id = next(
+                str(provider_id) for provider_id in range(200, 300)
+                if sharding.shard_for_key(str(provider_id)) == sharding.shard_for_key(taken_provider_id)
+            )
+            original_first_user_id_after = sharding.first_user_id_after
+            picked_ids = []
+
+            def first_user_id_after_racing_another_worker(max_user_id, shard_id, count=None):
+                user_id = original_first_user_id_after(max_user_id, shard_id, count)
+                picked_ids.append(user_id if picked_ids else taken_user_id)
+                return picked_ids[-1]
+
+            monkeypatch.setattr(sharding, "first_user_id_after", first_user_id_after_racing_another_worker)
+            new_user = sharding.add_new_user(
+                session,
+                lambda: User(provider="telegram", provider_id=provider_id, token=f"sharding_test_token_{provider_id}")
+            )
+            assert picked_ids[0] == taken_user_id and new_user.id == picked_ids[1]
+            assert sharding.shard_for_user_id(new_user.id) == sharding.shard_for_user_id(taken_user_id)
+        finally:
+            session.close()
+            for engine in engines.values():
+                engine.dispose()
+
+
+def test_backup_export_and_import_round_trip():
+    # Check that exporting and then importing over the top gives back the same users and messages
+    import os
+    import tempfile
+    from project import backup, sharding
+
+    with app.app_context():
+        user_count = sharding.count_rows(db.session, User)
+        message_count = sharding.count_rows(db.session, Message)
+        tokens = sorted(user.token for user in User.query.all())
+
+        with tempfile.TemporaryDirectory() as temporary_folder:
+            backup_path = os.path.join(temporary_folder, "backup.jsonl.gz")
+            assert backup.export_data(backup_path, chunk_size=2) == {'user': user_count, 'message': message_count}
+            assert backup.import_data(backup_path, chunk_size=2, replace=True) == {'user': user_count, 'message': message_count}
+
+        db.session.expire_all()
+        assert sharding.count_rows(db.session, Message) == message_count
+        assert sorted(user.token for user in User.query.all()) == tokens
+
+
+def test_backup_import_is_all_or_nothing():
+    # Check that a file that isn't an export, or an import that fails part way, leaves the existing data as it was
+    import os
+    import gzip
+    import json
+    import tempfile
+    from project import backup, sharding
+
+    with app.app_context():
+        project.create_new_user("telegram", str(randint(100000000, 999999999)))
+        user_count = sharding.count_rows(db.session, User)
+        message_count = sharding.count_rows(db.session, Message)
+
+        with tempfile.TemporaryDirectory() as temporary_folder:
+            not_an_export_path = os.path.join(temporary_folder, "not_an_export.jsonl.gz")
+            with gzip.open(not_an_export_path, 'wt', encoding='utf-8') as f:
+                f.write(json.dumps({'format': 'something-else'}) + "\n")
+            with pytest.raises(ValueError):
+                backup.import_data(not_an_export_path, replace=True)
+
+            # Two new users fill the first chunk, then the third already exists
+            backup_path = os.path.join(temporary_folder, "backup.jsonl.gz")
+            backup.export_data(backup_path)
+            with gzip.open(backup_path, 'rt', encoding='utf-8') as f:
+                header, user_columns, existing_user = [json.loads(f.readline()) for line in range(3)]
+            columns = user_columns['columns']
+
+            new_users = []
+            for offset in range(2):
+                new_user = list(existing_user)
+                new_user[columns.index('id')] = 10 ** 8 + offset
+                new_user[columns.index('token')] = f"all_or_nothing_token_{offset}"
+                new_user[columns.index('provider_id')] = f"all_or_nothing_{offset}"
+                new_users.append(new_user)
+
+            failing_path = os.path.join(temporary_folder, "failing.jsonl.gz")
+            with gzip.open(failing_path, 'wt', encoding='utf-8') as f:
+                for record in [header, user_columns] + new_users + [existing_user]:
+                    f.write(json.dumps(record) + "\n")
+            with pytest.raises(Exception):
+                backup.import_data(failing_path, chunk_size=2)
+
+        db.session.expire_all()
+        assert sharding.count_rows(db.session, User) == user_count
+        assert sharding.count_rows(db.session, Message) == message_count
+        assert not User.query.filter_by(token="all_or_nothing_token_0").first()
+
+
+def test_backup_import_alongside_existing_users():
+    # Check that users imported without replace get new ids rather than colliding with the existing users' ids, and
+    # that their messages follow them
+    import os
+    import gzip
+    import json
+    import tempfile
+    from project import backup, sharding
+
+    with app.app_context():
+        user = project.create_new_user("telegram", str(randint(100000000, 999999999)))
+        project.add_new_message(user.id, "telegram", "A note to copy")
+        user_count = sharding.count_rows(db.session, User)
+        message_count = sharding.count_rows(db.session, Message)
+
+        with tempfile.TemporaryDirectory() as temporary_folder:
+            backup_path = os.path.join(temporary_folder, "backup.jsonl.gz")
+            backup.export_data(backup_path)
+
+            # The same users (with the same ids) under new tokens and provider ids
+            copy_path = os.path.join(temporary_folder, "copy.jsonl.gz")
+            with gzip.open(backup_path, 'rt', encoding='utf-8') as source, gzip.open(copy_path, 'wt', encoding='utf-8') as f:
+                table_name, columns = None, []
+                for line in source:
+                    record = json.loads(line)
+                    if isinstance(record, dict) and 'table' in record:
+                        table_name, columns = record['table'], record['columns']
+                    elif table_name == 'user':
+                        for column in ['token', 'provider_id']:
+                            record[columns.index(column)] = f"copy_{record[columns.index(column)]}"
+                    f.write(json.dumps(record) + "\n")
+
+            assert backup.import_data(copy_path) == {'user': user_count, 'message': message_count}
+
+        db.session.expire_all()
+        assert sharding.count_rows(db.session, User) == user_count * 2
+        assert sharding.count_rows(db.session, Message) == message_count * 2
+        copied_user = User.query.filter_by(token=f"copy_{user.token}").first()
+        assert copied_user.id != user.id
+        # With encryption on the copy's contents can't be read, as its key was wrapped with the original token
+        assert sharding.count_rows(db.session, Message, Message.user_id == str(copied_user.id)) == 1
+
+        for copied_user in User.query.filter(User.token.startswith("copy_")).all():
+            project.delete_all_messages(copied_user.id)
+            db.session.delete(copied_user)
+        project.delete_all_messages(user.id)
+        db.session.delete(user)
+        db.session.commit()
+
+
+def test_message_contents_compressed_at_rest(monkeypatch):
+    # Check that long contents are stored compressed but read back unchanged, and plain text rows still read fine
+    from sqlalchemy import select, cast, LargeBinary
+    from project import compression
+
+    long_contents = "TODO read this article about [[LogLink]] and take notes " * 40
+    short_contents = "Buy milk"
+
+    # With encryption on, what is stored is the encrypted envelope instead
+    monkeypatch.setattr(envars, "message_encryption_key", None)
+
+    with app.app_context():
+        user = project.create_new_user("telegram", str(randint(100000000, 999999999)))
+        for contents in [long_contents, short_contents]:
+            project.add_new_message(user.id, "telegram", contents)
+
+        # Read what is actually stored, bypassing the column type
+        stored = db.session.execute(
+            select(cast(Message.contents, LargeBinary)).where(Message.user_id == user.id).order_by(Message.id.desc())
+        ).scalars().all()
+        assert stored[0] == short_contents.encode('utf-8')
+        assert stored[1].startswith(compression.compressed_marker)
+        assert len(stored[1]) < len(long_contents) / 10
+
+        assert [message.contents for message in Message.query.filter_by(user_id=user.id).order_by(Message.id.desc()).limit(2)] == [short_contents, long_contents]
+        project.delete_all_messages(user.id)
+        db.session.delete(user)
+        db.session.commit()
+
+
+def test_message_contents_encrypted_at_rest(monkeypatch):
+    # Check that contents are stored encrypted, and a poll decrypts the whole batch with a single key derivation
+    from datetime import datetime
+    from sqlalchemy import select, update, cast, LargeBinary
+    from sqlalchemy.orm.attributes import set_committed_value
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from project import encryption, instrumentation
+
+    monkeypatch.setattr(envars, "message_encryption_key", "test-message-encryption-key")
+
+    notes = ["First secret note", "Second secret note " * 20, "📍 Third secret note"]
+
+    with app.app_context():
+        user = project.create_new_user("telegram", str(randint(100000000, 999999999)))
+        for note in notes:
+            project.add_new_message(user.id, "telegram", note)
+
+        stored = db.session.execute(
+            select(cast(Message.contents, LargeBinary)).where(Message.user_id == user.id)
+        ).scalars().all()
+        assert len(stored) == len(notes)
+        assert all(contents.startswith(encryption.encrypted_marker) for contents in stored)
+        assert not any(b"secret" in contents for contents in stored)
+        user_token = user.token
+
+    encryption.clear_key_cache()
+    derivations_before = instrumentation.snapshot()['counters'].get('encryption_key_derivations', 0)
+
+    with app.test_client() as test_client:
+        response = test_client.post('/get_new_messages/', json={'user_id': user_token})
+        assert response.status_code == 200
+        assert [message['contents'] for message in response.json['messages']['contents']] == notes
+
+    assert instrumentation.snapshot()['counters']['encryption_key_derivations'] == derivations_before + 1
+
+    # A worker that loaded the user before another worker gave them a key uses the other worker's key
+    with app.app_context():
+        user = project.create_new_user("telegram", str(randint(100000000, 999999999)))
+        user_token = user.token
+        assert user.message_key is None
+
+        key_cipher = AESGCM(encryption.derive_key_encryption_key(user.token))
+        other_workers_key = encryption.wrap_data_key(key_cipher, AESGCM.generate_key(bit_length=256))
+        db.session.execute(update(User).where(User.id == user.id).values(message_key=other_workers_key))
+        set_committed_value(user, 'message_key', None)
+
+        db.session.add(Message(
+            user_id=user.id, provider="telegram", timestamp=datetime.now(),
+            contents=encryption.encrypt_contents(user, "Note encrypted during a race")
+        ))
+        db.session.commit()
+        assert user.message_key == other_workers_key
+
+    encryption.clear_key_cache()
+    with app.test_client() as test_client:
+        response = test_client.post('/get_new_messages/', json={'user_id': user_token})
+        assert [message['contents'] for message in response.json['messages']['contents']] == [
+            "Note encrypted during a race"
+        ]
+
+
+def test_telegram_polling_ingests_batch_once(monkeypatch):
+    # Check that a batch of polled updates is ingested in one go, a bad update is skipped, and nothing is ingested twice
+    from project import telegram_polling, sharding
+
+    chat_id = randint(100000000, 999999999)
+
+    def update(update_id, **message):
+        return {
+            'update_id': update_id,
+            'message': dict({'message_id': update_id, 'chat': {'id': chat_id}, 'from': {'id': chat_id}}, **message)
+        }
+
+    with app.app_context():
+        user = project.create_new_user("telegram", str(chat_id))
+        first_update_id = telegram_polling.get_next_update_id() + 1
+        updates = [
+            update(first_update_id, text="Polled note one"),
+            update(first_update_id + 1, photo="not a list of photo sizes"),
+            update(first_update_id + 2, text="Polled note two"),
+        ]
+
+        result = telegram_polling.ingest_updates(updates)
+        assert result == {'ingested': 2, 'skipped': 0, 'failed': 1, 'next_update_id': first_update_id + 3}
+        assert telegram_polling.get_next_update_id() == first_update_id + 3
+        assert sharding.count_rows(db.session, Message, Message.user_id == user.id) == 2
+
+        # Replaying the same updates does nothing
+        assert telegram_polling.ingest_updates(updates)['skipped'] == 3
+        assert sharding.count_rows(db.session, Message, Message.user_id == user.id) == 2
+
+        # An update whose message fails to be stored is rolled back on its own, and the ones around it are kept
+        def add_new_message_failing_to_store(*args, **kwargs):
+            project.add_new_message(*args, **kwargs)
+            if kwargs.get('message_contents') == "Polled note that fails":
+                raise ValueError("could not store the message")
+            return True
+
+        updates = [
+            update(first_update_id + 3, text="Polled note three"),
+            update(first_update_id + 4, text="Polled note that fails"),
+            update(first_update_id + 5, text="Polled note four"),
+        ]
+        monkeypatch.setattr(telegram, "add_new_message", add_new_message_failing_to_store)
+        result = telegram_polling.ingest_updates(updates)
+        assert result == {'ingested': 2, 'skipped': 0, 'failed': 1, 'next_update_id': first_update_id + 6}
+        assert sharding.count_rows(db.session, Message, Message.user_id == user.id) == 4
+
+        project.delete_all_messages(user.id)
+        db.session.delete(user)
+        db.session.commit()
+
+
+def test_orjson_provider_matches_flask_output():
+    # Check that the orjson provider gives the plugin exactly what Flask's own provider does for a 1000 message poll
+    # response
+    import json
+    from datetime import datetime
+    from flask.json.provider import DefaultJSONProvider
+    from project import json_provider
+
+    pytest.importorskip("orjson")
+
+    messages = [
+        Message(id=message_id, provider="telegram", provider_message_id=str(message_id), user_id="1",
+                contents=f"📍 Note number {message_id} with \"quotes\" and [[links]]", timestamp=datetime(2023, 1, 7, 18, 0, message_id % 60),
+                delivered=True)
+        for message_id in range(1000)
+    ]
+    messages.append({'contents': project.message_string['new_version_available']})
+    response = {'status': 'success', 'messages': {'count': len(messages), 'contents': messages}}
+
+    flask_provider = DefaultJSONProvider(app)
+    flask_provider.sort_keys = False
+    orjson_provider = json_provider.OrjsonProvider(app)
+    orjson_provider.sort_keys = False
+
+    expected = json.loads(flask_provider.dumps(response))
+    actual = json.loads(orjson_provider.dumps_bytes(response))
+    assert actual == expected
+    assert list(actual['messages']['contents'][0]) == ['id', 'provider', 'provider_message_id', 'contents', 'timestamp', 'delivered']
+    assert actual['messages']['contents'][0]['timestamp'] == "Sat, 07 Jan 2023 18:00:00 GMT"
+
+    # Anything orjson can't encode falls back to the standard library
+    assert json.loads(orjson_provider.dumps({'big': 2 ** 70})) == {'big': 2 ** 70}
+
+
+def test_location_named_from_gazetteer_and_cached(monkeypatch):
+    # Check that a bare location is named after the nearest place in the gazetteer, repeats come from the cache, and
+    # the Google Maps link is unchanged
+    import os
+    import tempfile
+    from project import geocoding, instrumentation
+
+    with tempfile.TemporaryDirectory() as temporary_folder:
+        monkeypatch.setattr(geocoding, "gazetteer_path", os.path.join(temporary_folder, "gazetteer.txt"))
+        with open(geocoding.gazetteer_path, "w", encoding="utf-8") as f:
+            f.write("London\t51.50853\t-0.12574\tGB\n")
+            f.write("Greenwich\t51.47785\t-0.01176\tGB\n")
+            f.write("Suva\t-18.14161\t178.44149\tFJ\n")
+            f.write("Wairiki\t-16.81\t179.99\tFJ\n")
+        geocoding.reset()
+
+        try:
+            contents = project.compose_location_message_contents(51.4801, -0.0102)
+            assert contents == "📍 Near Greenwich, GB (51.4801, -0.0102) https://maps.google.com/maps?q=51.4801,-0.0102"
+
+            # Nearby coordinates round to the same key, so don't look anything up again
+            hits_before = instrumentation.snapshot()['counters'].get('reverse_geocode_cache_hits', 0)
+            assert geocoding.reverse_geocode(51.48012, -0.01018) == "Greenwich, GB"
+            assert instrumentation.snapshot()['counters']['reverse_geocode_cache_hits'] == hits_before + 1
+
+            # Across the antimeridian, and nowhere near anything
+            assert geocoding.reverse_geocode(-16.81, -179.99) == "Wairiki, FJ"
+            assert geocoding.reverse_geocode(-18.1, 178.4) == "Suva, FJ"
+            assert project.compose_location_message_contents(0.5, 0.5) == "📍 Lat: 0.5, Lon: 0.5 https://maps.google.com/maps?q=0.5,0.5"
+
+            # Venues keep their own name
+            assert project.compose_location_message_contents(51.4801, -0.0102, "Home", "1 Road") == "📍 Home, 1 Road https://maps.google.com/maps?q=51.4801,-0.0102"
+        finally:
+            geocoding.reset()
+
+
+def test_digest_mode_folds_consecutive_notes(monkeypatch):
+    # Check that a user in digest mode gets runs of plain notes as one block, with anything else kept in order between
+    from project import image_storage
+
+    with app.app_context():
+        chat_id = randint(100000000, 999999999)
+        user = project.create_new_user("telegram", str(chat_id))
+        user_id, user_token = user.id, user.token
+
+        # Turned on with a command
+        with app.test_client() as client:
+            response = client.post(
+                '/telegram/webhook/',
+                headers={"X-Telegram-Bot-Api-Secret-Token": envars.telegram_webhook_auth},
+                json={"update_id": 1, "message": {"message_id": 1, "chat": {"id": chat_id}, "from": {"id": chat_id}, "text": "/digest on"}}
+            )
+            assert response.status_code == 200
+        db.session.expire_all()
+        assert User.query.filter_by(id=user.id).first().digest_mode
+
+        # An uncaptioned photo is stored as just the URL of the uploaded image, and mustn't be folded into a digest
+        monkeypatch.setattr(image_storage, "upload_image", lambda image_file_path, user=None: "https://i.ibb.co/abc123/photo.jpg")
+        photo = project.compose_image_message_contents("test.jpg", caption=None, user=user)
+
+        notes = ["Buy milk", "Call Sam", "TODO book flights", "Idea for a talk", "Read chapter 3", photo, "Water the plants", "Sort the post"]
+        for note in notes:
+            project.add_new_message(user.id, "telegram", note)
+
+    with app.test_client() as client:
+        response = client.post('/get_new_messages/', json={'user_id': user_token})
+        assert response.status_code == 200
+        contents = [message['contents'] for message in response.json['messages']['contents']]
+
+    assert contents == [
+        "📥 2 notes\n- Buy milk\n- Call Sam",
+        "TODO book flights",
+        "📥 2 notes\n- Idea for a talk\n- Read chapter 3",
+        "https://i.ibb.co/abc123/photo.jpg",
+        "📥 2 notes\n- Water the plants\n- Sort the post",
+    ]
+    assert set(response.json['messages']['contents'][0]) == {'id', 'provider', 'provider_message_id', 'contents', 'timestamp', 'delivered'}
+
+    with app.app_context():
+        assert Message.query.filter_by(user_id=user_id).count() == 0
+        project.delete_all_messages(user_id)
+        db.session.delete(User.query.filter_by(id=user_id).first())
+        db.session.commit()
+
+
+def test_request_guard_rejects_before_flask(monkeypatch):
+    # Check that bad webhook tokens and oversized bodies are turned away by the middleware, in both serving modes,
+    # without Flask ever seeing the request
+    import anyio
+    import httpx
+    from project import request_guard, instrumentation
+    from project.asgi import asgi_app
+
+    requests_seen_by_flask = []
+    monkeypatch.setitem(app.before_request_funcs, None, app.before_request_funcs.get(None, []) + [lambda: requests_seen_by_flask.append(1)])
+
+    def rejected(reason):
+        return instrumentation.snapshot()['counters'].get(f"request_guard_rejected_{reason}", 0)
+
+    with app.test_client() as client:
+        response = client.post('/telegram/webhook/', headers={"X-Telegram-Bot-Api-Secret-Token": "wrong_token"}, json=telegram_webhook)
+        assert response.status_code == 401 and response.json['message'] == 'Webhook verification token did not match expected'
+
+        response = client.post('/telegram/webhook', json=telegram_webhook)
+        assert response.status_code == 401
+
+        response = client.post('/get_new_messages/', data=b"x" * (request_guard.max_content_length + 1), content_type="application/json")
+        assert response.status_code == 413
+
+    assert requests_seen_by_flask == []
+
+    async def run():
+        async with httpx.AsyncClient(app=asgi_app, base_url="http://testserver") as client:
+            before = rejected('bad_webhook_token')
+            response = await client.post('/telegram/webhook/', headers={"X-Telegram-Bot-Api-Secret-Token": "wrong_token"}, json=telegram_webhook)
+            assert response.status_code == 401
+            assert rejected('bad_webhook_token') == before + 1
+
+            response = await client.post('/telegram/webhook/', headers={"X-Telegram-Bot-Api-Secret-Token": envars.telegram_webhook_auth}, content=b"x" * (request_guard.webhook_max_content_length + 1))
+            assert response.status_code == 413
+
+            # Chunked, so there is no Content-Length to check up front
+            async def chunks():
+                for _ in range(request_guard.max_content_length // 65536 + 2):
+                    yield b"x" * 65536
+
+            before = rejected('body_too_large')
+            response = await client.post('/get_new_messages/', content=chunks())
+            assert response.status_code == 413
+            assert rejected('body_too_large') == before + 1
+
+    anyio.run(run)
+
+
+def test_hot_lookups_use_compiled_cache():
+    # Check that the lambda statements find the same rows as the ORM queries they replaced, that repeats are served from
+    # the compiled statement cache
+    from project import queries, instrumentation
+
+    def counter(name):
+        return instrumentation.snapshot()['counters'].get(name, 0)
+
+    with app.app_context():
+        chat_id = randint(100000000, 999999999)
+        user = project.create_new_user("telegram", str(chat_id))
+        user_id, user_token = user.id, user.token
+        project.add_new_message(user_id, "telegram", "A note")
+
+        assert queries.get_user_by_token(user_token).id == user_id
+        assert queries.get_user_by_provider_id(chat_id).id == user_id
+        assert queries.get_user_by_token("not a token") is None
+        expected_message_ids = [message.id for message in Message.query.filter_by(user_id=user_id, delivered=False)]
+        assert [message.id for message in queries.get_undelivered_messages(user_id)] == expected_message_ids
+        assert len(expected_message_ids) == 1
+
+        hits_before = counter('sql_compiled_cache_hits')
+        queries.get_user_by_token(user_token)
+        queries.get_undelivered_messages(user_id)
+        assert counter('sql_compiled_cache_hits') >= hits_before + 2
+
+        project.delete_all_messages(user_id)
+        db.session.delete(User.query.filter_by(id=user_id).first())
+        db.session.commit()
+
+
+def test_request_profiler_counts_statements(monkeypatch):
+    # Check that with profiling on a poll reports the statements it ran as headers in debug mode only, in both serving
+    # modes, and that a request running too many statements is logged as slow
+    import time
+    import anyio
+    import httpx
+    from sqlalchemy import text
+    from project import request_profiler, instrumentation
+    from project.asgi import asgi_app
+
+    with app.app_context():
+        user = project.create_new_user("telegram", str(randint(100000000, 999999999)))
+        user_id, user_token = user.id, user.token
+        project.add_new_message(user_id, "telegram", "A note")
+
+    slow_requests_before = instrumentation.snapshot()['counters'].get('request_profiler_slow_requests', 0)
+    monkeypatch.setattr(request_profiler, "request_profiling_enabled", True)
+    monkeypatch.setattr(app, "debug", True)
+
+    with app.test_client() as client:
+        response = client.post('/get_new_messages/', json={'user_id': user_token})
+        assert response.status_code == 200
+        assert int(response.headers['X-DB-Statements']) >= 2
+        assert response.headers['X-HTTP-Requests'] == "0"
+        assert response.headers['Server-Timing'].startswith("db;dur=")
+
+    async def run():
+        async with httpx.AsyncClient(app=asgi_app, base_url="http://testserver") as client:
+            response = await client.post('/get_new_messages/', json={'user_id': user_token})
+            assert response.status_code == 200
+            assert int(response.headers['X-DB-Statements']) >= 2
+
+    anyio.run(run)
+
+    with app.test_client() as client:
+        monkeypatch.setattr(app, "debug", False)
+        monkeypatch.setattr(request_profiler, "slow_request_statement_threshold", 1)
+        response = client.post('/get_new_messages/', json={'user_id': user_token})
+        assert response.status_code == 200
+        assert 'X-DB-Statements' not in response.headers
+        assert instrumentation.snapshot()['counters']['request_profiler_slow_requests'] == slow_requests_before + 1
+
+    # A statement that fails doesn't leave its start time behind to be counted against the next one
+    with app.app_context(), request_profiler.profile_request("GET", "/test") as profile:
+        with pytest.raises(Exception):
+            db.session.execute(text("SELECT * FROM a_table_that_does_not_exist"))
+        db.session.rollback()
+        time.sleep(0.3)
+        db.session.execute(text("SELECT 1"))
+        assert profile.statement_count == 2
+        assert profile.db_seconds < 0.3
+
+    with app.app_context():
+        db.session.delete(User.query.filter_by(id=user_id).first())
+        db.session.commit()
+
+
+def test_demo_tokens_served_without_database(monkeypatch):
+    # Check that every demo token gets its fixed response, even with a plugin version sent, in both serving modes and
+    # without running any SQL
+    import anyio
+    import httpx
+    from project import demo_fixtures, request_profiler
+    from project.asgi import asgi_app
+
+    with monkeypatch.context() as patch, app.test_client() as client:
+        patch.setattr(request_profiler, "request_profiling_enabled", True)
+        patch.setattr(app, "debug", True)
+        for token, messages in demo_fixtures.demo_messages.items():
+            response = client.post('/get_new_messages/', json={'user_id': token, 'plugin_version': '0.0.1'})
+            assert response.status_code == 200
+            assert response.headers['X-DB-Statements'] == "0"
+            assert response.json['messages'] == {'count': len(messages), 'contents': messages}
+
+    assert len(demo_fixtures.demo_messages['dummy']) == 5
+
+    async def run():
+        async with httpx.AsyncClient(app=asgi_app, base_url="http://testserver") as client:
+            response = await client.post('/get_new_messages/', json={'user_id': 'dummy_all', 'plugin_version': '0.0.1'})
+            assert response.status_code == 200
+            assert response.content == demo_fixtures.demo_response_bodies['dummy_all']
+
+    anyio.run(run)
+
+
+def test_lifecycle_drains_and_persists_unsent_messages(monkeypatch):
+    # Check that a stopping worker waits for work in flight until the deadline, that a service message interrupted by
+    # the worker stopping is kept, and that the next worker sends it
+    import threading
+    from datetime import datetime, timedelta
+    from project import lifecycle, janitor, PendingSend
+
+    # The janitor is started by the worker, whichever server is running it
+    assert janitor.start_janitor_with_worker in lifecycle._start_hooks
+
+    monkeypatch.setattr(lifecycle, "shutdown_deadline_seconds", 0.2)
+    try:
+        work_started, release_work = threading.Event(), threading.Event()
+
+        def slow_work():
+            with lifecycle.in_flight('test_work'):
+                work_started.set()
+                release_work.wait(5)
+
+        thread = threading.Thread(target=slow_work)
+        thread.start()
+        work_started.wait(5)
+        assert lifecycle.wait_for_in_flight() == {'test_work': 1}
+        release_work.set()
+        thread.join()
+        assert lifecycle.wait_for_in_flight() == {}
+
+        with app.app_context():
+            provider_ids = [str(randint(100000000, 999999999)) for _ in range(2)]
+            user_ids = [project.create_new_user("telegram", provider_id).id for provider_id in provider_ids]
+
+            lifecycle.begin_stopping()
+            project.send_service_message("Back in a minute")
+            pending_sends = PendingSend.query.all()
+            assert set(provider_ids) <= {pending_send.provider_id for pending_send in pending_sends}
+            assert all(pending_send.disable_notification for pending_send in pending_sends)
+
+            # The next workers - one claims the oldest message and is then killed, so the other sends the rest, and the
+            # oldest once the claim has run out
+            lifecycle.reset()
+            claimed = lifecycle.claim_next_pending_send()
+            assert claimed.id == min(pending_send.id for pending_send in pending_sends)
+
+            sent = []
+            monkeypatch.setattr(lifecycle, "send_message", lambda *args: sent.append(args) or True)
+            assert lifecycle.send_pending_sends() == len(pending_sends) - 1
+            assert PendingSend.query.count() == 1
+
+            claimed.claimed_at = datetime.now() - timedelta(seconds=lifecycle.pending_send_claim_seconds + 1)
+            db.session.commit()
+            assert lifecycle.send_pending_sends() == 1
+            assert ("telegram", provider_ids[0], "Back in a minute", True) in sent
+            assert PendingSend.query.count() == 0
+
+            for user_id in user_ids:
+                db.session.delete(User.query.filter_by(id=user_id).first())
+            db.session.commit()
+    finally:
+        lifecycle.reset()
+
+
+def test_pending_send_kept_when_sending_fails(monkeypatch):
+    # Check that a message left over by a previous worker that fails to send is kept, with its claim given up, and that
+    # the rest wait until the next worker starts
+    from project import lifecycle, PendingSend
+
+    monkeypatch.setattr(telegram, "send_telegram_message", lambda *args: False)
+    assert project.send_message("telegram", "123", "Hello") is False
+
+    with app.app_context():
+        provider_ids = [str(randint(100000000, 999999999)) for _ in range(2)]
+        lifecycle.persist_pending_sends([("telegram", provider_id, "Back in a minute", True) for provider_id in provider_ids])
+
+        attempts = []
+        monkeypatch.setattr(lifecycle, "send_message", lambda *args: attempts.append(args) and False)
+        assert lifecycle.send_pending_sends() == 0
+        assert len(attempts) == 1
+
+        pending_sends = PendingSend.query.all()
+        assert sorted(pending_send.provider_id for pending_send in pending_sends) == sorted(provider_ids)
+        assert all(pending_send.claimed_at is None for pending_send in pending_sends)
+
+        monkeypatch.setattr(lifecycle, "send_message", lambda *args: True)
+        assert lifecycle.send_pending_sends() == 2
+        assert PendingSend.query.count() == 0
+
+
+def test_lazy_integrations_not_imported_at_startup():
+    # Check that importing the project doesn't pull in the integrations that are now loaded lazily
+    import os
+    import subprocess
+    import sys
+
+    # Sentry is only imported when a DSN is configured, so make sure it isn't for this check
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import project"],
+        capture_output=True,
+        text=True,
+        env=dict(os.environ, SENTRY_DSN="")
+    )
+    assert result.returncode == 0, result.stderr
+
+    imported_modules = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        imported_modules.add(line.split("|")[-1].strip())
+
+    for lazy_module in ["sentry_sdk", "redmail", "email_validator", "humanize", "apscheduler", "PIL"]:
+        assert lazy_module not in imported_modules, f"{lazy_module} should not be imported at startup"
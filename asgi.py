@@ -0,0 +1,6 @@
+from project.asgi import asgi_app as app
+
+# Async serving mode, run with: uvicorn asgi:app
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app)
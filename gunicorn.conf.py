@@ -0,0 +1,18 @@
+# Gunicorn reads this file from the directory it is started in, eg: gunicorn wsgi:app
+# It hooks the workers into project/lifecycle.py, so a worker being recycled finishes (or persists) its work first
+
+# Must be longer than lifecycle.shutdown_deadline_seconds, or the arbiter kills workers while they are still draining
+graceful_timeout = 30
+
+
+def post_worker_init(worker):
+    from project import app, lifecycle
+
+    lifecycle.watch_for_stop_signal()
+    lifecycle.start_worker(app)
+
+
+def worker_exit(server, worker):
+    from project import lifecycle
+
+    lifecycle.stop_worker()
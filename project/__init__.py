@@ -1,53 +1,92 @@
-from sentry_sdk.integrations.flask import FlaskIntegration
 import os
 import glob
 import requests
 from requests.auth import HTTPBasicAuth
 from datetime import datetime, time, timedelta
-import humanize
 import secrets
 import logging
 from dataclasses import dataclass
 
 from .mailman import send_email, send_onboarding_email
 
-import sentry_sdk
-
 # Import flask
-from flask import Flask, render_template, request, jsonify, Response
-from flask_sqlalchemy import SQLAlchemy
+import click
+from flask import Flask, Blueprint, render_template, request, jsonify, Response, current_app
 from flask_migrate import Migrate
 from flask_cors import CORS
 
 # Import secrets
 from . import envars
 
-from email_validator import validate_email, EmailNotValidError
+from . import instrumentation
+from . import http_client
+from . import shared_state
+from . import sharding
+from . import compression
+from . import encryption
+from . import json_provider
+from . import geocoding
+from . import request_guard
+from . import request_profiler
 
 # Sentry for error logging
 # Disable this if you have self deployed and don't want to send errors to Sentry
 sentry_logging = True
-if sentry_logging:
-    if envars.sentry_dsn:
-        sentry_sdk.init(
-            dsn=envars.sentry_dsn,
-            integrations=[
-                FlaskIntegration(),
-            ],
-            traces_sample_rate=1.0
-        )
 
-# Create the app
-app = Flask(__name__)
-CORS(app)
+# The extensions and routes are created here and attached to an app by create_app
+db = sharding.ShardedSQLAlchemy()  # a plain SQLAlchemy() unless DB_SHARD_COUNT is above 1
+migrate = Migrate()
+routes = Blueprint('loglink', __name__, cli_group=None)
+
+
+def init_sentry():
+    # Sentry is only imported if we are actually going to use it, as it is slow to import
+    if not sentry_logging or not envars.sentry_dsn:
+        return False
+
+    import sentry_sdk
+    from sentry_sdk.integrations.flask import FlaskIntegration
+
+    sentry_sdk.init(
+        dsn=envars.sentry_dsn,
+        integrations=[
+            FlaskIntegration(),
+        ],
+        traces_sample_rate=1.0
+    )
+    return True
+
+
+def create_app(config=None):
+    # Create the app
+    app = Flask(__name__)
+    CORS(app)
+
+    # Create the DB
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///messages.sqlite3'
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    if sharding.is_sharded():
+        app.config['SQLALCHEMY_BINDS'] = sharding.shard_binds()
+    if json_provider.get_orjson():
+        app.json = json_provider.OrjsonProvider(app)  # faster, with the same output
+    app.json.sort_keys = False
+    app.config['SECRET_KEY'] = envars.app_secret_key
+    app.config['MAX_CONTENT_LENGTH'] = request_guard.max_content_length
+    if config:
+        app.config.update(config)
+
+    # Bad requests are turned away before Flask parses them, and the rest are profiled if REQUEST_PROFILING is set
+    app.wsgi_app = request_profiler.RequestProfilerMiddleware(app.wsgi_app, app)
+    app.wsgi_app = request_guard.RequestGuardMiddleware(app.wsgi_app)
+
+    db.init_app(app)
+    migrate.init_app(app, db)
+    init_sentry()
+
+    app.register_blueprint(routes)
+
+    return app
 
-# Create the DB
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///messages.sqlite3'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.json.sort_keys = False
-app.config['SECRET_KEY'] = envars.app_secret_key
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
 
 # Define global paths and uris
 app_uri = "https://loglink.it/"
@@ -57,8 +96,9 @@ beta_codes_folder = "beta_codes"
 telegram_invite_link_uri = f"https://t.me/{envars.telegram_bot_name}"
 plugin_url = "https://api.github.com/repos/hankhank10/loglink-plugin/releases/latest"
 
-latest_plugin_version = "0.0.0"  # default, will be updated
-latest_plugin_version_last_checked = datetime.now()
+# The latest plugin version is kept in shared_state so that every worker shares it and only one of them checks github
+plugin_version_check_interval_seconds = 60 * 60
+plugin_version_retry_seconds = 60  # if a check fails, how long before another worker can try again
 
 # Global app settings
 delete_immediately = True  # This setting means messages are deleted immediately after they are delivered - keep on in production, but maybe turn off for testing
@@ -66,13 +106,10 @@ token_length = 18
 creating_db = False
 
 # Image upload services
-image_upload_service = "imgbb"
-# if image_upload_service == "imgur":
-#    from . import imgur
-if image_upload_service == "imgbb":
-    from . import imgbb
+# The backends themselves (imgbb, imgur, local and s3) and which one is the default are in image_storage.py
+from . import imgbb
 
-require_user_to_have_own_cloud_account = True
+require_user_to_have_own_cloud_account = True  # only applies to imgbb
 
 
 # Message strings
@@ -90,7 +127,7 @@ message_string = {
     "error_with_message": "This message could not be saved",
     "message_type_not_supported": "This message type is not supported",
     "plugin_instructions": f"You should paste this token into your plugin settings in Logseq. See {app_uri}setup-plugin for more information.",
-    "telegram_help_message": "*LogLink Help Menu*^^You can use the following commands to seek help:^^/imgbb: Connect LogLink with your imgBB account to allow image uploads^/token_refresh: Generate a new token and send it to yourself^/delete_account: Delete your account^^The full instructions are at " + app_uri + "",
+    "telegram_help_message": "*LogLink Help Menu*^^You can use the following commands to seek help:^^/imgbb: Connect LogLink with your imgBB account to allow image uploads^/storage: Choose where your images are stored^/digest: Group the notes you send between syncs into a single block^/token_refresh: Generate a new token and send it to yourself^/delete_account: Delete your account^^The full instructions are at " + app_uri + "",
     "sorry_didnt_understand_command": "Sorry, I didn't understand that command.",
     "delete_failed_not_in_database": "No record associated with this ID found in the database",
     "user_deleted": "Your account and all associated messages were deleted. If you want to use the service again, send another message.",
@@ -103,8 +140,17 @@ message_string = {
     "imgbb_no_argument": "To specify an imgbb API key, use the command /imgbb followed by your API key.^^Full instructions at " + app_uri + "image-upload",
     "imgbb_invalid_key": "I tried to send a test message to imgbb using that API key but it didn't work.^^Full instructions at " + app_uri + "image-upload",
     "imgbb_key_set": "Your imgbb API key has been set and you should now be able to upload images. Try it out!",
+    "storage_options": "To choose where your images are stored, use the command /storage followed by one of: ",
+    "storage_set": "Your images will now be stored using ",
+    "storage_not_available": "That image storage option isn't available. You may need to set your imgbb API key first with /imgbb.",
+    "digest_options": "To have the notes you send between syncs arrive in Logseq as a single block with a bullet for each note, use /digest on (and /digest off to turn it off again).",
+    "digest_on": "Digest mode is on. Notes you send between syncs will arrive in Logseq as a single block with a bullet for each note (images, locations and tasks still arrive on their own).",
+    "digest_off": "Digest mode is off. Each note will arrive in Logseq as its own block.",
+    "digest_header": "📥 {count} notes",
     "new_version_available": f"FYI, a new version of the LogLink plugin is available. Please update via the marketplace.",
     "new_version_available_desktop": f"FYI, a new version of the LogLink plugin is available for Logseq Desktop. Please update via the marketplace on your desktop.",
+    "sending_too_fast": "You are sending messages faster than LogLink can take them, so some were not saved. Please slow down and send anything that is missing again.",
+    "message_queue_full": "You have too many messages waiting to be synced, so this one was not saved. Sync your messages in Logseq and then try again.",
 }
 
 media_urls = {
@@ -136,8 +182,17 @@ class User(db.Model):
 
     imgbb_api_key: str = db.Column(db.String(80), nullable=True)
 
+    # If not set the deployment's default image storage backend is used
+    image_storage_backend: str = db.Column(db.String(20), nullable=True)
+
     api_call_count: int = db.Column(db.Integer, default=0, nullable=False)
 
+    # If set, consecutive short notes are folded into one block when delivered - see digest.py
+    digest_mode: bool = db.Column(db.Boolean, default=False, nullable=False)
+
+    # The user's message data key, wrapped with a key derived from their token - see encryption.py
+    message_key = db.Column(db.LargeBinary, nullable=True)
+
     @property
     def messages(self):
         return Message.query.filter_by(user_id=self.id).all()
@@ -152,6 +207,8 @@ class User(db.Model):
 
     @property
     def last_message_timestamp_readable(self):
+        import humanize
+
         last_message_timestamp = Message.query.filter_by(
             user_id=self.id).order_by(Message.timestamp.desc()).first().timestamp
         return humanize.naturaltime(datetime.now() - last_message_timestamp)
@@ -167,7 +224,8 @@ class Message(db.Model):
 
     user_id = db.Column(db.String(80), db.ForeignKey('user.id'))
 
-    contents: str = db.Column(db.String(10000))
+    # Long contents are compressed in the database, see compression.py
+    contents: str = db.Column(compression.CompressedText(10000))
     timestamp: datetime = db.Column(db.DateTime)
     delivered: bool = db.Column(db.Boolean, default=False, nullable=False)
 
@@ -176,8 +234,80 @@ class Message(db.Model):
         return (datetime.now() - self.timestamp).seconds / 60
 
 
-with app.app_context():
+@dataclass
+class UpdateOffset(db.Model):
+    # How far through a provider's update stream we have got when polling for updates - see telegram_polling.py
+    id: int = db.Column(db.Integer, primary_key=True)
+
+    name: str = db.Column(db.String(40), unique=True, nullable=False)
+
+    next_update_id: int = db.Column(db.Integer, nullable=False)
+
+    updated: datetime = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now, nullable=False)
+
+
+@dataclass
+class Lease(db.Model):
+    # Held by one worker at a time, for background jobs that only one worker should run - see janitor.py
+    name: str = db.Column(db.String(40), primary_key=True)
+
+    holder: str = db.Column(db.String(100), nullable=False)
+
+    expires: datetime = db.Column(db.DateTime, nullable=False)
+
+
+@dataclass
+class PendingSend(db.Model):
+    # A message a worker was stopped before it could send, which the next worker to start sends - see lifecycle.py
+    id: int = db.Column(db.Integer, primary_key=True)
+
+    provider: str = db.Column(db.String(20), nullable=False)
+
+    provider_id: str = db.Column(db.String(30), nullable=False)
+
+    contents: str = db.Column(db.Text, nullable=False)
+
+    disable_notification: bool = db.Column(db.Boolean, default=False, nullable=False)
+
+    created: datetime = db.Column(db.DateTime, default=datetime.now, nullable=False)
+
+    # Set by the worker sending it, so no other worker sends it too - see lifecycle.claim_next_pending_send
+    claimed_at: datetime = db.Column(db.DateTime, nullable=True)
+
+
+@dataclass
+class BetaCode(db.Model):
+    id: int = db.Column(db.Integer, primary_key=True)
+
+    code: str = db.Column(db.String(20), unique=True, nullable=False)  # unique, so it is indexed
+
+    created: datetime = db.Column(db.DateTime, default=datetime.now, nullable=False)
+
+
+def create_all_tables():
+    # Creates any tables that don't exist yet, on every shard
     db.create_all()
+    if sharding.is_sharded():
+        sharding.create_shard_tables(db, current_app)
+
+
+@routes.cli.command('create-db')
+def create_db_command():
+    # Run with: flask --app project create-db
+    create_all_tables()
+    print("Database tables created")
+
+
+@routes.cli.command('reshard')
+@click.argument('shard_count', type=int)
+def reshard_command(shard_count):
+    # Moves users and messages onto shard_count shards, run with the server stopped: flask --app project reshard 4
+    # Then set DB_SHARD_COUNT to the new shard count and start the server again
+    if shard_count < 1:
+        print("The shard count must be at least 1")
+        return
+    users_moved, messages_moved = sharding.reshard(db, current_app, shard_count)
+    print(f"Moved {users_moved} users and {messages_moved} messages onto {shard_count} shards - now set DB_SHARD_COUNT={shard_count}")
 
 ################
 # HOUSEKEEPING #
@@ -201,7 +331,12 @@ def get_latest_plugin_version():
     # Gets the latest version of the loglink pulgin from github - if you are self deploying this or using a custom plugin then you may want to change this
 
     logging.info("Getting latest plugin version from Github API")
-    response = requests.get(plugin_url)
+    try:
+        response = http_client.get(plugin_url)
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Error getting latest plugin version: {e}")
+        return "0.0.0"
+
     if response.status_code == 200:
         response = response.json()
         version = response['tag_name']
@@ -213,27 +348,144 @@ def get_latest_plugin_version():
         return "0.0.0"
 
 
+def get_cached_latest_plugin_version():
+    return shared_state.get_value('latest_plugin_version', "0.0.0")
+
+
+def is_plugin_version_check_due():
+    # We only check github for a new plugin version once an hour
+
+    return shared_state.get_value('latest_plugin_version_fresh') is None
+
+
+def claim_plugin_version_check():
+    # Returns True if this worker should check github now - only one worker gets to at a time
+
+    if not is_plugin_version_check_due():
+        return False
+    return shared_state.set_value_if_absent(
+        'latest_plugin_version_check_claimed',
+        True,
+        ttl_seconds=plugin_version_retry_seconds
+    )
+
+
+def store_latest_plugin_version(version):
+    # If the check failed we keep whatever version we already had, and try again once the claim expires
+
+    if version == "0.0.0":
+        return
+    shared_state.set_value('latest_plugin_version', version)
+    shared_state.set_value('latest_plugin_version_fresh', True, ttl_seconds=plugin_version_check_interval_seconds)
+    shared_state.delete_value('latest_plugin_version_check_claimed')
+
+
+def refresh_latest_plugin_version():
+    # Returns the latest plugin version, checking github first if it is due
+
+    if claim_plugin_version_check():
+        store_latest_plugin_version(get_latest_plugin_version())
+    return get_cached_latest_plugin_version()
+
+
+def is_plugin_out_of_date(plugin_version, latest_plugin_version=None):
+    # Compares the version the plugin says it is running with the latest version on github
+
+    if latest_plugin_version is None:
+        latest_plugin_version = get_cached_latest_plugin_version()
+    return calculate_version_number(plugin_version) < calculate_version_number(latest_plugin_version)
+
+
 def list_of_beta_codes():
-    # Gets the list of beta codes in the beta_codes folder
-    list_of_codes = []
-    for file in glob.glob(f"{beta_codes_folder}/*.txt"):
-        filename = file.replace(".txt", "")
-        filename = filename.replace(f"{beta_codes_folder}/", "")
-        list_of_codes.append(filename)
-    return list_of_codes
+    # Gets the list of unused beta codes
+    return [
+        beta_code.code for beta_code in BetaCode.query.order_by(BetaCode.created).all()
+    ]
 
 
 def use_beta_code(beta_code):
-    # "Uses" a beta code by deleting it from the directory
-    if beta_code in list_of_beta_codes():
+    # "Uses" a beta code by deleting it from the table
+    # This is a single DELETE so if two users try to claim the same code at once only one of them gets it
+    if not beta_code:
+        logging.warning("No beta code provided")
+        return False
+
+    try:
+        claimed = BetaCode.query.filter_by(code=beta_code).delete()
+        db.session.commit()
+    except:
+        db.session.rollback()
+        logging.error(f"Error using beta code: {beta_code}")
+        return False
+
+    if claimed:
         logging.info(f"Using beta code: {beta_code}")
-        os.remove(f"{beta_codes_folder}/{beta_code}.txt")
         return True
     else:
-        logging.warn(f"Beta code not found: {beta_code}")
+        logging.warning(f"Beta code not found: {beta_code}")
         return False
 
 
+def create_beta_codes(number_of_codes):
+    # Creates a batch of new beta codes with a single bulk insert, returns the list of codes
+
+    if number_of_codes < 1:
+        return []
+
+    now = datetime.now()
+    new_codes = [secrets.token_hex(5) for i in range(number_of_codes)]
+    try:
+        db.session.execute(
+            BetaCode.__table__.insert(),
+            [{'code': new_code, 'created': now} for new_code in new_codes]
+        )
+        db.session.commit()
+    except:
+        db.session.rollback()
+        logging.error("Error creating beta codes")
+        return False
+    return new_codes
+
+
+def import_beta_code_files():
+    # Beta codes used to be stored as empty files in the beta_codes folder
+    # This moves any that are left into the database, returns how many were imported
+
+    file_codes = []
+    for file in glob.glob(f"{beta_codes_folder}/*.txt"):
+        file_codes.append(os.path.basename(file).replace(".txt", ""))
+
+    if not file_codes:
+        return 0
+
+    existing_codes = {
+        beta_code.code for beta_code in BetaCode.query.filter(BetaCode.code.in_(file_codes)).all()
+    }
+    codes_to_import = [code for code in file_codes if code not in existing_codes]
+
+    if codes_to_import:
+        now = datetime.now()
+        db.session.execute(
+            BetaCode.__table__.insert(),
+            [{'code': code, 'created': now} for code in codes_to_import]
+        )
+        db.session.commit()
+
+    # Only remove the files once they are safely in the database
+    for code in file_codes:
+        os.remove(f"{beta_codes_folder}/{code}.txt")
+
+    logging.info(f"Imported {len(codes_to_import)} beta codes from {beta_codes_folder}")
+    return len(codes_to_import)
+
+
+@routes.cli.command('import-beta-codes')
+def import_beta_codes_command():
+    # Run with: flask --app project import-beta-codes
+    number_imported = import_beta_code_files()
+    print(f"Imported {number_imported} beta codes")
+
+
 def escape_markdown(text, carriage_return_only=False):
     if not carriage_return_only:
         char_list = [
@@ -295,15 +547,12 @@ def random_token(token_type=None):
 
 
 def is_user_able_to_upload_to_cloud(user_id):
-    # Check that the user both exists and has an imgbb key associated with their account
+    # Check that the user both exists and can use their image storage backend (eg has an imgbb key)
 
     user = User.query.filter_by(id=user_id).first()
     if not user:
         return False
-    if user.imgbb_api_key:
-        return True
-    else:
-        return False
+    return image_storage.is_user_able_to_upload(user)
 
 
 def create_new_user(
@@ -329,17 +578,18 @@ def create_new_user(
                 )
                 return False
 
-    new_user = User(
-        provider_id=provider_id,
-        token=random_token(provider),
-        provider=provider,
-        approved=approved
-    )
+    def make_new_user():
+        return User(
+            provider_id=provider_id,
+            token=random_token(provider),
+            provider=provider,
+            approved=approved
+        )
+
     try:
-        db.session.add(new_user)
-        db.session.commit()
-        return new_user
+        return sharding.add_new_user(db.session, make_new_user)
     except:
+        db.session.rollback()
         return False
 
 
@@ -348,35 +598,49 @@ def add_new_message(
         provider,
         message_contents,
         provider_message_id=None,
+        commit=True,
 ):
+    # With commit=False the message is only flushed, so the caller can commit it along with its own changes - if the
+    # flush fails the error is raised, for the caller to roll back
 
     # Get the user record
-    user = User.query.filter_by(id=user_id).first()
+    user = queries.get_user_by_id(user_id)
 
     if not user:
         return False
 
     # Add to the user's API count
     user.api_call_count = user.api_call_count + 1
-    db.session.commit()
+    if commit:
+        db.session.commit()
 
     # Create the message
     new_message = Message(
         user_id=user_id,
         provider_message_id=provider_message_id,
         provider=provider,
-        contents=message_contents,
+        contents=encryption.encrypt_contents(user, message_contents),
         timestamp=datetime.now(),
     )
+    db.session.add(new_message)
+    if not commit:
+        db.session.flush()
+        return True
+
     try:
-        db.session.add(new_message)
         db.session.commit()
-    except:
+    except Exception as e:
+        logging.error(f"Failed to add a message to the database: {e}")
+        db.session.rollback()
         return False
 
     return True
 
 
+location_pin = "📍"
+google_maps_base_url = "https://maps.google.com/maps?q="
+
+
 def compose_location_message_contents(
     location_latitude,
     location_longitude,
@@ -385,60 +649,33 @@ def compose_location_message_contents(
     location_url=None,
 ):
 
-    message_contents = None
-
-    location_pin = "📍"
-    location_details = ""
-
-    if location_name:
-        location_details = location_name
+    # A bare location (rather than a venue) is named after the nearest place in the gazetteer, if one is configured
+    if not location_name and not location_address:
+        place_name = geocoding.reverse_geocode(location_latitude, location_longitude)
+        if place_name:
+            location_name = f"Near {place_name}"
 
     if location_address:
-        if location_details:
-            location_details = f"{location_details}, "
-        location_details = f"{location_details}{location_address}"
+        location_details = f"{location_name}, {location_address}" if location_name else location_address
+    elif location_name:
+        location_details = f"{location_name} ({location_latitude}, {location_longitude})"
     else:
-        if location_details:
-            location_details = f"{location_details} {location_latitude}, {location_longitude})"
-        else:
-            location_details = f"Lat: {location_latitude}, Lon: {location_longitude}"
+        location_details = f"Lat: {location_latitude}, Lon: {location_longitude}"
 
     if location_url:
         location_details = f"{location_details} {location_url}"
 
-    google_maps_base_url = "https://maps.google.com/maps?q="
-    google_maps_address = f"{google_maps_base_url}{location_latitude},{location_longitude}"
-
-    message_contents = f"{location_pin} {location_details} {google_maps_address}"
-
-    return message_contents
+    return f"{location_pin} {location_details} {google_maps_base_url}{location_latitude},{location_longitude}"
 
 
 def compose_image_message_contents(
         image_file_path,
-        imgbb_api_key=None,
-        caption=None
+        caption=None,
+        user=None,
 ):
 
-    # If we require the user to have their own cloud account, check whether they have one
-    if require_user_to_have_own_cloud_account:
-        # At the moment only imgbb is implemented
-        if not imgbb_api_key:
-            logging.error("No imgbb API key provided when one was required")
-            return False
-
-    # Upload the image to the cloud service
-    image_upload_result = False
-    if image_upload_service == "imgbb":
-        image_upload_result = imgbb.upload_image(
-            image_file_path,
-            user_api_token=imgbb_api_key
-        )
-    else:
-        # If image_upload_service is not set to something we recognise then return False
-        logging.error(
-            f"Could not upload image to service {image_upload_service} because it was not a recognised service")
-        return False
+    # Upload the image to the user's image storage backend
+    image_upload_result = image_storage.upload_image(image_file_path, user=user)
 
     if image_upload_result:
         logging.info(f"Image uploaded to cloud at url {image_upload_result}")
@@ -457,7 +694,7 @@ def compose_image_message_contents(
 def set_user_imgbb_api_key(user_id, imgbb_api_key):
 
     # Check that we are even using imgbb for cloud image storage
-    if image_upload_service != "imgbb":
+    if "imgbb" not in [image_storage.default_backend] + image_storage.user_selectable_backends:
         logging.error(
             "Tried to add an imgbb_api_key to a user, but we are not using imgbb")
         return False
@@ -495,9 +732,8 @@ def send_message(
         return False
 
     if provider == 'telegram':
-        telegram.send_telegram_message(
+        return telegram.send_telegram_message(
             provider_id, contents, disable_notification)
-        return True
 
     return False
 
@@ -616,8 +852,9 @@ def help_send_new_token(
     # Delete all old messages
     delete_all_messages(user.id)
 
-    # Refresh the token
+    # Refresh the token, and with it the message key, as it is wrapped with a key derived from the token
     user.token = random_token(provider)
+    user.message_key = None
     db.session.commit()
     send_message(provider, provider_id, message_string["resetting_your_token"])
     send_message(provider, provider_id,
@@ -635,32 +872,65 @@ def help_more_help(
     return True
 
 
+# The statements for the lookups made on every request
+from . import queries
+
+# The fixed responses for the plugin's demo tokens
+from . import demo_fixtures
+
+# What happens when a worker starts and stops
+from . import lifecycle
+
 # Import other routes
 if not creating_db:
     if 'telegram' in valid_providers:
         from . import telegram
 
+# The background janitor, started by the server entry points
+from . import janitor
+
+from . import rate_limit
+
+from . import admin_auth
+
+from . import image_storage
+# The export-data and import-data commands
+from . import backup
+
+# Folding notes into digests for users in digest mode
+from . import digest
+
+# The poll-telegram command and update replay route, for running without a webhook
+if not creating_db:
+    if 'telegram' in valid_providers:
+        from . import telegram_polling
+
 
 #####################
 # ROUTES            #
 #####################
 
 
-@app.route('/')
+@routes.route('/')
 def index():
     return "✅ API is running"
 
 
-@app.route('/get_new_messages/', methods=['POST'])
+@routes.route('/get_new_messages/', methods=['POST'])
 def get_new_messages():
+    return process_poll(request.get_json(silent=True))
+
+
+def process_poll(posted_json):
+    # The plugin polling for new messages, shared by the route above and asgi.py
+    # Takes the posted JSON (None if there wasn't any, or it couldn't be parsed) and returns what a Flask view would
 
     print("Message received")
 
     # Check that we have been sent JSON
     try:
-        posted_json = request.get_json()
         user_id = posted_json.get('user_id')
-    except:
+    except AttributeError:
         logging.warn("Failure parsing JSON or no JSON received")
         return jsonify({
             'status': 'error',
@@ -676,68 +946,48 @@ def get_new_messages():
             'message': 'No user_id provided in JSON'
         }, 400
 
-    # Check whether the user token provided is "dummy" in which case return some dummy data
-    if user_id == "dummy":
-        new_messages = []
-        for a in range(1, 5):
-            new_message = {
-                'id': 4242,
-                'provider': 'telegram',
-                'provider_message_id': 'abcdefg',
-                'contents': f"This is dummy message {a}",
-                'timestamp': datetime.now(),
-                'delivered': True
-            }
-
-            new_messages = new_messages + [new_message]
-
-        # Send an image message
-        sad_cat_caption = "sad cat"
-        sad_cat_url = "https://media.giphy.com/media/71PLYtZUiPRg4/giphy.gif"
-
-        image_message = {
-            'id': 4243,
-            'provider': 'telegram',
-            'provider_message_id': 'abcdefg',
-            'contents': f"{sad_cat_caption} ![{sad_cat_caption}]({sad_cat_url})",
-            'timestamp': datetime.now(),
-            'delivered': True
-        }
-        new_messages = new_messages + [image_message]
+    # Demo tokens (eg "dummy") get their fixed response, see demo_fixtures.py
+    demo_response_body = demo_fixtures.get_demo_response_body(user_id)
+    if demo_response_body is not None:
+        response = current_app.response_class(demo_response_body, mimetype='application/json')
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        return response, 200
 
-    else:
-        # Get the user record
-        user = User.query.filter_by(token=user_id).first()
+    # Turn away anyone polling too often before we go anywhere near the database
+    if not rate_limit.check('poll', user_id):
+        return rate_limit.rate_limited_response()
 
-        if not user:
-            return {
-                'status': 'error',
-                'error_type': 'user_not_found',
-                'message': 'No user found with that token. Try refreshing your token at ' + app_uri + ' and is ensure it is correctly entered in settings.'
-            }, 404
+    # Get the user record
+    user = queries.get_user_by_token(user_id)
 
-        # Get the messages from the database
-        messages = Message.query.filter_by(user_id=user.id).all()
+    if not user:
+        return {
+            'status': 'error',
+            'error_type': 'user_not_found',
+            'message': 'No user found with that token. Try refreshing your token at ' + app_uri + ' and is ensure it is correctly entered in settings.'
+        }, 404
 
-        new_messages = []
-        for message in messages:
-            if not message.delivered:
-                message.delivered = True
+    if user.digest_mode:
+        # Read, folded into digests, and marked as delivered in one pass over the rows
+        new_messages = digest.claim_messages_as_digest(user, delete_immediately)
 
-                message_in_memory = message
-                new_messages.append(message_in_memory)
+    else:
+        # Get the messages from the database
+        new_messages = queries.get_undelivered_messages(user.id)
+        for message in new_messages:
+            message.delivered = True
 
         # Mark them as read and delete them from the database
         db.session.commit()
         if delete_immediately:
             delete_delivered_messages(user.id)
 
+        # Decrypt the batch last, so nothing above can write the plaintext back to the database
+        encryption.decrypt_messages(user, new_messages)
+
     # Version checking
-    # Check whether we have already checked the latest version
-    global latest_plugin_version
-    if latest_plugin_version == "0.0.0" \
-            or latest_plugin_version_last_checked < (datetime.now() - timedelta(hours=1)):
-        latest_plugin_version = get_latest_plugin_version()
+    # This only goes to github if no worker has checked within the last hour
+    latest_plugin_version = refresh_latest_plugin_version()
 
     # Check if a version number was sent
     plugin_version = posted_json.get('plugin_version')
@@ -746,13 +996,9 @@ def get_new_messages():
     if plugin_version:
         print("Plugin version: " + plugin_version +
               " vs latest " + latest_plugin_version)
-        cumulative_plugin_version = calculate_version_number(plugin_version)
-        cumulative_latest_plugin_version = calculate_version_number(
-            latest_plugin_version)
         try:
-            if cumulative_plugin_version < cumulative_latest_plugin_version:
-                logging.info('Old version detected: ' + str(cumulative_plugin_version) +
-                             ' < ' + str(cumulative_latest_plugin_version))
+            if is_plugin_out_of_date(plugin_version, latest_plugin_version):
+                logging.info(f'Old version detected: {plugin_version} < {latest_plugin_version}')
                 new_messages.append({
                     'contents': message_string['new_version_available'],
                 })
@@ -782,14 +1028,11 @@ def get_new_messages():
 # ADMIN #
 #########
 
-@app.route('/admin/send_service_message', methods=['POST'])
+@routes.route('/admin/send_service_message', methods=['POST'])
+@admin_auth.admin_required
 def route_send_service_message():
     # This is a route for the admin to send a service message to all users or a particular user - it is an API route that accepts a post request with JSON with the message contents and the user_id
 
-    auth = request.authorization
-    if not auth or not is_admin_password_valid(auth.username, auth.password):
-        return prompt_to_authenticate()
-
     # Check that we have got data from the form
     contents = request.json['contents']
     if not contents:
@@ -830,7 +1073,15 @@ def send_service_message(
             user.provider_id for user in User.query.filter_by(provider="telegram").all()
         ]
 
-    for telegram_provider_id in telegram_provider_id_list_to_send_message_to:
+    for index, telegram_provider_id in enumerate(telegram_provider_id_list_to_send_message_to):
+        # If the worker is being stopped, leave the rest for the next one
+        if lifecycle.is_stopping():
+            lifecycle.persist_pending_sends([
+                ("telegram", provider_id, contents, True)
+                for provider_id in telegram_provider_id_list_to_send_message_to[index:]
+            ])
+            break
+
         telegram.send_telegram_message(
             telegram_provider_id,
             contents,
@@ -839,12 +1090,13 @@ def send_service_message(
 
 
 def check_db():
+    # These count across every shard
     return {
-        'users': User.query.count(),
+        'users': sharding.count_rows(db.session, User),
         'messages': {
-            'total': Message.query.count(),
-            'delivered': Message.query.filter_by(delivered=True).count(),
-            'undelivered': Message.query.filter_by(delivered=False).count()
+            'total': sharding.count_rows(db.session, Message),
+            'delivered': sharding.count_rows(db.session, Message, Message.delivered == True),
+            'undelivered': sharding.count_rows(db.session, Message, Message.delivered == False)
         }
     }
 
@@ -852,51 +1104,30 @@ def check_db():
 def check_stats():
     # A function that returns data from the database as to how many users there are, how many messages are pending delivery, etc
     return {
-        'user_count': User.query.count(),
-        'pending_message_count': Message.query.count(),
+        'user_count': sharding.count_rows(db.session, User),
+        'pending_message_count': sharding.count_rows(db.session, Message),
     }
 
 
-def is_admin_password_valid(
-        admin_username,
-        admin_password
-):
-
-    if admin_username != envars.admin_username:
-        return False
-    if admin_password != envars.admin_password:
-        return False
-    return True
-
-
-def prompt_to_authenticate():
-    # Send a 401 response with a request to authenticate
-    return Response(
-        'Login Required', 401,
-        {'WWW-Authenticate': 'Basic realm="Login Required"'}
-    )
-
-
-@app.route('/admin/logout')
+@routes.route('/admin/logout')
 def logout():
-    # Send an 401 response to log the user out.
-    return Response(
+    # Send an 401 response to log the user out, and forget their session
+    response = Response(
         'Logout', 401,
         {'WWW-Authenticate': 'Basic realm="Login Required"'}
     )
+    return admin_auth.clear_admin_session_cookie(response)
 
 
-@app.route('/admin')
+@routes.route('/admin')
+@admin_auth.admin_required
 def admin_home():
-    auth = request.authorization
-    if not auth or not is_admin_password_valid(auth.username, auth.password):
-        return prompt_to_authenticate()
-
     return render_template(
         'admin_home.html',
         health_status=check_health(),
         stats=check_stats(),
-        user_list=User.query.order_by(User.api_call_count.desc()).all(),
+        # Sorted here, as with several shards each one's users come back separately
+        user_list=sorted(User.query.all(), key=lambda user: user.api_call_count, reverse=True),
         beta_code_list=list_of_beta_codes(),
         telegram_require_beta_code=telegram_require_beta_code
     )
@@ -904,7 +1135,7 @@ def admin_home():
 
 def is_internet_connected():
     try:
-        r = requests.get("https://google.com")
+        r = http_client.get("https://google.com", retry=False)
     except:
         return False
 
@@ -914,32 +1145,31 @@ def is_internet_connected():
         return False
 
 
-@app.route('/admin/health')
-def check_health():
-    auth = request.authorization
-    if not auth or not is_admin_password_valid(auth.username, auth.password):
-        return prompt_to_authenticate()
+@routes.route('/admin/health')
+@admin_auth.admin_required
+def check_health_route():
+    return check_health()
 
-    telegram_health = telegram.check_webhook_health()
 
+def check_health():
     return {
         'server': {
             'ok': True
         },
         'database': check_db(),
         'internet': is_internet_connected(),
-        'telegram_webhook': telegram.check_webhook_health()
+        'telegram_webhook': telegram.check_webhook_health(),
+        'instrumentation': instrumentation.snapshot(),
+        'janitor': janitor.last_run,
+        'image_upload_latency_seconds': image_storage.backend_latency_tracker.snapshot()
     }
 
 
-@app.post('/admin/send_beta_code_to_new_user')
+@routes.post('/admin/send_beta_code_to_new_user')
+@admin_auth.admin_required
 def send_beta_code_to_new_user():
     # This is a route for the admin to onboard a user by sending them a new beta code - it is an API route that accepts a post request with JSON with the user's email address and sends the onboarding email
 
-    auth = request.authorization
-    if not auth or not is_admin_password_valid(auth.username, auth.password):
-        return prompt_to_authenticate()
-
     # Check that we have got data from the form
     user_email = request.json['user_email']
     if not user_email:
@@ -949,6 +1179,7 @@ def send_beta_code_to_new_user():
         }, 400
 
     # Check that the email address received is a valid one
+    from email_validator import validate_email, EmailNotValidError
     try:
         validate_email(user_email)
     except EmailNotValidError as e:
@@ -982,20 +1213,15 @@ def send_beta_code_to_new_user():
 
 
 def create_beta_code():
-    new_code = secrets.token_hex(5)
-    try:
-        open(f"{beta_codes_folder}/{new_code}.txt", "w").close()
-        return new_code
-    except:
+    new_codes = create_beta_codes(1)
+    if not new_codes:
         return False
+    return new_codes[0]
 
 
-@app.route('/admin/beta_codes', methods=['GET', 'POST'])
+@routes.route('/admin/beta_codes', methods=['GET', 'POST'])
+@admin_auth.admin_required
 def beta_codes_route():
-    auth = request.authorization
-    if not auth or not is_admin_password_valid(auth.username, auth.password):
-        return prompt_to_authenticate()
-
     if request.method == 'POST':
         # This creates a new beta code
 
@@ -1020,9 +1246,12 @@ def beta_codes_route():
             }, 400
 
         # Create the codes
-        list_of_codes = []
-        for i in range(number_of_codes):
-            list_of_codes.append(create_beta_code())
+        list_of_codes = create_beta_codes(number_of_codes)
+        if list_of_codes is False:
+            return {
+                "status": "error",
+                "message": "Failed to create beta codes"
+            }, 500
 
         return {
             "status": "success",
@@ -1036,3 +1265,8 @@ def beta_codes_route():
             'count': len(result),
             'codes': result
         }
+
+
+# Create the default app, used by wsgi.py, asgi.py and the tests
+app = create_app()
+db.app = app  # so the models can still be queried outside of a request
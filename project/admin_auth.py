@@ -0,0 +1,191 @@
+# This library protects the admin routes
+# - the admin password is hashed once (or a hash can be supplied directly) and checked in constant time
+# - a successful login sets a signed, short-lived session cookie so auto-refreshing dashboards skip the password check
+# - IPs that keep failing are locked out before we do any hashing, so brute forcing can't load down the server
+
+import hmac
+import logging
+import threading
+from functools import wraps
+
+from flask import current_app, request, Response, make_response
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from . import envars
+from . import instrumentation
+from . import shared_state
+
+# Admin auth settings
+admin_session_cookie_name = "loglink_admin_session"
+admin_session_minutes = 15
+lockout_failure_threshold = 10
+lockout_window_minutes = 15
+lockout_minutes = 15
+
+# Only turn this on if the server is behind a proxy that sets X-Forwarded-For, otherwise it can be spoofed
+use_forwarded_for = False
+
+_admin_password_hash = None
+_admin_password_hash_lock = threading.Lock()
+
+
+def get_admin_password_hash():
+    # Hash the admin password once, the first time it is needed, unless a hash has been provided in the environment
+    # Hashing is deliberately slow so we don't do it at import
+
+    global _admin_password_hash
+
+    with _admin_password_hash_lock:
+        if _admin_password_hash is None:
+            if envars.admin_password_hash:
+                _admin_password_hash = envars.admin_password_hash
+            elif envars.admin_password:
+                _admin_password_hash = generate_password_hash(envars.admin_password)
+            else:
+                logging.warning("No admin password set, admin routes will not be accessible")
+                _admin_password_hash = False
+        return _admin_password_hash
+
+
+class LoginAttemptTracker:
+    # Counts failed logins per IP and locks out IPs that fail too often
+    # The counts are kept in shared_state, so every worker sees the same ones, and expire on their own
+
+    def failures_key(self, ip):
+        return f"admin_login_failures:{ip}"
+
+    def lockout_key(self, ip):
+        return f"admin_login_locked_out:{ip}"
+
+    def is_locked_out(self, ip):
+        return bool(shared_state.get_value(self.lockout_key(ip)))
+
+    def record_failure(self, ip):
+        # The count starts again once lockout_window_minutes have passed since the first failure in the run
+        failure_count = shared_state.increment_value(self.failures_key(ip), ttl_seconds=lockout_window_minutes * 60)
+
+        if failure_count >= lockout_failure_threshold:
+            logging.warning(f"Locking out {ip} from admin routes after {failure_count} failed logins")
+            instrumentation.increment('admin_auth_lockouts')
+            shared_state.set_value(self.lockout_key(ip), True, ttl_seconds=lockout_minutes * 60)
+            shared_state.delete_value(self.failures_key(ip))
+
+    def record_success(self, ip):
+        shared_state.delete_value(self.failures_key(ip))
+
+
+login_attempt_tracker = LoginAttemptTracker()
+
+
+def get_session_serializer():
+    if not current_app.config.get('SECRET_KEY'):
+        return None
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt="loglink-admin-session")
+
+
+def is_admin_password_valid(
+        admin_username,
+        admin_password
+):
+    # Both comparisons are constant time, and we always do both so timing doesn't reveal which one was wrong
+
+    admin_password_hash = get_admin_password_hash()
+    if not admin_password_hash or not envars.admin_username:
+        return False
+
+    username_ok = hmac.compare_digest(
+        str(admin_username or "").encode('utf-8'),
+        envars.admin_username.encode('utf-8')
+    )
+    password_ok = check_password_hash(admin_password_hash, str(admin_password or ""))
+    return username_ok and password_ok
+
+
+def is_admin_session_valid():
+    serializer = get_session_serializer()
+    session_cookie = request.cookies.get(admin_session_cookie_name)
+    if not serializer or not session_cookie:
+        return False
+
+    try:
+        session_username = serializer.loads(session_cookie, max_age=admin_session_minutes * 60)
+    except BadSignature:
+        return False
+
+    return hmac.compare_digest(
+        str(session_username).encode('utf-8'),
+        str(envars.admin_username).encode('utf-8')
+    )
+
+
+def set_admin_session_cookie(response):
+    serializer = get_session_serializer()
+    if not serializer:
+        return response
+
+    response.set_cookie(
+        admin_session_cookie_name,
+        serializer.dumps(envars.admin_username),
+        max_age=admin_session_minutes * 60,
+        httponly=True,
+        samesite='Strict',
+        secure=request.is_secure,
+        path='/admin',
+    )
+    return response
+
+
+def clear_admin_session_cookie(response):
+    response.delete_cookie(admin_session_cookie_name, path='/admin')
+    return response
+
+
+def get_client_ip():
+    if use_forwarded_for and request.headers.get('X-Forwarded-For'):
+        return request.headers['X-Forwarded-For'].split(',')[0].strip()
+    return request.remote_addr
+
+
+def prompt_to_authenticate():
+    # Send a 401 response with a request to authenticate
+    return Response(
+        'Login Required', 401,
+        {'WWW-Authenticate': 'Basic realm="Login Required"'}
+    )
+
+
+def locked_out_response():
+    return Response(
+        'Too many failed login attempts, try again later', 429,
+        {'Retry-After': str(lockout_minutes * 60)}
+    )
+
+
+def admin_required(view):
+    # Decorator for admin routes: accepts a valid session cookie, or Basic auth which then sets the cookie
+
+    @wraps(view)
+    def wrapped_view(*args, **kwargs):
+
+        if is_admin_session_valid():
+            return view(*args, **kwargs)
+
+        client_ip = get_client_ip()
+        if login_attempt_tracker.is_locked_out(client_ip):
+            return locked_out_response()
+
+        auth = request.authorization
+        if not auth:
+            return prompt_to_authenticate()
+
+        if not is_admin_password_valid(auth.username, auth.password):
+            login_attempt_tracker.record_failure(client_ip)
+            instrumentation.increment('admin_auth_failures')
+            return prompt_to_authenticate()
+
+        login_attempt_tracker.record_success(client_ip)
+        response = make_response(view(*args, **kwargs))
+        return set_admin_session_cookie(response)
+
+    return wrapped_view
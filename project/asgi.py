@@ -0,0 +1,207 @@
+# This is an async (ASGI) way of serving LogLink, so one process can hold lots of in-flight requests
+# The webhook and message polling routes are read natively, with the request_guard checks made before and while the
+# body is read, and then handled by the same functions as the Flask routes (telegram.process_webhook and
+# process_poll), run on the event loop through async_bridge:
+# - their requests to Telegram, imgbb and Github are sent with httpx (see http_client)
+# - their queries run on a session using the aiosqlite driver (see get_db_session)
+# so a request waiting on either holds a greenlet rather than a thread, and the event loop gets on with the others
+# Re-encoding images is handed to worker threads, and calls to Redis (only made if REDIS_URL is set) still block
+# Everything else is passed straight through to the normal Flask app
+# The WSGI entry point (wsgi.py) still works exactly as before, this is an alternative to it - run with: uvicorn asgi:app
+
+import anyio
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import project
+from project import app, db
+from project import telegram
+from project import sharding
+from project import http_client
+from project import async_bridge
+from project import request_guard
+from project import request_profiler
+from project import lifecycle
+
+# Async settings
+max_in_flight_handlers = 1000  # webhook and polling requests beyond this wait for one to finish
+
+_handler_limiter = None
+_db_engines = {}  # shard id -> engine using the aiosqlite driver
+
+flask_asgi_app = WsgiToAsgi(app)
+
+
+def get_handler_limiter():
+    # anyio needs a running event loop to create a limiter, so this is created on first use
+
+    global _handler_limiter
+
+    if _handler_limiter is None:
+        _handler_limiter = anyio.CapacityLimiter(max_in_flight_handlers)
+    return _handler_limiter
+
+
+def get_db_session():
+    # A session on the same database files (and shards) as db.session, but using the aiosqlite driver, so each query
+    # waits on the event loop - the engines don't connect until they are used, and hold no connections between
+    # sessions, so they can be shared by every event loop
+
+    if not _db_engines:
+        for shard_id, engine in sharding.get_shard_engines(db, app).items():
+            _db_engines[shard_id] = create_async_engine(engine.url.set(drivername='sqlite+aiosqlite'))
+
+    shards = {shard_id: engine.sync_engine for shard_id, engine in _db_engines.items()}
+    if sharding.is_sharded():
+        return sharding.ShardedSession(shards=shards)
+    return Session(bind=shards[sharding.global_shard_id])
+
+
+async def dispose_db_engines():
+    for engine in _db_engines.values():
+        await engine.dispose()
+    _db_engines.clear()
+
+
+def parse_json(body):
+    # None if the body isn't JSON, which the handlers turn into the same error response Flask would give
+
+    try:
+        return app.json.loads(body)
+    except ValueError:
+        return None
+
+
+def run_handler(path, handler, *args):
+    # Runs one of the handlers shared with the Flask routes (in a greenlet on the event loop), and turns what it
+    # returns into a response - profiled, like a Flask request, if REQUEST_PROFILING is set
+
+    with app.test_request_context(path, method='POST'):
+        # db.session is scoped to the greenlet, so this is the handler's own session - it is closed with the context
+        db.session.registry.set(get_db_session())
+
+        with request_profiler.profile_request('POST', path) as profile:
+            response = app.make_response(handler(*args))
+
+        headers = [('Content-Type', response.headers.get('Content-Type'))]
+        if profile is not None and app.debug:
+            headers += profile.headers()
+        return response.status_code, response.get_data(), headers
+
+
+async def run_natively(path, handler, *args):
+    async with get_handler_limiter():
+        return await async_bridge.run(run_handler, path, handler, *args)
+
+
+async def telegram_webhook(headers, body):
+    return await run_natively(
+        '/telegram/webhook/',
+        telegram.process_webhook,
+        headers.get(request_guard.webhook_secret_header.lower()),
+        parse_json(body)
+    )
+
+
+async def get_new_messages(headers, body):
+    return await run_natively(
+        '/get_new_messages/',
+        project.process_poll,
+        parse_json(body)
+    )
+
+
+native_routes = {
+    ('POST', '/telegram/webhook/'): telegram_webhook,
+    ('POST', '/get_new_messages/'): get_new_messages,
+}
+
+
+async def read_body(receive, max_length):
+    # Returns the body, or None if it is longer than max_length - which we find out without holding more than that
+
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get('body', b'')
+        if len(body) > max_length:
+            return None
+        more_body = message.get('more_body', False)
+    return body
+
+
+def rejection_response(reason, path):
+    request_guard.record_rejection(reason, path)
+    status, response_body = request_guard.rejection_responses[reason]
+    return int(status.split(" ")[0]), response_body, [('Content-Type', 'application/json')]
+
+
+async def handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Starts the janitor, along with the other start hooks
+            lifecycle.start_worker(app)
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            # Waits for work in flight (which carries on while we wait on a thread), and stops the janitor
+            await anyio.to_thread.run_sync(lifecycle.stop_worker)
+            await http_client.close_async_client()
+            await dispose_db_engines()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def asgi_app(scope, receive, send):
+
+    if scope['type'] == 'lifespan':
+        await handle_lifespan(receive, send)
+        return
+
+    handler = None
+    if scope['type'] == 'http':
+        handler = native_routes.get((scope['method'], scope['path']))
+
+    if not handler:
+        # Anything we don't handle natively goes to the Flask app
+        await flask_asgi_app(scope, receive, send)
+        return
+
+    headers = {
+        key.decode('latin-1').lower(): value.decode('latin-1')
+        for key, value in scope['headers']
+    }
+
+    # The same early checks the WSGI app gets from request_guard, made before the body is read
+    rejection_reason = request_guard.check_request(
+        scope['method'],
+        scope['path'],
+        headers.get('content-length'),
+        headers.get(request_guard.webhook_secret_header.lower()),
+    )
+    if rejection_reason:
+        status, response_body, response_headers = rejection_response(rejection_reason, scope['path'])
+    else:
+        # Bodies that don't say how long they are (or lie about it) are held to the same limit as they are read
+        body = await read_body(receive, request_guard.get_max_content_length(scope['method'], scope['path']))
+        if body is None:
+            status, response_body, response_headers = rejection_response('body_too_large', scope['path'])
+        else:
+            status, response_body, response_headers = await handler(headers, body)
+
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response_headers
+        ] + [
+            (b'content-length', str(len(response_body)).encode('latin-1')),
+            (b'access-control-allow-origin', b'*'),
+        ],
+    })
+    await send({
+        'type': 'http.response.body',
+        'body': response_body,
+    })
@@ -0,0 +1,99 @@
+# This library lets the same synchronous code the Flask routes run (telegram.process_webhook, process_poll and
+# everything under them) run on asgi.py's event loop without blocking it, using the greenlet bridge SQLAlchemy's
+# asyncio support is built on
+# - run(fn, *args) runs fn in a greenlet on the event loop
+# - inside it, wait(awaitable) suspends fn until the awaitable is done, and the event loop gets on with other requests
+#   in the meantime - so a request waiting on Telegram, imgbb or the database holds a greenlet, not a thread
+# - http_client sends through httpx this way, and asgi.py gives the handlers a database session on the aiosqlite
+#   driver, which waits like this for every query
+# - blocking(fn, *args) hands things that can't wait like this (eg re-encoding an image) to a worker thread, and
+#   submit() and wait_for_futures() let image_storage start and wait for uploads as tasks on the event loop
+# Outside run() (in a Flask route, the janitor or any other thread) is_active() is False, and all of this just calls
+# straight through, blocking as before
+# Locks taken in code that can run here must never be held across a wait - another greenlet on the same thread that
+# tried to take it would block the event loop for good
+
+import time
+import asyncio
+import weakref
+import concurrent.futures
+
+import anyio
+import greenlet
+from sqlalchemy.util import greenlet_spawn, await_only
+
+_bridged_greenlets = weakref.WeakSet()
+_background_tasks = set()  # asyncio only keeps weak references to tasks, so the ones submit() starts are kept here
+
+
+async def run(fn, *args):
+    # Runs fn(*args) in a greenlet on the event loop, and returns what it returns
+
+    def bridged():
+        _bridged_greenlets.add(greenlet.getcurrent())
+        return fn(*args)
+
+    return await greenlet_spawn(bridged)
+
+
+def is_active():
+    return greenlet.getcurrent() in _bridged_greenlets
+
+
+def wait(awaitable):
+    # Only call this when is_active()
+    return await_only(awaitable)
+
+
+def sleep(seconds):
+    if is_active():
+        wait(anyio.sleep(seconds))
+    else:
+        time.sleep(seconds)
+
+
+def blocking(fn, *args):
+    # Calls fn(*args), on a worker thread if we are on the event loop
+
+    if not is_active():
+        return fn(*args)
+    return wait(anyio.to_thread.run_sync(fn, *args))
+
+
+def submit(executor, fn, *args):
+    # Starts fn(*args) in the background and returns a concurrent.futures Future for it - run as a task on the event
+    # loop if we are on it, otherwise on the executor's threads
+
+    if not is_active():
+        return executor.submit(fn, *args)
+
+    future = concurrent.futures.Future()
+    task = asyncio.get_running_loop().create_task(complete_future(future, fn, args))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return future
+
+
+async def complete_future(future, fn, args):
+    if not future.set_running_or_notify_cancel():
+        return
+    try:
+        future.set_result(await run(fn, *args))
+    except Exception as e:
+        future.set_exception(e)
+
+
+def wait_for_futures(futures, timeout=None, return_when=concurrent.futures.ALL_COMPLETED):
+    # concurrent.futures.wait, without blocking the event loop if we are on it
+
+    if not is_active():
+        return concurrent.futures.wait(futures, timeout=timeout, return_when=return_when)
+
+    futures = set(futures)
+    wait(asyncio.wait(
+        [asyncio.wrap_future(future) for future in futures],
+        timeout=timeout,
+        return_when=return_when
+    ))
+    done = {future for future in futures if future.done()}
+    return done, futures - done
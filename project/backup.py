@@ -0,0 +1,256 @@
+# This library backs up the users and message queue to a single file and restores them, eg to move to a new host
+# without copying a live SQLite file
+# Encrypted contents and keys are exported still encrypted, so importing them needs the same MESSAGE_ENCRYPTION_KEY
+# The file is gzipped line-delimited JSON: a header line, then for each table a line listing its columns followed by
+# one line per row holding just the values, so column names aren't repeated on every row
+# Both directions work a chunk at a time, so memory use doesn't grow with the size of the database
+# Imported users are given new ids after the highest one already there (on their shard, with sharding), and their
+# messages follow them, so an import can go into a database that already has users
+# An import is all or nothing: each shard is written in a single transaction, which is only committed once the whole
+# file has been read, so a bad file or a failed insert leaves the existing users and messages as they were
+# - with sharding, the shards' transactions are committed one after another, so if one of those commits fails (eg the
+#   disk is full) the shards committed before it keep their part of the import - it is only all or nothing per shard
+# Run with: flask --app project export-data backup.jsonl.gz
+#      and: flask --app project import-data backup.jsonl.gz
+
+import gzip
+import base64
+import json
+import logging
+from datetime import datetime
+from timeit import default_timer as timer
+
+import click
+from flask import current_app
+from sqlalchemy import select, insert, delete, func, DateTime
+
+from . import db
+from . import routes
+from . import sharding
+
+# Backup settings
+backup_chunk_size = 5000
+backup_format_name = "loglink-export"
+backup_format_version = 1
+backup_tables = ["user", "message"]  # users first, so messages can be matched to them on import
+
+
+def encode_value(value):
+    # Bytes (encrypted contents and keys, which are exported as they are) become {"base64": ...}
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, bytes):
+        return {'base64': base64.b64encode(value).decode('ascii')}
+    return value
+
+
+def decode_value(value):
+    if isinstance(value, dict):
+        return base64.b64decode(value['base64'])
+    return value
+
+
+def read_table_in_chunks(engine, table, chunk_size):
+    # Pages through the table by primary key, so we never hold more than one chunk or keep a long-running cursor open
+
+    last_id = 0
+    with engine.connect() as connection:
+        while True:
+            rows = connection.execute(
+                select(table).where(table.c.id > last_id).order_by(table.c.id).limit(chunk_size)
+            ).all()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1].id
+
+
+def export_data(path, chunk_size=None):
+    # Writes every user and message (from every shard) to path, returns the number of rows written for each table
+
+    chunk_size = chunk_size or backup_chunk_size
+    engines = sharding.get_shard_engines(db, current_app)
+    rows_written = {}
+
+    with gzip.open(path, 'wt', encoding='utf-8', compresslevel=6) as f:
+        f.write(json.dumps({
+            'format': backup_format_name,
+            'version': backup_format_version,
+            'exported': datetime.now().isoformat(),
+        }) + "\n")
+
+        for table_name in backup_tables:
+            table = db.metadata.tables[table_name]
+            columns = [column.name for column in table.columns]
+            f.write(json.dumps({'table': table_name, 'columns': columns}) + "\n")
+
+            rows_written[table_name] = 0
+            for engine in engines.values():
+                for rows in read_table_in_chunks(engine, table, chunk_size):
+                    f.writelines(
+                        json.dumps([encode_value(value) for value in row], separators=(',', ':')) + "\n"
+                        for row in rows
+                    )
+                    rows_written[table_name] += len(rows)
+
+    return rows_written
+
+
+class Importer:
+    # Keeps track of where imported users went, so their messages follow them
+
+    def __init__(self, connections):
+        self.connections = connections  # shard id -> connection with the import's transaction open on it
+        self.user_ids = {}  # exported user id (as a string, as messages store it) -> new user id
+        self.next_user_ids = {}
+
+    def allocate_user_id(self, user):
+        # The next id after the highest on the user's shard (without sharding there is only shard 0, and that is just the
+        # next id), so imported users never collide with the ones already there
+
+        shard_id = sharding.shard_for_key(user['provider_id'] or user['token'])
+        if shard_id not in self.next_user_ids:
+            max_user_id = self.connections[shard_id].execute(select(func.max(db.metadata.tables['user'].c.id))).scalar()
+            self.next_user_ids[shard_id] = sharding.first_user_id_after(max_user_id, shard_id)
+
+        user_id = self.next_user_ids[shard_id]
+        self.next_user_ids[shard_id] += sharding.shard_count
+        return shard_id, user_id
+
+    def prepare_row(self, table_name, row):
+        # Returns the shard the row goes to and the row as it should be inserted, or None to skip it
+
+        if table_name == 'user':
+            shard_id, user_id = self.allocate_user_id(row)
+            self.user_ids[str(row['id'])] = user_id
+            return shard_id, dict(row, id=user_id)
+
+        # Messages whose user wasn't exported are skipped
+        user_id = self.user_ids.get(str(row['user_id']))
+        if user_id is None:
+            return None
+
+        # Message ids are only unique within a shard, so they are given new ones
+        return sharding.shard_for_user_id(user_id), dict(row, id=None, user_id=str(user_id))
+
+    def insert_chunk(self, table, rows):
+        rows_by_shard = {}
+        for row in rows:
+            prepared = self.prepare_row(table.name, row)
+            if prepared:
+                shard_id, prepared_row = prepared
+                rows_by_shard.setdefault(shard_id, []).append(prepared_row)
+
+        for shard_id, shard_rows in rows_by_shard.items():
+            self.connections[shard_id].execute(insert(table), shard_rows)
+
+        return sum(len(shard_rows) for shard_rows in rows_by_shard.values())
+
+
+def read_header(f, path):
+    header = json.loads(f.readline() or "{}")
+    if header.get('format') != backup_format_name or header.get('version') != backup_format_version:
+        raise ValueError(f"{path} is not a LogLink export this version can read")
+    return header
+
+
+def import_rows(f, importer, chunk_size):
+    # Inserts every row after the header, returns the number of rows imported for each table
+
+    rows_imported = {}
+    table, columns, column_positions, datetime_columns, rows = None, [], [], set(), []
+
+    for line in f:
+        record = json.loads(line)
+
+        if isinstance(record, dict):
+            # A new table is starting, so finish the previous one
+            if rows:
+                rows_imported[table.name] += importer.insert_chunk(table, rows)
+                rows = []
+
+            table = db.metadata.tables[record['table']]
+            columns = [column for column in record['columns'] if column in table.columns]
+            datetime_columns = {column for column in columns if isinstance(table.columns[column].type, DateTime)}
+            rows_imported[table.name] = 0
+            column_positions = [record['columns'].index(column) for column in columns]
+            continue
+
+        row = {column: decode_value(record[position]) for column, position in zip(columns, column_positions)}
+        for column in datetime_columns:
+            if row[column]:
+                row[column] = datetime.fromisoformat(row[column])
+        rows.append(row)
+
+        if len(rows) >= chunk_size:
+            rows_imported[table.name] += importer.insert_chunk(table, rows)
+            rows = []
+
+    if rows:
+        rows_imported[table.name] += importer.insert_chunk(table, rows)
+
+    return rows_imported
+
+
+def import_data(path, chunk_size=None, replace=False):
+    # Loads a file written by export_data, returns the number of rows imported for each table
+    # Users whose token or provider id already exist will fail the import unless replace is set, which deletes all
+    # existing users and messages first (in the same transaction as the shard's import, so they are only gone if it is
+    # committed)
+
+    chunk_size = chunk_size or backup_chunk_size
+    engines = sharding.get_shard_engines(db, current_app)
+
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        # Check the file is one of ours before we touch the database
+        read_header(f, path)
+
+        connections = {shard_id: engine.connect() for shard_id, engine in engines.items()}
+        try:
+            transactions = [connection.begin() for connection in connections.values()]
+
+            if replace:
+                for connection in connections.values():
+                    for table_name in reversed(backup_tables):
+                        connection.execute(delete(db.metadata.tables[table_name]))
+
+            rows_imported = import_rows(f, Importer(connections), chunk_size)
+
+            for transaction in transactions:
+                transaction.commit()
+        finally:
+            # Closing a connection rolls back its transaction if it wasn't committed
+            for connection in connections.values():
+                connection.close()
+
+    return rows_imported
+
+
+@routes.cli.command('export-data')
+@click.argument('path')
+@click.option('--chunk-size', type=int, default=None, help="Rows read per query")
+def export_data_command(path, chunk_size):
+    started = timer()
+    rows_written = export_data(path, chunk_size)
+    duration = timer() - started
+
+    total_rows = sum(rows_written.values())
+    print(f"Exported {rows_written} to {path} in {duration:.1f}s ({total_rows / max(duration, 0.001):,.0f} rows/s)")
+
+
+@routes.cli.command('import-data')
+@click.argument('path')
+@click.option('--chunk-size', type=int, default=None, help="Rows inserted per statement")
+@click.option('--replace', is_flag=True, help="Delete all existing users and messages first")
+def import_data_command(path, chunk_size, replace):
+    started = timer()
+    try:
+        rows_imported = import_data(path, chunk_size, replace)
+    except Exception as e:
+        logging.error(f"Import failed: {e}")
+        print(f"Import failed: {e}")
+        return
+    duration = timer() - started
+
+    total_rows = sum(rows_imported.values())
+    print(f"Imported {rows_imported} from {path} in {duration:.1f}s ({total_rows / max(duration, 0.001):,.0f} rows/s)")
@@ -0,0 +1,95 @@
+# This library compresses message contents at rest
+# Contents above compression_threshold_bytes are deflated with a preset dictionary of text that turns up a lot in
+# Logseq notes and in the messages LogLink itself composes (links, image markdown, locations), which is what lets
+# even fairly short notes shrink. Compressed values are stored as bytes starting with a marker and the id of the
+# dictionary used, so the dictionary can be changed later without breaking existing rows
+# Shorter contents, and anything written before compression was added, are stored as plain text and read back as is
+
+import zlib
+
+from sqlalchemy.types import TypeDecorator, String
+
+from . import instrumentation
+
+# Compression settings
+compression_enabled = True
+compression_threshold_bytes = 64
+compression_level = 6
+compression_dictionary_id = 1
+
+compressed_marker = b"Z"
+
+# zlib finds matches nearest the end of the dictionary most cheaply, so the most common text goes last
+dictionaries = {
+    1: (
+        "collapsed:: true\nid:: \ntags:: \nalias:: \ntitle:: \ntype:: \nsource:: \nauthor:: \nurl:: \n"
+        "SCHEDULED: <2023-01-01 Mon>\nDEADLINE: <2023-01-01 Mon>\n:LOGBOOK:\nCLOCK: [2023-01-01 Mon 09:00]\n:END:\n"
+        "{{embed ((}}))}} {{video https://www.youtube.com/watch?v=}} #+BEGIN_QUOTE\n#+END_QUOTE\n```\n"
+        "LATER NOW WAITING CANCELED [#A] [#B] [#C] "
+        " according to because however therefore although important information government people "
+        " which would there their about could should after before between through during without "
+        " meeting tomorrow today yesterday remember to need to don't forget call email buy idea "
+        " this that with from have will been were what when where your more some also into than "
+        " the and for are but not you all any can had her was one our out has his how its may new "
+        " of to in is it on as at by be or an we if so do my no up he us "
+        "https://twitter.com/ https://en.wikipedia.org/wiki/ https://github.com/ https://www.youtube.com/watch?v= "
+        "https://www. .com/ .org/ .co.uk/ .html "
+        "📍 Lat: , Lon: https://maps.google.com/maps?q= "
+        "![image](https://i.ibb.co/.jpg) ![](https://i.imgur.com/.png) "
+        "TODO DONE #[[]] [[]] ** - "
+    ).encode('utf-8'),
+}
+
+
+def compress_text(text):
+    # Returns bytes if compressing was worth it, otherwise the text unchanged
+
+    data = text.encode('utf-8')
+    if not compression_enabled or len(data) < compression_threshold_bytes:
+        return text
+
+    compressor = zlib.compressobj(
+        compression_level, zlib.DEFLATED, -zlib.MAX_WBITS,
+        zdict=dictionaries[compression_dictionary_id]
+    )
+    compressed = (
+        compressed_marker + bytes([compression_dictionary_id]) + compressor.compress(data) + compressor.flush()
+    )
+
+    if len(compressed) >= len(data):
+        return text
+
+    instrumentation.increment('compression_bytes_saved', len(data) - len(compressed))
+    return compressed
+
+
+def decompress_text(value):
+    # Anything that isn't compressed comes back untouched, including bytes written by another layer (eg encryption)
+    if isinstance(value, str):
+        return value
+
+    value = bytes(value)
+    if value[:1] != compressed_marker:
+        return value
+
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=dictionaries[value[1]])
+    return (decompressor.decompress(value[2:]) + decompressor.flush()).decode('utf-8')
+
+
+class CompressedText(TypeDecorator):
+    # A String column that transparently compresses long values - SQLite is happy to keep bytes in a text column,
+    # so switching a column to this type doesn't need a migration
+
+    impl = String
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        # Bytes have already been encoded by another layer (eg encryption) so are stored as they are
+        if value is None or isinstance(value, bytes):
+            return value
+        return compress_text(value)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        return decompress_text(value)
@@ -0,0 +1,85 @@
+# This library holds the demo responses for the plugin, returned when it polls with one of the demo tokens below
+# instead of a real user token - plugin developers point their tests at these, so each token covers a kind of message
+# the plugin has to handle
+# The responses never change, so each one is serialised once when the server starts and served as the same bytes
+# every time, without touching the database, shared state or the network (demo tokens aren't rate limited, and don't
+# get the plugin version check - dummy_new_version shows what the out of date notice looks like instead)
+# The set of tokens is fixed, so the memory they take is too
+
+import json
+from datetime import datetime
+
+from . import message_string
+from . import location_pin, google_maps_base_url
+from . import digest
+from . import json_provider
+from . import instrumentation
+
+# Demo settings
+demo_timestamp = json_provider.format_http_date(datetime(2023, 1, 1, 12, 0, 0))
+sad_cat_caption = "sad cat"
+sad_cat_url = "https://media.giphy.com/media/71PLYtZUiPRg4/giphy.gif"
+
+
+def demo_message(message_id, contents):
+    return {
+        'id': message_id,
+        'provider': 'telegram',
+        'provider_message_id': 'abcdefg',
+        'contents': contents,
+        'timestamp': demo_timestamp,
+        'delivered': True
+    }
+
+
+text_messages = [demo_message(4242, f"This is dummy message {a}") for a in range(1, 5)]
+image_messages = [demo_message(4243, f"{sad_cat_caption} ![{sad_cat_caption}]({sad_cat_url})")]
+multiline_messages = [demo_message(4244, "This is a dummy message\nthat goes over\nseveral lines")]
+location_messages = [
+    demo_message(4245, f"{location_pin} Trafalgar Square (51.508, -0.128) {google_maps_base_url}51.508,-0.128")
+]
+task_messages = [demo_message(4246, "TODO reply to the dummy messages")]
+digest_messages = [
+    demo_message(4247, digest.compose_digest_contents(["Buy milk", "Call Sam", "Water the plants"]))
+]
+new_version_messages = [{'contents': message_string['new_version_available']}]
+
+demo_messages = {
+    # The original demo token, which plugin tests already use
+    'dummy': text_messages + image_messages,
+    'dummy_empty': [],
+    'dummy_text': text_messages,
+    'dummy_multiline': multiline_messages,
+    'dummy_image': image_messages,
+    'dummy_location': location_messages,
+    'dummy_task': task_messages,
+    'dummy_digest': digest_messages,
+    'dummy_new_version': text_messages[:1] + new_version_messages,
+    'dummy_all': (
+        text_messages + multiline_messages + image_messages + location_messages + task_messages + digest_messages
+    ),
+}
+
+
+def serialise_demo_response(messages):
+    return json.dumps({
+        'status': 'success',
+        'messages': {
+            'count': len(messages),
+            'contents': messages
+        }
+    }, ensure_ascii=False, separators=(",", ":")).encode('utf-8')
+
+
+demo_response_bodies = {
+    token: serialise_demo_response(messages) for token, messages in demo_messages.items()
+}
+
+
+def get_demo_response_body(user_id):
+    # Returns the serialised response for a demo token, or None if it isn't one
+
+    body = demo_response_bodies.get(user_id) if isinstance(user_id, str) else None
+    if body is not None:
+        instrumentation.increment('demo_responses_served')
+    return body
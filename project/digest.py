@@ -0,0 +1,132 @@
+# This library folds a user's short text notes into digests when they are delivered, for users who have turned on
+# digest mode with /digest on
+# Each run of consecutive plain notes becomes one Logseq block with a child bullet per note, so someone who sends
+# dozens of quick notes between syncs gets one block (and one JSON object) instead of dozens
+# Anything that wouldn't survive being a bullet (images, locations, tasks, multi line notes) is delivered on its own
+# as usual, and breaks the run, so the order notes arrive in is kept - an uncaptioned photo is stored as just the URL
+# of the uploaded image, so a note that is only an image URL counts as an image
+# The user's rows are streamed from the database a chunk at a time and folded as they are read, rather than loaded as
+# Message objects first
+
+import re
+from collections import namedtuple
+
+from sqlalchemy import select, update, delete
+
+from . import db
+from . import Message
+from . import message_string
+from . import location_pin
+from . import encryption
+
+# Digest settings
+digest_min_notes = 2  # a run shorter than this is delivered as separate notes
+digest_max_notes = 100  # longer runs are split into several digests
+digest_max_note_length = 500
+digest_read_chunk_size = 500
+digest_task_markers = ("TODO ", "DOING ", "NOW ", "LATER ", "WAITING ", "DONE ", "CANCELED ")
+
+# Every image storage backend gives back a URL ending in the image's extension
+bare_image_url_pattern = re.compile(r"^https?://\S+\.(jpg|jpeg|png|gif|webp)(\?\S*)?$", re.IGNORECASE)
+
+ClaimedRow = namedtuple('ClaimedRow', ['id', 'provider', 'provider_message_id', 'contents', 'timestamp'])
+
+
+def is_foldable(contents):
+    # Whether a note can become a child bullet of a digest without changing what it means in Logseq
+
+    return (
+        len(contents) <= digest_max_note_length
+        and "\n" not in contents
+        and not contents.startswith(location_pin)
+        and "![" not in contents
+        and not bare_image_url_pattern.match(contents)
+        and not contents.startswith(digest_task_markers)
+    )
+
+
+def row_to_message(row, contents=None):
+    # The same shape a Message is serialised in
+    return {
+        'id': row.id,
+        'provider': row.provider,
+        'provider_message_id': row.provider_message_id,
+        'contents': row.contents if contents is None else contents,
+        'timestamp': row.timestamp,
+        'delivered': True,
+    }
+
+
+def compose_digest_contents(notes):
+    return message_string['digest_header'].format(count=len(notes)) + "".join(f"\n- {note}" for note in notes)
+
+
+def fold_notes(rows):
+    # Yields messages to deliver from rows (which need id, provider, provider_message_id, contents and timestamp),
+    # with runs of foldable notes folded into a digest that takes the id and timestamp of its first note
+
+    run = []
+
+    def finish_run():
+        if len(run) >= digest_min_notes:
+            yield row_to_message(run[0], compose_digest_contents([row.contents for row in run]))
+        else:
+            yield from (row_to_message(row) for row in run)
+        run.clear()
+
+    for row in rows:
+        if row.contents is not None and is_foldable(row.contents):
+            run.append(row)
+            if len(run) >= digest_max_notes:
+                yield from finish_run()
+        else:
+            yield from finish_run()
+            yield row_to_message(row)
+
+    yield from finish_run()
+
+
+def decrypt_rows(user, rows):
+    # Encrypted contents are decrypted as each row is read (the user's key is only derived once, see encryption.py)
+    for row in rows:
+        if isinstance(row.contents, bytes):
+            row = ClaimedRow(
+                row.id, row.provider, row.provider_message_id,
+                encryption.decrypt_contents(user, row.contents), row.timestamp
+            )
+        yield row
+
+
+def claim_messages_as_digest(user, delete_delivered=True):
+    # Returns the user's undelivered messages folded into digests, and marks them delivered (and deletes them if
+    # delete_delivered is set) - only the rows we actually read are claimed, so a note that arrives meanwhile waits for
+    # the next poll
+
+    rows = db.session.execute(
+        select(Message.id, Message.provider, Message.provider_message_id, Message.contents, Message.timestamp)
+        .where(Message.user_id == user.id, Message.delivered == False)
+        .order_by(Message.id)
+        .execution_options(yield_per=digest_read_chunk_size)
+    )
+
+    claimed_ids = []
+
+    def remember_claimed(rows):
+        for row in rows:
+            claimed_ids.append(row.id)
+            yield row
+
+    messages = list(fold_notes(decrypt_rows(user, remember_claimed(rows))))
+
+    # Claimed a chunk at a time, to stay under SQLite's limit on the number of parameters in a statement
+    for start in range(0, len(claimed_ids), digest_read_chunk_size):
+        chunk_ids = claimed_ids[start:start + digest_read_chunk_size]
+        criteria = (Message.user_id == user.id, Message.id.in_(chunk_ids))
+        if delete_delivered:
+            statement = delete(Message).where(*criteria)
+        else:
+            statement = update(Message).where(*criteria).values(delivered=True)
+        db.session.execute(statement.execution_options(synchronize_session=False))
+    db.session.commit()
+
+    return messages
@@ -0,0 +1,177 @@
+# This library encrypts message contents at rest, so notes waiting for the plugin to collect them aren't sitting in
+# the database in plaintext
+# - each user has a random data key, and their messages are encrypted with it using AES-GCM
+# - the data key is stored on the user wrapped (encrypted) with a key derived from their token and the server's
+#   MESSAGE_ENCRYPTION_KEY, so a copy of the database on its own isn't enough to read anything
+# - a user is given a data key the first time one of their messages is encrypted, claimed with a conditional UPDATE
+#   so that when two workers do this at once they both end up using the one that was stored
+# - unwrapped data keys are cached for a few minutes, so a poll decrypts its whole batch with a single derivation
+# Contents are compressed (see compression.py) before they are encrypted, as ciphertext doesn't compress
+# Encryption is off unless MESSAGE_ENCRYPTION_KEY is set, and messages stored before it was turned on read back as is
+
+import os
+import logging
+import threading
+
+from cachetools import TTLCache
+from sqlalchemy import select, update
+from sqlalchemy.orm.attributes import set_committed_value
+
+from . import envars
+from . import compression
+from . import instrumentation
+
+# Encryption settings
+data_key_cache_size = 10_000
+data_key_cache_seconds = 600
+undecryptable_message_placeholder = "[LogLink could not decrypt this message]"
+
+encrypted_marker = b"E"
+envelope_version = 1
+nonce_length = 12
+key_derivation_salt = b"loglink-message-key"
+flag_compressed = 1
+
+_data_key_cache = TTLCache(maxsize=data_key_cache_size, ttl=data_key_cache_seconds)
+_data_key_cache_lock = threading.Lock()
+
+
+def is_encryption_enabled():
+    return bool(envars.message_encryption_key)
+
+
+def derive_key_encryption_key(token):
+    # HKDF is the right tool here as both inputs are already high entropy - nothing needs to be stretched
+
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+    instrumentation.increment('encryption_key_derivations')
+    return HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=key_derivation_salt,
+        info=token.encode('utf-8'),
+    ).derive(envars.message_encryption_key.encode('utf-8'))
+
+
+def wrap_data_key(key_cipher, data_key):
+    nonce = os.urandom(nonce_length)
+    return nonce + key_cipher.encrypt(nonce, data_key, None)
+
+
+def claim_message_key(user, key_cipher):
+    # Stores a new wrapped data key on the user unless someone else has stored one first, and returns whichever one
+    # the user ended up with (the caller needs to commit the user)
+    # The UPDATE only matches while the key is still empty, and SQLite makes a second writer wait for the first to
+    # commit, so it is never overwritten - the loser reads back the winner's key
+
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from . import db
+    from . import User
+
+    db.session.execute(
+        update(User)
+        .where(User.id == user.id, User.message_key.is_(None))
+        .values(message_key=wrap_data_key(key_cipher, AESGCM.generate_key(bit_length=256)))
+        .execution_options(synchronize_session=False)
+    )
+    message_key = db.session.execute(select(User.message_key).where(User.id == user.id)).scalar()
+
+    # Set as unchanged, as the UPDATE has already written it
+    set_committed_value(user, 'message_key', message_key)
+    return message_key
+
+
+def get_user_cipher(user):
+    # Returns an AES-GCM cipher using the user's data key, giving the user a data key first if they don't have one
+
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+    # The token and wrapped key are part of the cache key, so a token refresh can never use a stale key
+    cache_key = (user.id, user.token, user.message_key)
+    with _data_key_cache_lock:
+        cipher = _data_key_cache.get(cache_key)
+    if cipher is not None:
+        return cipher
+
+    key_cipher = AESGCM(derive_key_encryption_key(user.token))
+
+    if user.message_key is None:
+        claim_message_key(user, key_cipher)
+    data_key = key_cipher.decrypt(user.message_key[:nonce_length], user.message_key[nonce_length:], None)
+
+    cipher = AESGCM(data_key)
+    with _data_key_cache_lock:
+        _data_key_cache[(user.id, user.token, user.message_key)] = cipher
+    return cipher
+
+
+def clear_key_cache():
+    with _data_key_cache_lock:
+        _data_key_cache.clear()
+
+
+def encrypt_contents(user, contents):
+    # Returns what should be stored for these contents - the encrypted envelope, or the contents unchanged if
+    # encryption is off (in which case the column compresses them itself)
+
+    if not is_encryption_enabled() or contents is None:
+        return contents
+
+    payload = compression.compress_text(contents)
+    flags = 0
+    if isinstance(payload, bytes):
+        flags |= flag_compressed
+    else:
+        payload = payload.encode('utf-8')
+
+    nonce = os.urandom(nonce_length)
+    return (
+        encrypted_marker + bytes([envelope_version, flags]) + nonce
+        + get_user_cipher(user).encrypt(nonce, payload, None)
+    )
+
+
+def decrypt_contents(user, stored_contents, cipher=None):
+
+    if not isinstance(stored_contents, bytes) or stored_contents[:1] != encrypted_marker:
+        return stored_contents
+
+    flags = stored_contents[2]
+    nonce = stored_contents[3:3 + nonce_length]
+
+    try:
+        cipher = cipher or get_user_cipher(user)
+        payload = cipher.decrypt(nonce, stored_contents[3 + nonce_length:], None)
+    except Exception as e:
+        logging.error(f"Could not decrypt a message for user {user.id}: {e}")
+        instrumentation.increment('encryption_decrypt_failures')
+        return undecryptable_message_placeholder
+
+    if flags & flag_compressed:
+        return compression.decompress_text(payload)
+    return payload.decode('utf-8')
+
+
+def decrypt_messages(user, messages):
+    # Decrypts a batch of the user's messages in place, deriving their key at most once
+
+    if not any(isinstance(message.contents, bytes) for message in messages):
+        return messages
+
+    try:
+        cipher = get_user_cipher(user)
+    except Exception as e:
+        logging.error(f"Could not get the message key for user {user.id}: {e}")
+        cipher = None
+
+    for message in messages:
+        if cipher is None and isinstance(message.contents, bytes):
+            contents = undecryptable_message_placeholder
+        else:
+            contents = decrypt_contents(user, message.contents, cipher)
+        # Committed, so the ORM doesn't think the contents have changed and write the plaintext back
+        set_committed_value(message, 'contents', contents)
+
+    return messages
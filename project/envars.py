@@ -20,18 +20,45 @@ imgur_client_secret = os.environ.get("IMGUR_CLIENT_SECRET")
 # IMGbb credentials
 imgbb_api_key = os.environ.get("IMGBB_API_KEY")
 
+# S3-compatible image storage (optional)
+s3_endpoint_url = os.environ.get("S3_ENDPOINT_URL")
+s3_bucket = os.environ.get("S3_BUCKET")
+s3_access_key_id = os.environ.get("S3_ACCESS_KEY_ID")
+s3_secret_access_key = os.environ.get("S3_SECRET_ACCESS_KEY")
+s3_public_url = os.environ.get("S3_PUBLIC_URL")
+
+# Storing images on this server (optional, the public URL the images will be served from, eg https://loglink.it/images/
+# - leave it unset to keep images off this server)
+local_image_public_url = os.environ.get("LOCAL_IMAGE_PUBLIC_URL")
+
 # Telegram credentials
 telegram_bot_name = os.environ.get("TELEGRAM_BOT_NAME")
 telegram_token = os.environ.get("TELEGRAM_TOKEN")
 telegram_full_token = f"bot{telegram_token}"
 telegram_webhook_auth = os.environ.get("TELEGRAM_WEBHOOK_AUTH")
 
+# Message encryption at rest (optional, any long random string - keep it out of the database's backups)
+message_encryption_key = os.environ.get("MESSAGE_ENCRYPTION_KEY")
+
+# Offline reverse geocoding of shared locations (optional, the path to a gazetteer file - see geocoding.py)
+gazetteer_path = os.environ.get("GAZETTEER_PATH")
+
+# Database sharding (optional, the number of SQLite files users and messages are spread over)
+db_shard_count = int(os.environ.get("DB_SHARD_COUNT") or 1)
+
+# Per request profiling of SQL statements and outbound HTTP requests (optional, set to anything to turn it on)
+request_profiling = os.environ.get("REQUEST_PROFILING")
+
+# Redis (optional, used to share state between workers)
+redis_url = os.environ.get("REDIS_URL")
+
 # Sentry
 sentry_dsn = os.environ.get("SENTRY_DSN")
 
 # Admin password
 admin_username = os.environ.get("ADMIN_USERNAME")
 admin_password = os.environ.get("ADMIN_PASSWORD")
+admin_password_hash = os.environ.get("ADMIN_PASSWORD_HASH")  # optional, a werkzeug password hash used instead of ADMIN_PASSWORD
 
 # Email credentials
 email_setting_host = os.environ.get("EMAIL_SETTING_HOST")
@@ -0,0 +1,159 @@
+# This library turns the coordinates of a shared location into a place name, without calling out to any service
+# It is optional, and only used if GAZETTEER_PATH points at a gazetteer file, which can be either:
+# - a GeoNames dump (eg cities1000.txt from https://download.geonames.org/export/dump/), or
+# - a tab separated file of name, latitude, longitude and (optionally) country code, one place per line
+# The nearest place within reverse_geocode_max_distance_km is used, found through a grid of one degree cells
+# People share the same places (home, the office) again and again, so results are kept in an LRU keyed by the
+# coordinates rounded to reverse_geocode_precision decimal places (about 100m), and repeats cost a dictionary lookup
+
+import math
+import logging
+import threading
+
+from cachetools import LRUCache
+
+from . import envars
+from . import instrumentation
+
+# Geocoding settings
+gazetteer_path = envars.gazetteer_path
+reverse_geocode_precision = 3
+reverse_geocode_max_distance_km = 25
+reverse_geocode_cache_size = 10_000
+
+earth_radius_km = 6371
+
+_gazetteer = None  # (latitude cell, longitude cell) -> list of (latitude, longitude, place name)
+_gazetteer_lock = threading.Lock()
+_place_name_cache = LRUCache(maxsize=reverse_geocode_cache_size)
+_place_name_cache_lock = threading.Lock()
+
+
+def is_reverse_geocoding_enabled():
+    return bool(gazetteer_path)
+
+
+def get_cell(latitude, longitude):
+    return math.floor(latitude), math.floor(longitude)
+
+
+def parse_gazetteer_line(line):
+    # Returns (latitude, longitude, place name), or None if the line isn't a place
+
+    columns = line.rstrip("\n").split("\t")
+    if len(columns) >= 9:
+        # GeoNames: id, name, ascii name, alternate names, latitude, longitude, feature class, feature code, country
+        name, latitude, longitude, country = columns[1], columns[4], columns[5], columns[8]
+    elif len(columns) >= 3:
+        name, latitude, longitude = columns[:3]
+        country = columns[3] if len(columns) > 3 else None
+    else:
+        return None
+
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except ValueError:
+        return None
+
+    return latitude, longitude, f"{name}, {country}" if country else name
+
+
+def load_gazetteer(path=None):
+    # Reads the gazetteer into a grid of cells, returns the grid and the number of places loaded
+
+    path = path or gazetteer_path
+    gazetteer = {}
+    places_loaded = 0
+
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            place = parse_gazetteer_line(line)
+            if place:
+                gazetteer.setdefault(get_cell(place[0], place[1]), []).append(place)
+                places_loaded += 1
+
+    logging.info(f"Loaded {places_loaded} places from the gazetteer {path}")
+    return gazetteer, places_loaded
+
+
+def get_gazetteer():
+    # The gazetteer is only loaded the first time we need it, as it can be large
+
+    global _gazetteer
+
+    if _gazetteer is None:
+        with _gazetteer_lock:
+            if _gazetteer is None:
+                try:
+                    _gazetteer = load_gazetteer()[0]
+                except OSError as e:
+                    logging.error(f"Could not load the gazetteer {gazetteer_path}: {e}")
+                    _gazetteer = {}
+    return _gazetteer
+
+
+def distance_km(latitude_1, longitude_1, latitude_2, longitude_2):
+    # Haversine distance
+
+    latitude_1, longitude_1, latitude_2, longitude_2 = map(math.radians, (latitude_1, longitude_1, latitude_2, longitude_2))
+    a = (
+        math.sin((latitude_2 - latitude_1) / 2) ** 2
+        + math.cos(latitude_1) * math.cos(latitude_2) * math.sin((longitude_2 - longitude_1) / 2) ** 2
+    )
+    return 2 * earth_radius_km * math.asin(math.sqrt(a))
+
+
+def find_nearest_place(latitude, longitude):
+    # Looks through the cell the coordinates are in and the eight around it
+
+    gazetteer = get_gazetteer()
+    latitude_cell, longitude_cell = get_cell(latitude, longitude)
+
+    nearest_place = None
+    nearest_distance = reverse_geocode_max_distance_km
+    for latitude_offset in (-1, 0, 1):
+        for longitude_offset in (-1, 0, 1):
+            # Longitude cells wrap around at the antimeridian
+            cell = (latitude_cell + latitude_offset, (longitude_cell + longitude_offset + 180) % 360 - 180)
+            for place_latitude, place_longitude, place_name in gazetteer.get(cell, ()):
+                distance = distance_km(latitude, longitude, place_latitude, place_longitude)
+                if distance <= nearest_distance:
+                    nearest_place, nearest_distance = place_name, distance
+
+    return nearest_place
+
+
+def reverse_geocode(latitude, longitude):
+    # Returns the name of the nearest place, or None if there isn't one nearby (or geocoding is off)
+
+    if not is_reverse_geocoding_enabled():
+        return None
+
+    try:
+        latitude, longitude = float(latitude), float(longitude)
+    except (TypeError, ValueError):
+        return None
+
+    cache_key = (round(latitude, reverse_geocode_precision), round(longitude, reverse_geocode_precision))
+    with _place_name_cache_lock:
+        if cache_key in _place_name_cache:
+            instrumentation.increment('reverse_geocode_cache_hits')
+            return _place_name_cache[cache_key]
+
+    instrumentation.increment('reverse_geocode_cache_misses')
+    place_name = find_nearest_place(*cache_key)
+
+    with _place_name_cache_lock:
+        _place_name_cache[cache_key] = place_name
+    return place_name
+
+
+def reset():
+    # Forgets the gazetteer and cached place names, eg after changing gazetteer_path
+
+    global _gazetteer
+
+    with _gazetteer_lock:
+        _gazetteer = None
+    with _place_name_cache_lock:
+        _place_name_cache.clear()
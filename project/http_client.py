@@ -0,0 +1,264 @@
+# This library is the single way the server talks to the outside world (Telegram, imgbb, Github etc)
+# It keeps a pooled session per host, applies default timeouts, retries idempotent calls with jittered backoff
+# and has a circuit breaker per upstream so one slow service can't hang every worker
+# Requests made by handlers asgi.py is running on its event loop (see async_bridge) are sent with httpx instead, so
+# they wait without holding a thread - callers get a requests Response (and requests exceptions) either way
+
+import time
+import random
+import asyncio
+import logging
+import threading
+import weakref
+from datetime import timedelta
+from urllib.parse import urlsplit
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from . import request_profiler
+from . import async_bridge
+
+# Client settings
+default_timeout = (3.05, 10)  # (connect, read) in seconds
+pool_size = 10
+max_retries = 3
+backoff_base_seconds = 0.5
+backoff_max_seconds = 8
+retry_status_codes = [429, 500, 502, 503, 504]
+idempotent_methods = ['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE']
+async_max_connections = 100  # for each event loop's httpx client, across every host
+
+# Circuit breaker settings
+circuit_breaker_failure_threshold = 5
+circuit_breaker_reset_seconds = 30
+
+_lock = threading.Lock()
+_sessions = {}
+_circuit_breakers = {}
+_async_clients = weakref.WeakKeyDictionary()  # event loop -> httpx client
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    # Raised instead of making a request when the upstream has failed too often recently
+    pass
+
+
+class CircuitBreaker:
+    # Tracks consecutive failures for one upstream host
+    # After too many failures the circuit "opens" and requests fail fast until the reset period has passed,
+    # at which point a single trial request is let through to see if the upstream has recovered
+
+    def __init__(
+            self,
+            failure_threshold=None,
+            reset_seconds=None,
+    ):
+        self.failure_threshold = failure_threshold or circuit_breaker_failure_threshold
+        self.reset_seconds = reset_seconds or circuit_breaker_reset_seconds
+        self.failure_count = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_seconds:
+            return "half_open"
+        return "open"
+
+    def allow_request(self):
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open":
+                # Let one request through and hold the circuit open for everyone else while it runs
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failure_count = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failure_count += 1
+            if self.failure_count >= self.failure_threshold:
+                if self.opened_at is None:
+                    logging.error(f"Circuit breaker opened after {self.failure_count} failures")
+                self.opened_at = time.monotonic()
+
+
+def get_host(url):
+    return urlsplit(url).netloc
+
+
+def get_session(host):
+    # Returns the pooled session for this host, creating it the first time it is needed
+
+    with _lock:
+        session = _sessions.get(host)
+        if not session:
+            session = requests.Session()
+            session.hooks['response'].append(request_profiler.record_http_response)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[host] = session
+        return session
+
+
+def get_async_client():
+    # An httpx client holds connections for the event loop it was first used on, so each loop gets its own
+
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=async_max_connections),
+            follow_redirects=True,
+        )
+        _async_clients[loop] = client
+    return client
+
+
+async def close_async_client():
+    # Called by asgi.py as the server shuts down
+
+    client = _async_clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+def get_circuit_breaker(host):
+    with _lock:
+        circuit_breaker = _circuit_breakers.get(host)
+        if not circuit_breaker:
+            circuit_breaker = CircuitBreaker()
+            _circuit_breakers[host] = circuit_breaker
+        return circuit_breaker
+
+
+def backoff_delay(attempt, response=None):
+    # Full jitter exponential backoff, but respect Retry-After if the upstream sent one
+
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after and retry_after.isdigit():
+            return min(int(retry_after), backoff_max_seconds)
+
+    return random.uniform(0, min(backoff_max_seconds, backoff_base_seconds * (2 ** attempt)))
+
+
+def as_requests_response(httpx_response, elapsed):
+    # So callers don't need to know which client made the request
+
+    response = requests.Response()
+    response.status_code = httpx_response.status_code
+    response.reason = httpx_response.reason_phrase
+    response.headers = CaseInsensitiveDict(httpx_response.headers)
+    response.url = str(httpx_response.url)
+    response.encoding = httpx_response.encoding
+    response.elapsed = timedelta(seconds=elapsed)
+    response._content = httpx_response.content
+    return response
+
+
+async def send_async(method, url, timeout, **kwargs):
+    if isinstance(timeout, tuple):
+        connect_timeout, read_timeout = timeout
+    else:
+        connect_timeout = read_timeout = timeout
+
+    started = time.monotonic()
+    try:
+        httpx_response = await get_async_client().request(
+            method,
+            url,
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            **kwargs
+        )
+    except httpx.TimeoutException as e:
+        raise requests.exceptions.Timeout(e)
+    except httpx.TransportError as e:
+        raise requests.exceptions.ConnectionError(e)
+    except httpx.RequestError as e:
+        raise requests.exceptions.RequestException(e)
+
+    response = as_requests_response(httpx_response, time.monotonic() - started)
+    request_profiler.record_http_response(response)
+    return response
+
+
+def send(session, method, url, timeout, **kwargs):
+    # Makes one attempt at a request, through httpx if we are on asgi.py's event loop
+
+    if async_bridge.is_active():
+        return async_bridge.wait(send_async(method, url, timeout, **kwargs))
+    return session.request(method, url, timeout=timeout, **kwargs)
+
+
+def request(
+        method,
+        url,
+        retry=None,
+        timeout=None,
+        **kwargs
+):
+    # Make a request through the pooled session for the host
+    # Idempotent methods are retried by default, anything else is only retried if retry=True is passed
+
+    method = method.upper()
+    if retry is None:
+        retry = method in idempotent_methods
+    if timeout is None:
+        timeout = default_timeout
+
+    host = get_host(url)
+    session = get_session(host)
+    circuit_breaker = get_circuit_breaker(host)
+
+    attempts = max_retries + 1 if retry else 1
+
+    for attempt in range(attempts):
+        if not circuit_breaker.allow_request():
+            logging.warning(f"Circuit breaker is open for {host}, not making request")
+            raise CircuitOpenError(f"Circuit breaker is open for {host}")
+
+        is_last_attempt = attempt == attempts - 1
+
+        try:
+            response = send(session, method, url, timeout, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            circuit_breaker.record_failure()
+            if is_last_attempt:
+                raise
+            logging.warning(f"{method} {host} failed ({e}), retrying")
+            async_bridge.sleep(backoff_delay(attempt))
+            continue
+
+        if response.status_code >= 500:
+            circuit_breaker.record_failure()
+        else:
+            circuit_breaker.record_success()
+
+        if response.status_code in retry_status_codes and not is_last_attempt:
+            logging.warning(f"{method} {host} returned {response.status_code}, retrying")
+            async_bridge.sleep(backoff_delay(attempt, response))
+            continue
+
+        return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
@@ -0,0 +1,118 @@
+# This library decides which of the photo sizes Telegram offers we download, and optionally shrinks it before upload
+
+import os
+import logging
+
+from . import instrumentation
+
+# Policy settings
+# "largest" always takes the biggest size Telegram offers (the original behaviour)
+# "target_width" takes the smallest size that is at least image_target_width pixels wide
+image_selection_policy = "target_width"
+image_target_width = 1280
+
+# If Pillow is installed (it is in requirements.txt), downscale anything wider than image_target_width and re-encode it
+# as a JPEG
+image_reencode = True
+image_reencode_quality = 85
+
+valid_selection_policies = [
+    "largest",
+    "target_width",
+]
+
+
+def get_image_library():
+    # If Pillow isn't installed we just skip the re-encoding step, but log it so a missing install is noticed
+    # It is only imported the first time we need it, as it is slow to import
+    try:
+        from PIL import Image
+    except ImportError:
+        logging.warning("Pillow is not installed, so images are uploaded without being re-encoded")
+        return None
+    return Image
+
+
+def choose_photo_size(
+        photo_sizes,
+        policy=None,
+        target_width=None,
+):
+    # Telegram sends a list of sizes for each photo, smallest first, which telegram_updates parses into PhotoSizes
+    # This picks the one we should download according to the policy
+
+    if not photo_sizes:
+        return None
+
+    if not policy:
+        policy = image_selection_policy
+    if not target_width:
+        target_width = image_target_width
+
+    if policy not in valid_selection_policies:
+        logging.error(f"Image selection policy {policy} not recognised, using largest")
+        policy = "largest"
+
+    photo_sizes = sorted(photo_sizes, key=lambda size: size.width)
+    largest = photo_sizes[-1]
+    chosen = largest
+
+    if policy == "target_width":
+        for size in photo_sizes:
+            if size.width >= target_width:
+                chosen = size
+                break
+
+    # Record how much we saved by not downloading the largest size (what re-encoding saves is counted separately)
+    if chosen.file_size and largest.file_size:
+        instrumentation.increment('image_policy_bytes_saved_by_size', largest.file_size - chosen.file_size)
+    instrumentation.increment('image_policy_photos_chosen')
+
+    return chosen
+
+
+def reencode_image(
+        image_path,
+        target_width=None,
+        quality=None,
+):
+    # Downscales and re-encodes the image in place if that makes it smaller, returns the number of bytes saved
+
+    if not image_reencode:
+        return 0
+
+    Image = get_image_library()
+    if Image is None:
+        return 0
+
+    if not target_width:
+        target_width = image_target_width
+    if not quality:
+        quality = image_reencode_quality
+
+    original_size = os.path.getsize(image_path)
+    temporary_path = f"{image_path}.reencoded"
+
+    try:
+        with Image.open(image_path) as image:
+            if image.width > target_width:
+                target_height = round(image.height * target_width / image.width)
+                image = image.resize((target_width, target_height))
+            image.convert('RGB').save(temporary_path, 'JPEG', quality=quality, optimize=True)
+    except Exception as e:
+        logging.error(f"Error re-encoding image {image_path}: {e}")
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        return 0
+
+    new_size = os.path.getsize(temporary_path)
+    if new_size >= original_size:
+        # Re-encoding didn't help so keep the original
+        os.remove(temporary_path)
+        return 0
+
+    os.replace(temporary_path, image_path)
+    bytes_saved = original_size - new_size
+    instrumentation.increment('image_policy_bytes_saved_by_reencoding', bytes_saved)
+    logging.info(f"Re-encoded {image_path}, saved {bytes_saved} bytes")
+    return bytes_saved
@@ -0,0 +1,447 @@
+# This library is where images sent to LogLink end up
+# Each backend knows whether a user can use it and how to upload to it, and returns a public URL for the image
+# - imgbb: the original backend, usually with the user's own API key
+# - imgur: uses the server's imgur client id
+# - local: a content-addressed store on this server, served from /images/ with long-lived cache headers - only
+#   available if the deployment opts in by setting LOCAL_IMAGE_PUBLIC_URL
+# - s3: a content-addressed store in any S3-compatible bucket (eg MinIO), needs boto3 to be installed
+# The deployment picks a default backend and users can pick another one with the /storage command
+# If that backend fails or is slow, upload_image falls back to (or hedges with) any fallbacks the deployment lists
+
+import os
+import re
+import shutil
+import hashlib
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED
+
+from flask import send_from_directory
+
+from . import envars
+from . import routes
+from . import instrumentation
+from . import lifecycle
+from . import async_bridge
+from . import imgbb
+from . import imgur
+from . import require_user_to_have_own_cloud_account
+
+# Image storage settings
+default_backend = "imgbb"
+user_selectable_backends = ["imgbb", "local"] if envars.local_image_public_url else ["imgbb"]
+
+# If the user's backend fails or is too slow we try these in order, skipping any the user can't use
+# A deployment that wants images kept on this server or in S3 when imgbb is down adds "local" or "s3" here
+upload_fallback_backends = [default_backend]
+
+# "failover", "hedge" or "race" - see upload_image
+# Hedging and racing upload the same image more than once, so only make sense with fallbacks worth the extra uploads
+upload_strategy = "failover"
+valid_upload_strategies = ["failover", "hedge", "race"]
+hedge_after_seconds = 5
+upload_max_workers = 8
+
+# How long we wait for each backend before giving up on it
+upload_deadline_seconds = {
+    'imgbb': 30,
+    'imgur': 30,
+    's3': 30,
+    'local': 5,
+}
+default_upload_deadline_seconds = 30
+
+# A backend whose smoothed upload time is above slow_backend_seconds is tried after the others
+slow_backend_seconds = 10
+slow_backend_retry_seconds = 300
+latency_smoothing = 0.2
+
+# Content-addressed files never change, so they can be cached forever
+long_cache_control = "public, max-age=31536000, immutable"
+
+local_store_folder = "image_store"
+local_public_url = envars.local_image_public_url
+
+# Local images are served as immutable and their URLs live on in users' notes, so they are never deleted - instead,
+# once the store reaches local_image_store_max_bytes new images are refused and go to the user's other backends
+local_image_store_max_bytes = 2_000_000_000
+local_store_size_refresh_seconds = 300  # how often the store's size is measured from disk, it is kept up to date in between
+
+content_addressed_name_pattern = re.compile(r"^[0-9a-f]{64}\.(jpg|jpeg|png|gif|webp)$")
+
+content_types = {
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+}
+
+
+def content_address(image_path):
+    # Returns the name an image is stored under: the sha256 of its contents plus its extension
+
+    sha256 = hashlib.sha256()
+    with open(image_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha256.update(chunk)
+
+    extension = os.path.splitext(image_path)[1].lstrip('.').lower()
+    if extension not in content_types:
+        extension = 'jpg'
+
+    return f"{sha256.hexdigest()}.{extension}"
+
+
+class ImageStorageBackend:
+    name = None
+
+    def is_available_for_user(self, user):
+        return True
+
+    def upload(self, image_path, user=None):
+        # Returns the public URL of the uploaded image, or False if it failed
+        raise NotImplementedError
+
+
+class ImgbbBackend(ImageStorageBackend):
+    name = "imgbb"
+
+    def is_available_for_user(self, user):
+        if user is not None and user.imgbb_api_key:
+            return True
+        return not require_user_to_have_own_cloud_account and bool(envars.imgbb_api_key)
+
+    def upload(self, image_path, user=None):
+        imgbb_api_key = user.imgbb_api_key if user is not None else None
+
+        if require_user_to_have_own_cloud_account and not imgbb_api_key:
+            logging.error("No imgbb API key provided when one was required")
+            return False
+
+        return imgbb.upload_image(image_path, user_api_token=imgbb_api_key)
+
+
+class ImgurBackend(ImageStorageBackend):
+    name = "imgur"
+
+    def is_available_for_user(self, user):
+        return bool(envars.imgur_client_id)
+
+    def upload(self, image_path, user=None):
+        return imgur.upload_image(image_path, delete_after_upload=False)
+
+
+class LocalBackend(ImageStorageBackend):
+    name = "local"
+
+    def is_available_for_user(self, user):
+        return bool(local_public_url)
+
+    def upload(self, image_path, user=None):
+        if not local_public_url:
+            logging.error("Local image storage is not turned on for this deployment")
+            return False
+
+        image_name = content_address(image_path)
+        destination = local_image_path(image_name)
+
+        # If we already have this exact image there is nothing to do
+        if not os.path.exists(destination):
+            image_bytes = os.path.getsize(image_path)
+            if get_local_store_bytes() + image_bytes > local_image_store_max_bytes:
+                logging.warning("The local image store is full, so the image will go to another backend")
+                instrumentation.increment('image_upload_local_store_full')
+                return False
+
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            temporary_path = f"{destination}.tmp"
+            try:
+                shutil.copyfile(image_path, temporary_path)
+                os.replace(temporary_path, destination)
+            except OSError as e:
+                logging.error(f"Error storing image locally: {e}")
+                return False
+            add_local_store_bytes(image_bytes)
+
+        return f"{local_public_url.rstrip('/')}/{image_name}"
+
+
+class S3Backend(ImageStorageBackend):
+    name = "s3"
+
+    def __init__(self):
+        self._client = None
+
+    def get_client(self):
+        # boto3 is optional and only imported the first time we use this backend
+        if self._client is None:
+            import boto3
+
+            self._client = boto3.client(
+                's3',
+                endpoint_url=envars.s3_endpoint_url,
+                aws_access_key_id=envars.s3_access_key_id,
+                aws_secret_access_key=envars.s3_secret_access_key,
+            )
+        return self._client
+
+    def is_available_for_user(self, user):
+        return bool(envars.s3_bucket and envars.s3_public_url)
+
+    def upload(self, image_path, user=None):
+        image_name = content_address(image_path)
+        extension = image_name.split('.')[-1]
+
+        try:
+            client = self.get_client()
+            try:
+                # If we already have this exact image there is nothing to do
+                client.head_object(Bucket=envars.s3_bucket, Key=image_name)
+            except client.exceptions.ClientError:
+                client.upload_file(
+                    image_path,
+                    envars.s3_bucket,
+                    image_name,
+                    ExtraArgs={
+                        'ContentType': content_types[extension],
+                        'CacheControl': long_cache_control,
+                    }
+                )
+        except Exception as e:
+            logging.error(f"Error uploading image to S3: {e}")
+            return False
+
+        return f"{envars.s3_public_url.rstrip('/')}/{image_name}"
+
+
+backends = {
+    backend.name: backend for backend in [
+        ImgbbBackend(),
+        ImgurBackend(),
+        LocalBackend(),
+        S3Backend(),
+    ]
+}
+
+
+def local_image_path(image_name):
+    # Images are spread over subfolders by the first two characters of their hash so no folder gets too big
+    return os.path.join(local_store_folder, image_name[:2], image_name)
+
+
+_local_store_bytes = None
+_local_store_measured = 0
+_local_store_lock = threading.Lock()
+
+
+def measure_local_store_bytes():
+    total_bytes = 0
+    for folder_path, folder_names, file_names in os.walk(local_store_folder):
+        for file_name in file_names:
+            try:
+                total_bytes += os.path.getsize(os.path.join(folder_path, file_name))
+            except OSError:
+                continue
+    return total_bytes
+
+
+def get_local_store_bytes():
+    # Measured from disk now and then, as other workers store images too
+
+    global _local_store_bytes, _local_store_measured
+
+    with _local_store_lock:
+        if _local_store_bytes is None or time.monotonic() - _local_store_measured > local_store_size_refresh_seconds:
+            _local_store_bytes = measure_local_store_bytes()
+            _local_store_measured = time.monotonic()
+        return _local_store_bytes
+
+
+def add_local_store_bytes(image_bytes):
+    global _local_store_bytes
+
+    with _local_store_lock:
+        if _local_store_bytes is not None:
+            _local_store_bytes += image_bytes
+
+
+def get_backend_for_user(user=None):
+    backend_name = default_backend
+    if user is not None and user.image_storage_backend in backends:
+        backend_name = user.image_storage_backend
+    return backends[backend_name]
+
+
+def is_user_able_to_upload(user):
+    return get_backend_for_user(user).is_available_for_user(user)
+
+
+class BackendLatencyTracker:
+    # Keeps a smoothed upload time per backend so slow or failing backends can be tried last
+    # A failed or timed out upload counts as taking the whole deadline
+
+    def __init__(self):
+        self.latencies = {}  # backend name -> (smoothed seconds, last updated)
+        self._lock = threading.Lock()
+
+    def record(self, backend_name, seconds):
+        now = time.monotonic()
+        with self._lock:
+            smoothed, last_updated = self.latencies.get(backend_name, (seconds, now))
+            smoothed += latency_smoothing * (seconds - smoothed)
+            self.latencies[backend_name] = (smoothed, now)
+
+    def is_slow(self, backend_name):
+        # Slow backends get another chance once slow_backend_retry_seconds have passed without hearing from them
+        with self._lock:
+            smoothed, last_updated = self.latencies.get(backend_name, (0, 0))
+        return smoothed > slow_backend_seconds and time.monotonic() - last_updated < slow_backend_retry_seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {backend_name: smoothed for backend_name, (smoothed, last_updated) in self.latencies.items()}
+
+
+backend_latency_tracker = BackendLatencyTracker()
+
+# Uploads run on these threads so that we can stop waiting for a slow backend and try another (or as tasks on the
+# event loop, for a handler asgi.py is running - see async_bridge)
+_upload_executor = ThreadPoolExecutor(max_workers=upload_max_workers, thread_name_prefix="image_upload")
+
+
+def run_upload(backend, image_path, user):
+    # Marked as in flight, so a stopping worker waits for it - even if the request has stopped waiting for it
+    with lifecycle.in_flight('image_upload'):
+        return backend.upload(image_path, user=user)
+
+
+@lifecycle.on_worker_stop
+def stop_upload_executor():
+    # Runs once the uploads in flight have finished (or run out of time), so this only drops ones that never started
+    _upload_executor.shutdown(wait=False, cancel_futures=True)
+
+
+def get_upload_deadline(backend_name):
+    return upload_deadline_seconds.get(backend_name, default_upload_deadline_seconds)
+
+
+def get_upload_candidates(user=None):
+    # The user's backend first, then any fallbacks they are able to use, with slow backends moved to the back
+
+    preferred_backend = get_backend_for_user(user)
+    backend_names = [preferred_backend.name] + [
+        backend_name for backend_name in upload_fallback_backends if backend_name != preferred_backend.name
+    ]
+
+    candidates = [
+        backends[backend_name] for backend_name in backend_names
+        if backend_name in backends and backends[backend_name].is_available_for_user(user)
+    ]
+
+    # sorted() is stable, so otherwise the preferred order is kept
+    return sorted(candidates, key=lambda backend: backend_latency_tracker.is_slow(backend.name))
+
+
+def upload_image(image_path, user=None):
+    # Uploads the image and returns its public URL, or False if every backend failed
+    # - failover: try each backend in turn, giving each one until its deadline
+    # - hedge: as failover, but if a backend hasn't answered after hedge_after_seconds start the next one as well
+    # - race: start every backend at once
+    # Whichever succeeds first wins; uploads we stop waiting for finish in the background and are ignored
+
+    candidates = get_upload_candidates(user)
+    if not candidates:
+        logging.error("No image storage backend is available for this user")
+        return False
+
+    if upload_strategy not in valid_upload_strategies:
+        logging.error(f"Upload strategy {upload_strategy} not recognised, using failover")
+
+    pending = {}  # future -> (backend, started)
+    last_started = None
+
+    def start_next_upload():
+        nonlocal last_started
+        backend = candidates.pop(0)
+        last_started = time.monotonic()
+        pending[async_bridge.submit(_upload_executor, run_upload, backend, image_path, user)] = (backend, last_started)
+
+    start_next_upload()
+    while upload_strategy == "race" and candidates:
+        start_next_upload()
+
+    while pending:
+        now = time.monotonic()
+
+        # Wake up when the next pending upload hits its deadline, or when it's time to hedge
+        wake_at = min(started + get_upload_deadline(backend.name) for backend, started in pending.values())
+        if upload_strategy == "hedge" and candidates:
+            wake_at = min(wake_at, last_started + hedge_after_seconds)
+
+        done, not_done = async_bridge.wait_for_futures(pending, timeout=max(0, wake_at - now), return_when=FIRST_COMPLETED)
+
+        for future in done:
+            backend, started = pending.pop(future)
+            upload_seconds = time.monotonic() - started
+            try:
+                image_url = future.result()
+            except Exception as e:
+                logging.error(f"Error uploading image to {backend.name}: {e}")
+                image_url = False
+
+            instrumentation.record_timing(f"image_upload_{backend.name}", upload_seconds)
+            if image_url:
+                backend_latency_tracker.record(backend.name, upload_seconds)
+                return image_url
+
+            logging.warning(f"Image upload to {backend.name} failed")
+            instrumentation.increment(f"image_upload_failures_{backend.name}")
+            backend_latency_tracker.record(backend.name, get_upload_deadline(backend.name))
+
+        # Give up on anything that has run past its deadline
+        now = time.monotonic()
+        for future, (backend, started) in list(pending.items()):
+            if now - started >= get_upload_deadline(backend.name):
+                del pending[future]
+                logging.warning(f"Image upload to {backend.name} missed its deadline")
+                instrumentation.increment(f"image_upload_deadlines_missed_{backend.name}")
+                backend_latency_tracker.record(backend.name, get_upload_deadline(backend.name))
+
+        if candidates and (
+                not pending or (upload_strategy == "hedge" and now - last_started >= hedge_after_seconds)
+        ):
+            if pending:
+                instrumentation.increment('image_upload_hedges')
+            start_next_upload()
+
+    logging.error("Image upload failed on every backend")
+    return False
+
+
+@routes.get('/images/<image_name>')
+def serve_local_image(image_name):
+    # Serves images from the local backend, which never change once stored
+
+    if not content_addressed_name_pattern.match(image_name):
+        return {
+            'status': 'error',
+            'message': 'Image not found'
+        }, 404
+
+    image_path = local_image_path(image_name)
+    if not os.path.exists(image_path):
+        return {
+            'status': 'error',
+            'message': 'Image not found'
+        }, 404
+
+    response = send_from_directory(
+        os.path.abspath(os.path.dirname(image_path)),
+        image_name,
+        mimetype=content_types[image_name.split('.')[-1]],
+        max_age=31536000,
+    )
+    response.headers['Cache-Control'] = long_cache_control
+    return response
@@ -1,4 +1,5 @@
 from . import envars
+from . import http_client
 import requests
 import logging
 
@@ -22,12 +23,17 @@ def upload_image(
     if expiration:
         payload['expiration'] = expiration
 
-    with open(image_path, 'rb') as f:
-        response = requests.post(
-            api_url,
-            files={'image': f},
-            params=payload
-        )
+    try:
+        with open(image_path, 'rb') as f:
+            response = http_client.post(
+                api_url,
+                files={'image': f},
+                params=payload,
+                timeout=(3.05, 30)
+            )
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Error uploading image to imgbb: {e}")
+        return False
 
     if response.status_code != 200:
         return False
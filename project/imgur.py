@@ -1,14 +1,22 @@
 import os
 import logging
-from imgur_python import Imgur
 from . import envars
 
-imgur_client = Imgur({'client_id': envars.imgur_client_id})
+_imgur_client = None
+
+
+def get_imgur_client():
+	# The client is only created the first time we upload
+	global _imgur_client
+	if _imgur_client is None:
+		from imgur_python import Imgur
+		_imgur_client = Imgur({'client_id': envars.imgur_client_id})
+	return _imgur_client
 
 
 def upload_image(image_path, delete_after_upload=True):
 	try:
-		image = imgur_client.image_upload(image_path, 'Untitled', 'An upload from LogLink')
+		image = get_imgur_client().image_upload(image_path, 'Untitled', 'An upload from LogLink')
 		image_id = image['response']['data']['id']
 	except Exception as e:
 		logging.error("Error uploading to imgur", str(e))
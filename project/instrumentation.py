@@ -0,0 +1,53 @@
+# This library keeps simple in-process counters and timings so we can see what the server is doing
+# (eg how many bytes were saved by the image policy, or how long uploads take)
+
+import threading
+
+_lock = threading.Lock()
+
+counters = {}
+timings = {}
+
+
+def increment(name, amount=1):
+    # Add to a named counter, creating it if it doesn't exist yet
+
+    with _lock:
+        counters[name] = counters.get(name, 0) + amount
+
+
+def record_timing(name, seconds):
+    # Record how long something took, keeping the count, total and slowest time seen
+
+    with _lock:
+        timing = timings.setdefault(name, {
+            'count': 0,
+            'total_seconds': 0.0,
+            'max_seconds': 0.0,
+        })
+        timing['count'] += 1
+        timing['total_seconds'] += seconds
+        if seconds > timing['max_seconds']:
+            timing['max_seconds'] = seconds
+
+
+def snapshot():
+    # Returns a copy of the counters and timings that is safe to serialise as JSON
+
+    with _lock:
+        timings_copy = {}
+        for name, timing in timings.items():
+            timings_copy[name] = dict(timing)
+            timings_copy[name]['average_seconds'] = timing['total_seconds'] / timing['count']
+        return {
+            'counters': dict(counters),
+            'timings': timings_copy,
+        }
+
+
+def reset():
+    # Clear everything (mostly useful for testing)
+
+    with _lock:
+        counters.clear()
+        timings.clear()
@@ -0,0 +1,219 @@
+# The janitor runs in the background and cleans up things that nothing else ever removes:
+# - media files left in media_uploads once they have been uploaded to the cloud
+# - delivered messages (only purged per user during a poll, and never if delete_immediately is off)
+# - undelivered messages older than the retention period, eg for users whose plugin never polls
+# Every worker schedules it, but a scheduled run only goes ahead if the worker can take the janitor's lease in the
+# database, so however many workers there are it runs about once per janitor_interval_minutes
+
+import os
+import socket
+import logging
+from datetime import datetime, timedelta
+from timeit import default_timer as timer
+
+from flask import current_app
+from sqlalchemy import select, update, delete, or_
+from sqlalchemy.dialects.sqlite import insert
+
+from . import db
+from . import Message, Lease
+from . import media_uploads_folder
+from . import instrumentation
+from . import sharding
+from . import lifecycle
+
+# Janitor settings
+janitor_enabled = True
+janitor_interval_minutes = 15
+janitor_batch_size = 500  # rows deleted per transaction, so we never hold the SQLite write lock for long
+janitor_max_batches_per_run = 20
+orphaned_media_max_age_minutes = 60
+undelivered_message_retention_days = 30
+janitor_lease_seconds = (janitor_interval_minutes - 1) * 60  # a little shorter than the interval, so timers can drift
+
+# A summary of the most recent run, shown on the admin health page
+last_run = None
+
+_scheduler = None
+_app = None
+
+
+def remove_orphaned_media():
+    # Once a file has been uploaded to the cloud nothing refers to the local copy, so anything older than
+    # orphaned_media_max_age_minutes is safe to remove (younger files might still be mid-upload)
+
+    files_removed = 0
+    bytes_reclaimed = 0
+    cutoff = datetime.now() - timedelta(minutes=orphaned_media_max_age_minutes)
+
+    for entry in os.scandir(media_uploads_folder):
+        if not entry.is_file() or entry.name.startswith('.'):
+            continue
+        try:
+            stat = entry.stat()
+            if datetime.fromtimestamp(stat.st_mtime) > cutoff:
+                continue
+            os.remove(entry.path)
+        except OSError as e:
+            logging.error(f"Janitor could not remove {entry.path}: {e}")
+            continue
+        files_removed += 1
+        bytes_reclaimed += stat.st_size
+
+    return files_removed, bytes_reclaimed
+
+
+def delete_messages_in_batches(*criteria):
+    # Deletes messages matching the criteria a batch at a time, returns how many were deleted
+    # Message ids are only unique within a shard, so each shard is cleaned up separately
+
+    messages_deleted = 0
+
+    for shard_id in sharding.shard_ids():
+        bind_arguments = sharding.shard_bind_arguments(shard_id)
+
+        for batch in range(janitor_max_batches_per_run):
+            message_ids = db.session.execute(
+                select(Message.id).where(*criteria).limit(janitor_batch_size),
+                bind_arguments=bind_arguments
+            ).scalars().all()
+            if not message_ids:
+                break
+
+            try:
+                db.session.execute(
+                    delete(Message).where(Message.id.in_(message_ids)).execution_options(synchronize_session=False),
+                    bind_arguments=bind_arguments
+                )
+                db.session.commit()
+            except:
+                db.session.rollback()
+                logging.error("Janitor failed to delete a batch of messages")
+                break
+            messages_deleted += len(message_ids)
+
+    return messages_deleted
+
+
+def purge_delivered_messages():
+    return delete_messages_in_batches(Message.delivered == True)
+
+
+def purge_expired_undelivered_messages():
+    cutoff = datetime.now() - timedelta(days=undelivered_message_retention_days)
+    return delete_messages_in_batches(Message.delivered == False, Message.timestamp < cutoff)
+
+
+def get_lease_holder():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_lease(name, seconds):
+    # Returns True if this worker now holds the lease, ie nobody else held it or their hold has run out
+    # The conditional UPDATE is atomic, so when several workers try at once only one of them gets it
+
+    now = datetime.now()
+    holder = get_lease_holder()
+
+    db.session.execute(insert(Lease).values(name=name, holder="", expires=now).on_conflict_do_nothing())
+    result = db.session.execute(
+        update(Lease)
+        .where(Lease.name == name, or_(Lease.expires <= now, Lease.holder == holder))
+        .values(holder=holder, expires=now + timedelta(seconds=seconds))
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def run_scheduled_janitor():
+    # What the scheduler runs - the lease isn't released afterwards, so the other workers skip this interval
+
+    from . import app as default_app
+    app = _app or default_app
+
+    with app.app_context():
+        if not claim_lease('janitor', janitor_lease_seconds):
+            logging.info("Janitor skipped, another worker has run it recently")
+            instrumentation.increment('janitor_runs_skipped')
+            return None
+
+    return run_janitor(app)
+
+
+def run_janitor(app=None):
+    # Runs every cleanup task once and records what was reclaimed
+
+    global last_run
+
+    if app is None:
+        # Fall back to the default app created at the end of project/__init__
+        from . import app as default_app
+        app = _app or default_app
+
+    started = timer()
+
+    with app.app_context():
+        media_files_removed, media_bytes_reclaimed = remove_orphaned_media()
+        delivered_messages_purged = purge_delivered_messages()
+        undelivered_messages_expired = purge_expired_undelivered_messages()
+
+    duration = timer() - started
+
+    instrumentation.increment('janitor_runs')
+    instrumentation.increment('janitor_media_files_removed', media_files_removed)
+    instrumentation.increment('janitor_media_bytes_reclaimed', media_bytes_reclaimed)
+    instrumentation.increment('janitor_delivered_messages_purged', delivered_messages_purged)
+    instrumentation.increment('janitor_undelivered_messages_expired', undelivered_messages_expired)
+    instrumentation.record_timing('janitor_run', duration)
+
+    last_run = {
+        'finished': datetime.now(),
+        'duration_seconds': duration,
+        'media_files_removed': media_files_removed,
+        'media_bytes_reclaimed': media_bytes_reclaimed,
+        'delivered_messages_purged': delivered_messages_purged,
+        'undelivered_messages_expired': undelivered_messages_expired,
+    }
+    logging.info(f"Janitor finished: {last_run}")
+    return last_run
+
+
+def start_janitor(app):
+    # Starts the background scheduler, when the worker starts (see start_janitor_with_worker), so tests and CLI commands
+    # don't start it
+
+    global _scheduler, _app
+
+    if not janitor_enabled or _scheduler is not None:
+        return _scheduler
+
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    _app = app
+    _scheduler = BackgroundScheduler(daemon=True)
+    _scheduler.add_job(
+        run_scheduled_janitor,
+        'interval',
+        minutes=janitor_interval_minutes,
+        id='janitor',
+        max_instances=1,
+        coalesce=True,
+    )
+    _scheduler.start()
+    logging.info(f"Janitor scheduled every {janitor_interval_minutes} minutes")
+    return _scheduler
+
+
+@lifecycle.on_worker_start
+def start_janitor_with_worker():
+    # Start hooks run inside the app's context
+    start_janitor(current_app._get_current_object())
+
+
+@lifecycle.on_worker_stop
+def stop_janitor():
+    global _scheduler
+
+    if _scheduler is not None:
+        _scheduler.shutdown(wait=False)
+        _scheduler = None
@@ -0,0 +1,103 @@
+# This library is a faster JSON provider for the app, used when orjson is installed (it is optional)
+# Poll responses are mostly a list of Message dataclasses, which orjson encodes several times faster than the
+# standard library encoder Flask uses by default
+# The output has the same shape as Flask's own provider, as that is what the plugin expects: a dataclass becomes its
+# fields (not everything SQLAlchemy keeps on the instance) and datetimes are HTTP dates
+# Anything orjson can't encode (eg integers over 64 bits) falls back to Flask's own provider
+
+import logging
+import dataclasses
+from datetime import date, datetime, timedelta
+
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.http import http_date
+
+# JSON settings
+orjson_enabled = True
+
+_dataclass_field_names = {}
+
+_http_date_days = ("Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun")
+_http_date_months = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+
+def get_orjson():
+    if not orjson_enabled:
+        return None
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return orjson
+
+
+def get_dataclass_field_names(cls):
+    # dataclasses.fields() is slow enough to show up when it runs for every message, so the names are kept per class
+    field_names = _dataclass_field_names.get(cls)
+    if field_names is None:
+        field_names = _dataclass_field_names[cls] = tuple(field.name for field in dataclasses.fields(cls))
+    return field_names
+
+
+def format_http_date(o):
+    # The same as werkzeug's http_date, but about twice as fast for the naive (UTC) timestamps messages have
+
+    if isinstance(o, datetime) and (o.tzinfo is None or o.utcoffset() == timedelta(0)):
+        return (
+            f"{_http_date_days[o.weekday()]}, {o.day:02d} {_http_date_months[o.month - 1]} {o.year:04d} "
+            f"{o.hour:02d}:{o.minute:02d}:{o.second:02d} GMT"
+        )
+    return http_date(o)
+
+
+def default(o):
+    # Called by orjson for anything it doesn't encode itself - dataclasses and datetimes are passed here on purpose
+
+    if isinstance(o, date):
+        return format_http_date(o)
+    if dataclasses.is_dataclass(o) and not isinstance(o, type):
+        return {name: getattr(o, name) for name in get_dataclass_field_names(type(o))}
+    return DefaultJSONProvider.default(o)
+
+
+class OrjsonProvider(DefaultJSONProvider):
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.orjson = get_orjson()
+        self.options = (
+            self.orjson.OPT_PASSTHROUGH_DATACLASS
+            | self.orjson.OPT_PASSTHROUGH_DATETIME
+            | self.orjson.OPT_NON_STR_KEYS
+        )
+
+    def dumps_bytes(self, obj, indent=False):
+        options = self.options
+        if self.sort_keys:
+            options |= self.orjson.OPT_SORT_KEYS
+        if indent:
+            options |= self.orjson.OPT_INDENT_2
+
+        try:
+            return self.orjson.dumps(obj, default=default, option=options)
+        except TypeError as e:
+            # orjson.JSONEncodeError is a TypeError
+            logging.warning(f"orjson could not encode a response, using the standard library: {e}")
+            return super().dumps(obj, separators=(",", ":")).encode('utf-8')
+
+    def dumps(self, obj, **kwargs):
+        # Callers asking for standard library options get the standard library
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        return self.dumps_bytes(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        # orjson.JSONDecodeError is a ValueError, like the standard library's, so request.get_json handles it the same
+        return self.orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        return self._app.response_class(self.dumps_bytes(obj, indent), mimetype=self.mimetype)
@@ -0,0 +1,261 @@
+# This library runs things when a worker starts and stops, so work in progress isn't lost when gunicorn recycles a
+# worker (after max_requests, on a deploy, or when scaling down)
+# When a worker is asked to stop:
+# - is_stopping() turns true straight away, so long loops (eg a service message going out to every user) can stop
+#   early and persist what they haven't done yet
+# - we wait, up to shutdown_deadline_seconds, for the work in flight (Telegram sends and downloads, image uploads) to
+#   finish
+# - then the stop hooks run, eg to stop the janitor
+# Outbound messages that weren't sent are kept in the database as PendingSends, and sent by the next worker to start
+# - each one is claimed in the database before it is sent, so when several workers start at once it is only sent once
+# It is driven by gunicorn.conf.py under gunicorn, and by the lifespan events in asgi.py under uvicorn
+
+import time
+import atexit
+import signal
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, or_
+
+from . import db
+from . import PendingSend
+from . import send_message
+from . import instrumentation
+
+# Lifecycle settings
+shutdown_deadline_seconds = 20  # keep this below gunicorn's graceful_timeout, see gunicorn.conf.py
+pending_send_claim_seconds = 10 * 60  # a claimed message is only sent by another worker once this has passed
+pending_send_claim_candidates = 20
+
+_start_hooks = []
+_stop_hooks = []
+_app = None
+_started = False
+_stopped = False
+_stopping = False  # a plain bool, as it is set from a signal handler
+_deadline = None
+_in_flight = {}  # kind of work -> how many are in flight
+_in_flight_condition = threading.Condition()
+
+
+def on_worker_start(hook):
+    # Registers a function to call (inside an app context) when the worker starts - it can be used as a decorator
+    _start_hooks.append(hook)
+    return hook
+
+
+def on_worker_stop(hook):
+    # Registers a function to call (inside an app context) when the worker stops - it should be done by the time
+    # seconds_until_deadline() runs out
+    _stop_hooks.append(hook)
+    return hook
+
+
+def is_stopping():
+    return _stopping
+
+
+def begin_stopping():
+    global _stopping
+    _stopping = True
+
+
+def seconds_until_deadline():
+    if _deadline is None:
+        return shutdown_deadline_seconds
+    return max(0, _deadline - time.monotonic())
+
+
+@contextmanager
+def in_flight(kind):
+    # Marks some work as in progress, so a stopping worker waits for it to finish
+
+    with _in_flight_condition:
+        _in_flight[kind] = _in_flight.get(kind, 0) + 1
+    try:
+        yield
+    finally:
+        with _in_flight_condition:
+            _in_flight[kind] -= 1
+            if not _in_flight[kind]:
+                del _in_flight[kind]
+            _in_flight_condition.notify_all()
+
+
+def wait_for_in_flight():
+    # Returns what is still in flight when the deadline passes, which is nothing if it all finished in time
+
+    with _in_flight_condition:
+        _in_flight_condition.wait_for(lambda: not _in_flight, timeout=seconds_until_deadline())
+        return dict(_in_flight)
+
+
+def run_hooks(hooks, description):
+    for hook in hooks:
+        try:
+            if _app is not None:
+                with _app.app_context():
+                    hook()
+            else:
+                hook()
+        except Exception as e:
+            logging.error(f"Worker {description} hook {hook.__name__} failed: {e}")
+
+
+def start_worker(app):
+    global _app, _started
+
+    if _started:
+        return
+    _app, _started = app, True
+
+    # In case the server stops without telling us, eg flask run
+    atexit.register(stop_worker)
+
+    run_hooks(_start_hooks, "start")
+    logging.info("Worker started")
+
+
+def stop_worker():
+    global _stopped, _deadline
+
+    if _stopped:
+        return
+    _stopped = True
+
+    begin_stopping()
+    _deadline = time.monotonic() + shutdown_deadline_seconds
+
+    unfinished = wait_for_in_flight()
+    if unfinished:
+        logging.warning(f"Worker stopping with work still in flight: {unfinished}")
+        instrumentation.increment('lifecycle_unfinished_work', sum(unfinished.values()))
+
+    run_hooks(_stop_hooks, "stop")
+
+    # The counters only live as long as the worker, so this is the last chance to see them
+    logging.info(f"Worker stopped, counters at exit: {instrumentation.snapshot()['counters']}")
+
+
+def watch_for_stop_signal(signal_number=signal.SIGTERM):
+    # Makes is_stopping() turn true as soon as the stop signal arrives, rather than once the worker gets round to
+    # stopping - the existing handler (eg gunicorn's) still runs afterwards
+    # Must be called from the main thread
+
+    previous_handler = signal.getsignal(signal_number)
+
+    def handle_stop_signal(number, frame):
+        begin_stopping()
+        if callable(previous_handler):
+            previous_handler(number, frame)
+        else:
+            raise SystemExit(0)
+
+    signal.signal(signal_number, handle_stop_signal)
+
+
+def persist_pending_sends(pending_sends):
+    # Keeps messages we didn't get round to sending, as (provider, provider_id, contents, disable_notification)
+
+    for provider, provider_id, contents, disable_notification in pending_sends:
+        db.session.add(PendingSend(
+            provider=provider,
+            provider_id=provider_id,
+            contents=contents,
+            disable_notification=disable_notification,
+        ))
+    db.session.commit()
+
+    instrumentation.increment('lifecycle_sends_persisted', len(pending_sends))
+    logging.warning(f"Persisted {len(pending_sends)} unsent messages for the next worker")
+
+
+def claim_next_pending_send():
+    # Returns the oldest pending send no other worker is sending, now claimed by this one, or None if there are none
+    # The claim is a conditional UPDATE, so when several workers go for the same one only one of them gets it - a claim
+    # that is never finished with (eg the worker was killed) runs out after pending_send_claim_seconds
+
+    now = datetime.now()
+    unclaimed = or_(
+        PendingSend.claimed_at.is_(None),
+        PendingSend.claimed_at < now - timedelta(seconds=pending_send_claim_seconds)
+    )
+
+    candidate_ids = db.session.execute(
+        select(PendingSend.id).where(unclaimed).order_by(PendingSend.id).limit(pending_send_claim_candidates)
+    ).scalars().all()
+
+    for pending_send_id in candidate_ids:
+        result = db.session.execute(
+            update(PendingSend)
+            .where(PendingSend.id == pending_send_id, unclaimed)
+            .values(claimed_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+        if result.rowcount == 1:
+            return PendingSend.query.filter_by(id=pending_send_id).first()
+
+    return None
+
+
+def send_pending_sends():
+    # Sends the messages a previous worker didn't get round to, returns how many were sent
+    # Each one is deleted once it has gone, so if this worker is stopped too the rest are still there for the next one
+    # If one fails to send it is kept (and its claim given up), and we stop there, as the rest would most likely fail
+    # too - they are tried again when the next worker starts
+
+    sent = 0
+    with in_flight('pending_sends'):
+        while not is_stopping():
+            pending_send = claim_next_pending_send()
+            if pending_send is None:
+                break
+
+            if not send_message(
+                pending_send.provider,
+                pending_send.provider_id,
+                pending_send.contents,
+                pending_send.disable_notification,
+            ):
+                pending_send.claimed_at = None
+                db.session.commit()
+                instrumentation.increment('lifecycle_pending_sends_failed')
+                logging.warning("Sending a message left over by a previous worker failed, leaving the rest for now")
+                break
+
+            db.session.delete(pending_send)
+            db.session.commit()
+            sent += 1
+
+    if sent:
+        instrumentation.increment('lifecycle_pending_sends_sent', sent)
+        logging.info(f"Sent {sent} messages left over by a previous worker")
+    return sent
+
+
+@on_worker_start
+def start_sending_pending_sends():
+    # On a thread, so that a long backlog doesn't hold up the worker starting
+
+    if not PendingSend.query.first():
+        return
+
+    app = _app
+
+    def run():
+        with app.app_context():
+            send_pending_sends()
+
+    threading.Thread(target=run, name="pending_sends", daemon=True).start()
+
+
+def reset():
+    # Forgets that the worker started or stopped (mostly useful for testing)
+
+    global _app, _started, _stopped, _stopping, _deadline
+
+    _app, _started, _stopped, _stopping, _deadline = None, False, False, False, None
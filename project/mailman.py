@@ -1,6 +1,5 @@
 # This library handles sending email messages to onboard new users
 
-from redmail import EmailSender
 import logging
 
 from project import envars
@@ -11,12 +10,24 @@ email_setting_port = envars.email_setting_port
 email_setting_username = envars.email_setting_username
 email_setting_password = envars.email_setting_password
 
-email_client = EmailSender(
-    host=email_setting_host,
-    port=email_setting_port,
-    username=email_setting_username,
-    password=email_setting_password,
-)
+_email_client = None
+
+
+def get_email_client():
+    # The email client is only created (and redmail only imported) the first time we send an email
+
+    global _email_client
+
+    if _email_client is None:
+        from redmail import EmailSender
+
+        _email_client = EmailSender(
+            host=email_setting_host,
+            port=email_setting_port,
+            username=email_setting_username,
+            password=email_setting_password,
+        )
+    return _email_client
 
 
 def send_email(
@@ -25,7 +36,7 @@ def send_email(
     body
 ):
 
-    email_client.send(
+    get_email_client().send(
         sender=email_setting_from_address,
         receivers=[to_email],
         subject=subject,
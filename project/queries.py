@@ -0,0 +1,60 @@
+# This library holds the statements for the lookups made on every webhook and poll
+# They are built with lambda_stmt, so SQLAlchemy only constructs each statement (and works out its cache key) the first
+# time - after that a call just picks up the new parameter values, instead of building a whole ORM query again
+# Each use of SQLAlchemy's compiled statement cache is counted in instrumentation (sql_compiled_cache_*), so a hot
+# statement that stops being cached shows up on the admin health page
+
+from sqlalchemy import select, event, lambda_stmt
+from sqlalchemy.engine import Engine
+
+from . import db
+from . import User, Message
+from . import instrumentation
+
+# Query settings
+count_compiled_cache_use = True
+
+
+def user_by_token_statement(token):
+    return lambda_stmt(lambda: select(User).where(User.token == token).limit(1))
+
+
+def user_by_provider_id_statement(provider_id):
+    return lambda_stmt(lambda: select(User).where(User.provider_id == provider_id).limit(1))
+
+
+def undelivered_messages_statement(user_id):
+    return lambda_stmt(lambda: select(Message).where(Message.user_id == user_id, Message.delivered == False))
+
+
+def get_user_by_token(token):
+    return db.session.execute(user_by_token_statement(token)).scalars().first()
+
+
+def get_user_by_provider_id(provider_id):
+    return db.session.execute(user_by_provider_id_statement(str(provider_id))).scalars().first()
+
+
+def get_user_by_id(user_id):
+    # Usually the user was loaded earlier in the same request, in which case this doesn't touch the database
+    return db.session.get(User, int(user_id))
+
+
+def get_undelivered_messages(user_id):
+    return db.session.execute(undelivered_messages_statement(str(user_id))).scalars().all()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def record_compiled_cache_use(connection, cursor, statement, parameters, context, executemany):
+    # context.cache_hit says whether the statement's compiled form came from the cache, or why it couldn't
+
+    if not count_compiled_cache_use or context is None:
+        return
+
+    cache_hit = getattr(context, 'cache_hit', None)
+    if cache_hit is connection.dialect.CACHE_HIT:
+        instrumentation.increment('sql_compiled_cache_hits')
+    elif cache_hit is connection.dialect.CACHE_MISS:
+        instrumentation.increment('sql_compiled_cache_misses')
+    elif cache_hit is not None:
+        instrumentation.increment('sql_compiled_cache_skipped')
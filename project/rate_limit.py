@@ -0,0 +1,183 @@
+# This library stops a single user token or Telegram chat from hammering the server
+# Each caller gets a token bucket per route, checked before we touch the database, plus quotas on how much
+# they can have queued up waiting for delivery
+# The memory backend is fine for a single worker; use the Redis backend so that several workers share the same buckets
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from sqlalchemy import func, select, cast, LargeBinary
+
+from . import envars
+from . import instrumentation
+from . import shared_state
+from . import db, Message
+
+# Rate limit settings
+rate_limit_enabled = True
+rate_limit_backend = "redis" if envars.redis_url else "memory"
+
+# Each bucket holds up to capacity tokens and refills at refill_per_second, every request costs one token
+buckets = {
+    'poll': {'capacity': 10, 'refill_per_second': 1},
+    'webhook': {'capacity': 30, 'refill_per_second': 1},
+}
+
+# A chat that is flooding the webhook is told so at most once in this long
+flood_notice_interval_seconds = 60
+
+# Quotas on what a user can have queued up waiting for the plugin to collect it
+max_queued_messages_per_user = 1000
+max_queued_bytes_per_user = 5_000_000
+
+# The memory backend forgets the least recently seen keys beyond this, so it can't grow without limit
+memory_backend_max_keys = 100_000
+
+
+class MemoryBackend:
+
+    def __init__(self, max_keys=None):
+        self.max_keys = max_keys or memory_backend_max_keys
+        self.buckets = OrderedDict()  # key -> (tokens, timestamp)
+        self._lock = threading.Lock()
+
+    def consume(self, key, capacity, refill_per_second, cost=1):
+        # Returns True if the request is allowed
+
+        now = time.monotonic()
+        with self._lock:
+            tokens, timestamp = self.buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - timestamp) * refill_per_second)
+
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+
+            self.buckets[key] = (tokens, now)
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+
+        return allowed
+
+
+class RedisBackend:
+
+    # Refill and consume in one atomic step so workers can't race each other
+    token_bucket_script = """
+local capacity = tonumber(ARGV[1])
+local refill_per_second = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local cost = tonumber(ARGV[4])
+
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(bucket[1])
+local timestamp = tonumber(bucket[2])
+if tokens == nil then
+    tokens = capacity
+    timestamp = now
+end
+
+tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * refill_per_second)
+
+local allowed = 0
+if tokens >= cost then
+    tokens = tokens - cost
+    allowed = 1
+end
+
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'timestamp', now)
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / refill_per_second) + 1)
+return allowed
+"""
+
+    def __init__(self, redis_url=None):
+        self.client = shared_state.get_redis_client(redis_url)
+        self.script = self.client.register_script(self.token_bucket_script)
+
+    def consume(self, key, capacity, refill_per_second, cost=1):
+        try:
+            result = self.script(
+                keys=[f"loglink:rate_limit:{key}"],
+                args=[capacity, refill_per_second, time.time(), cost]
+            )
+        except Exception as e:
+            # If Redis is down we would rather let traffic through than take the whole server down with it
+            logging.error(f"Rate limit check failed, allowing request: {e}")
+            return True
+        return result == 1
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+
+    with _backend_lock:
+        if _backend is None:
+            if rate_limit_backend == "redis":
+                _backend = RedisBackend()
+            else:
+                _backend = MemoryBackend()
+        return _backend
+
+
+def check(bucket_name, key):
+    # Returns True if this caller is allowed to make a request to the route protected by the named bucket
+
+    if not rate_limit_enabled or key is None:
+        return True
+
+    bucket = buckets[bucket_name]
+    allowed = get_backend().consume(
+        f"{bucket_name}:{key}",
+        bucket['capacity'],
+        bucket['refill_per_second']
+    )
+
+    if not allowed:
+        logging.warning(f"Rate limited {bucket_name} request")
+        instrumentation.increment(f"rate_limit_rejected_{bucket_name}")
+    return allowed
+
+
+def should_send_flood_notice(key):
+    # True the first time a flooding caller is turned away in each flood_notice_interval_seconds
+    return shared_state.set_value_if_absent(f"flood_notice:{key}", True, flood_notice_interval_seconds)
+
+
+def rate_limited_response():
+    return {
+        'status': 'error',
+        'error_type': 'rate_limited',
+        'message': 'Too many requests, please slow down'
+    }, 429
+
+
+def queued_for_user_statement(user_id):
+    # How many messages and how many bytes the user has waiting for delivery, in a single query
+    # The bytes are as stored, so long contents count at their compressed size
+
+    return select(
+        func.count(Message.id),
+        func.coalesce(func.sum(func.length(cast(Message.contents, LargeBinary))), 0)
+    ).where(
+        Message.user_id == user_id,
+        Message.delivered == False
+    )
+
+
+def is_over_quota(user_id, queued_messages, queued_bytes):
+    if queued_messages >= max_queued_messages_per_user or queued_bytes >= max_queued_bytes_per_user:
+        logging.warning(f"User {user_id} is over quota: {queued_messages} messages, {queued_bytes} bytes")
+        instrumentation.increment('rate_limit_quota_exceeded')
+        return True
+    return False
+
+
+def is_user_over_quota(user_id):
+    queued_messages, queued_bytes = db.session.execute(queued_for_user_statement(user_id)).one()
+    return is_over_quota(user_id, queued_messages, queued_bytes)
@@ -0,0 +1,113 @@
+# This library turns away bad requests before Flask does any work on them, so scanners and floods cost next to nothing
+# - requests to the Telegram webhook must carry the secret token, which is checked in constant time (so the time it
+#   takes doesn't leak how much of a guess was right) and never logged
+# - request bodies bigger than we would ever expect are refused from their Content-Length, before being read
+# It sits in front of the Flask app as WSGI middleware (see create_app), and asgi.py makes the same checks for the
+# routes it serves natively
+# Flask still enforces max_content_length for bodies that don't say how long they are (eg chunked uploads), and asgi.py
+# stops reading them once they pass get_max_content_length
+
+import hmac
+import json
+import logging
+
+from . import envars
+from . import instrumentation
+
+# Guard settings
+request_guard_enabled = True
+max_content_length = 1024 * 1024  # the biggest thing we accept is an admin replaying a batch of updates
+webhook_max_content_length = 256 * 1024  # a single Telegram update is a few KB at most
+webhook_paths = ["/telegram/webhook"]  # without the trailing slash, so both forms are guarded
+webhook_secret_header = "X-Telegram-Bot-Api-Secret-Token"
+
+# The responses are built once, as they are the same every time
+rejection_responses = {
+    'no_webhook_token': ("401 UNAUTHORIZED", {
+        'status': 'error',
+        'message': 'No webhook verification token received'
+    }),
+    'bad_webhook_token': ("401 UNAUTHORIZED", {
+        'status': 'error',
+        'message': 'Webhook verification token did not match expected'
+    }),
+    'body_too_large': ("413 REQUEST ENTITY TOO LARGE", {
+        'status': 'error',
+        'message': 'Request body too large'
+    }),
+}
+rejection_responses = {
+    reason: (status, json.dumps(body).encode('utf-8'))
+    for reason, (status, body) in rejection_responses.items()
+}
+
+
+def is_webhook_path(path):
+    return path.rstrip('/') in webhook_paths
+
+
+def is_webhook_secret_valid(received_token):
+    expected_token = envars.telegram_webhook_auth
+    if not received_token or not expected_token:
+        return False
+    return hmac.compare_digest(received_token.encode('utf-8'), expected_token.encode('utf-8'))
+
+
+def get_max_content_length(method, path):
+    if method == "POST" and is_webhook_path(path):
+        return webhook_max_content_length
+    return max_content_length
+
+
+def check_request(method, path, content_length, received_token):
+    # Returns the reason to reject the request, or None if it can go through
+
+    if not request_guard_enabled:
+        return None
+
+    is_webhook = method == "POST" and is_webhook_path(path)
+
+    try:
+        content_length = int(content_length or 0)
+    except ValueError:
+        content_length = 0
+    if content_length > get_max_content_length(method, path):
+        return 'body_too_large'
+
+    if is_webhook:
+        if not received_token:
+            return 'no_webhook_token'
+        if not is_webhook_secret_valid(received_token):
+            return 'bad_webhook_token'
+
+    return None
+
+
+def record_rejection(reason, path):
+    instrumentation.increment(f"request_guard_rejected_{reason}")
+    logging.warning(f"Rejected a request to {path}: {reason}")
+
+
+class RequestGuardMiddleware:
+
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        reason = check_request(
+            environ.get('REQUEST_METHOD'),
+            path,
+            environ.get('CONTENT_LENGTH'),
+            environ.get('HTTP_' + webhook_secret_header.upper().replace('-', '_')),
+        )
+        if not reason:
+            return self.wsgi_app(environ, start_response)
+
+        record_rejection(reason, path)
+        status, body = rejection_responses[reason]
+        start_response(status, [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(body))),
+        ])
+        return [body]
@@ -0,0 +1,146 @@
+# This library profiles each request to see how much database and network work it does, which isn't obvious from the
+# code (properties like User.message_count run a query each time they are read)
+# It is opt-in with REQUEST_PROFILING, and for every request counts:
+# - the SQL statements run and the time spent running them (from SQLAlchemy's cursor events)
+# - the outbound HTTP requests made through http_client and the time spent waiting on them
+# Requests that are slow or run a lot of statements are logged, and in debug mode the numbers are sent back as
+# response headers (including a Server-Timing header, which browser dev tools show next to the request)
+# It sits in front of the Flask app as WSGI middleware (see create_app), and asgi.py profiles the routes it serves
+# itself with profile_request
+
+import time
+import logging
+import contextvars
+from contextlib import contextmanager
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from . import envars
+from . import instrumentation
+
+# Profiler settings
+request_profiling_enabled = bool(envars.request_profiling)
+slow_request_threshold_seconds = 0.5
+slow_request_statement_threshold = 20
+
+_current_profile = contextvars.ContextVar('request_profile', default=None)
+
+
+class RequestProfile:
+    # What one request has done so far
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.statement_count = 0
+        self.db_seconds = 0.0
+        self.http_request_count = 0
+        self.http_seconds = 0.0
+
+    @property
+    def total_seconds(self):
+        return time.perf_counter() - self.started
+
+    def is_slow(self):
+        return (
+            self.total_seconds >= slow_request_threshold_seconds
+            or self.statement_count >= slow_request_statement_threshold
+        )
+
+    def headers(self):
+        return [
+            ('Server-Timing', (
+                f'db;dur={self.db_seconds * 1000:.1f};desc="{self.statement_count} statements", '
+                f'http;dur={self.http_seconds * 1000:.1f};desc="{self.http_request_count} requests", '
+                f'total;dur={self.total_seconds * 1000:.1f}'
+            )),
+            ('X-DB-Statements', str(self.statement_count)),
+            ('X-HTTP-Requests', str(self.http_request_count)),
+        ]
+
+    def summary(self):
+        return (
+            f"{self.total_seconds * 1000:.0f}ms, "
+            f"{self.statement_count} SQL statements ({self.db_seconds * 1000:.0f}ms), "
+            f"{self.http_request_count} HTTP requests ({self.http_seconds * 1000:.0f}ms)"
+        )
+
+
+def get_current_profile():
+    return _current_profile.get()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def record_statement_start(connection, cursor, statement, parameters, context, executemany):
+    profile = _current_profile.get()
+    if profile is None:
+        return
+
+    profile.statement_count += 1
+    if context is None:
+        return
+    # Kept on the statement's execution context, which is thrown away with it, so a statement that fails never leaves
+    # a start time behind for the next one to pick up
+    context._profiler_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_statement_end(connection, cursor, statement, parameters, context, executemany):
+    profile = _current_profile.get()
+    started = getattr(context, '_profiler_start', None)
+    if profile is None or started is None:
+        return
+
+    profile.db_seconds += time.perf_counter() - started
+
+
+def record_http_response(response, *args, **kwargs):
+    # A requests response hook (see http_client.get_session), also called for requests sent with httpx - elapsed is the
+    # time until the response arrived
+
+    profile = _current_profile.get()
+    if profile is None:
+        return
+
+    profile.http_request_count += 1
+    profile.http_seconds += response.elapsed.total_seconds()
+
+
+@contextmanager
+def profile_request(method, path):
+    # Profiles the work done inside the block, which gets the profile (or None if profiling is off)
+
+    if not request_profiling_enabled:
+        yield None
+        return
+
+    profile = RequestProfile()
+    token = _current_profile.set(profile)
+    try:
+        yield profile
+    finally:
+        _current_profile.reset(token)
+
+        if profile.is_slow():
+            instrumentation.increment('request_profiler_slow_requests')
+            logging.warning(f"Slow request {method} {path}: {profile.summary()}")
+
+
+class RequestProfilerMiddleware:
+
+    def __init__(self, wsgi_app, app):
+        self.wsgi_app = wsgi_app
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        with profile_request(environ.get('REQUEST_METHOD'), environ.get('PATH_INFO', '')) as profile:
+            if profile is None:
+                return self.wsgi_app(environ, start_response)
+
+            def profiled_start_response(status, headers, exc_info=None):
+                # Flask starts the response once the view has run, so by now the work for the request is done
+                if self.app.debug:
+                    headers = list(headers) + profile.headers()
+                return start_response(status, headers, exc_info)
+
+            return self.wsgi_app(environ, profiled_start_response)
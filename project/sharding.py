@@ -0,0 +1,326 @@
+# This library spreads users and their messages over several SQLite files, so webhook ingest isn't limited by
+# SQLite's single writer lock. Every shard has the same schema and a user's messages always live on the user's shard
+# - a new user is placed on a shard by a hash of their provider id (eg their Telegram chat id)
+# - user ids are then handed out so that user id % shard_count is the user's shard, so anything that knows the user id
+#   (most queries) goes straight to the right file - two workers adding users to a shard at once can pick the same id,
+#   so new users are added with add_new_user, which tries again with the next id
+# - queries that can't be routed (eg looking a user up by token, or admin counts) are run on every shard and combined
+# - everything else (beta codes, migrations) lives on shard 0, which is the original messages.sqlite3
+# With shard_count = 1 (the default) none of this is used and the database works exactly as before
+# To change the number of shards, stop the server and run: flask --app project reshard <shard_count>
+
+import os
+import zlib
+import sqlite3
+import logging
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import select, insert, delete, func, event, inspect, create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.ext.horizontal_shard import ShardedSession as BaseShardedSession
+from sqlalchemy.sql import visitors, operators
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+from sqlalchemy.sql.schema import Column
+
+from . import envars
+
+# Sharding settings
+shard_count = envars.db_shard_count
+global_shard_id = "0"
+shard_database_file = "messages.sqlite3"
+shard_database_file_pattern = "messages_shard{}.sqlite3"
+sharded_tables = ["user", "message"]
+user_id_allocation_attempts = 5
+
+
+def is_sharded():
+    return shard_count > 1
+
+
+def shard_ids(count=None):
+    return [str(shard_number) for shard_number in range(count or shard_count)]
+
+
+def shard_database_uri(shard_id):
+    if shard_id == global_shard_id:
+        return f"sqlite:///{shard_database_file}"
+    return f"sqlite:///{shard_database_file_pattern.format(shard_id)}"
+
+
+def shard_binds():
+    # The extra shards are configured as Flask-SQLAlchemy binds, so their engines are managed like the main one
+    return {f"shard{shard_id}": shard_database_uri(shard_id) for shard_id in shard_ids() if shard_id != global_shard_id}
+
+
+def get_shard_engines(db, app):
+    return {
+        shard_id: db.get_engine(app) if shard_id == global_shard_id else db.get_engine(app, bind=f"shard{shard_id}")
+        for shard_id in shard_ids()
+    }
+
+
+def shard_for_key(key, count=None):
+    # crc32 rather than hash(), which is different in every process
+    return str(zlib.crc32(str(key).encode('utf-8')) % (count or shard_count))
+
+
+def shard_for_user_id(user_id, count=None):
+    return str(int(user_id) % (count or shard_count))
+
+
+def first_user_id_after(max_user_id, shard_id, count=None):
+    # The next id after max_user_id that belongs on this shard (never 0, as plenty of code treats that as no user)
+    count = count or shard_count
+    user_id = (max_user_id or 0) + 1
+    return user_id + (int(shard_id) - user_id) % count
+
+
+# Columns that tell us which shard a query is about, and how to get from a value to a shard
+routing_columns = {
+    ('user', 'id'): shard_for_user_id,
+    ('user', 'provider_id'): shard_for_key,
+    ('message', 'user_id'): shard_for_user_id,
+}
+
+
+def get_table_name(mapper):
+    if mapper is None:
+        return None
+    return inspect(mapper).local_table.name
+
+
+def choose_shard_for_instance(mapper, instance, clause=None):
+    # Where a new or changed object is written to
+
+    table_name = get_table_name(mapper)
+    if instance is None or table_name not in sharded_tables:
+        return global_shard_id
+
+    if table_name == 'user':
+        if instance.id is not None:
+            return shard_for_user_id(instance.id)
+        return shard_for_key(instance.provider_id or instance.token)
+
+    return shard_for_user_id(instance.user_id)
+
+
+def choose_shards_for_identity(query, primary_key):
+    # Where to look for an object by its primary key
+
+    table_name = get_table_name(inspect(query.column_descriptions[0]['entity']))
+    if table_name == 'user':
+        return [shard_for_user_id(primary_key[0])]
+    if table_name in sharded_tables:
+        return shard_ids()
+    return [global_shard_id]
+
+
+def choose_shards_for_statement(orm_context):
+    # Which shards a query has to run on - if it compares a routing column to a value we only need that value's
+    # shard, otherwise it runs everywhere and the results are combined
+    # Only use equality on routing columns as a filter, not as one side of an OR with other columns
+
+    table_name = get_table_name(orm_context.bind_mapper)
+    if table_name not in sharded_tables:
+        return [global_shard_id]
+
+    # This looks through the whole statement, so filters inside subqueries (eg from query.count()) are found too
+    shards = set()
+    for element in visitors.iterate(orm_context.statement):
+        if not isinstance(element, BinaryExpression) or element.operator not in (operators.eq, operators.in_op):
+            continue
+        if not isinstance(element.left, Column) or not isinstance(element.right, BindParameter):
+            continue
+
+        choose_shard = routing_columns.get((element.left.table.name, element.left.name))
+        if not choose_shard:
+            continue
+
+        values = element.right.effective_value
+        if element.operator is operators.eq:
+            values = [values]
+        try:
+            shards.update(choose_shard(value) for value in values)
+        except (TypeError, ValueError):
+            return shard_ids()
+
+    return sorted(shards) if shards else shard_ids()
+
+
+class ShardedSession(BaseShardedSession):
+
+    def __init__(self, shards, **options):
+        # Any bind we are given is replaced by the shards
+        options.pop('bind', None)
+        options.pop('binds', None)
+        super().__init__(
+            shard_chooser=choose_shard_for_instance,
+            id_chooser=choose_shards_for_identity,
+            execute_chooser=choose_shards_for_statement,
+            shards=shards,
+            **options
+        )
+
+
+@event.listens_for(ShardedSession, 'before_flush')
+def assign_user_ids(session, flush_context, instances):
+    # New users get an id that points back at the shard their provider id hashes to
+
+    next_user_ids = {}
+    for instance in session.new:
+        mapper = inspect(instance).mapper
+        if get_table_name(mapper) != 'user' or instance.id is not None:
+            continue
+
+        shard_id = choose_shard_for_instance(mapper, instance)
+        if shard_id not in next_user_ids:
+            max_user_id = session.execute(
+                select(func.max(mapper.local_table.c.id)),
+                bind_arguments={'shard_id': shard_id}
+            ).scalar()
+            next_user_ids[shard_id] = first_user_id_after(max_user_id, shard_id)
+
+        instance.id = next_user_ids[shard_id]
+        next_user_ids[shard_id] += shard_count
+
+
+def add_new_user(session, make_user):
+    # Adds and commits the user make_user() returns, and returns it
+    # A new user's id is the next one after the highest on its shard, so if another worker adds a user to the same
+    # shard at the same time they both pick the same id, and SQLite turns the second one away (as a duplicate primary
+    # key, or as locked if both were writing at once). The loser rolls back and tries again with a fresh user, which
+    # gets the id after the winner's
+
+    for attempt in range(1, user_id_allocation_attempts + 1):
+        user = make_user()
+        session.add(user)
+        try:
+            session.commit()
+            return user
+        except (IntegrityError, OperationalError) as e:
+            session.rollback()
+            if attempt == user_id_allocation_attempts:
+                raise
+            logging.warning(f"Adding a new user failed, trying again (attempt {attempt}): {e}")
+
+
+class FlaskShardedSession(ShardedSession):
+    # The session Flask-SQLAlchemy creates for db.session when there is more than one shard
+
+    def __init__(self, db, **options):
+        super().__init__(shards=get_shard_engines(db, db.get_app()), **options)
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        if not is_sharded():
+            return super().create_session(options)
+        return sessionmaker(class_=FlaskShardedSession, db=self, **options)
+
+
+def shard_bind_arguments(shard_id):
+    # Pins a session.execute() to one shard
+    if not is_sharded():
+        return {}
+    return {'shard_id': shard_id}
+
+
+def count_rows(session, model, *criteria):
+    # Counts across every shard - a plain query.count() would only count the first shard's rows
+
+    statement = select(func.count()).select_from(model).where(*criteria)
+    return sum(session.execute(statement).scalars())
+
+
+def create_shard_tables(db, app):
+    # Shard 0 gets every table through db.create_all, the other shards only need users and messages
+
+    tables = [db.metadata.tables[table_name] for table_name in sharded_tables]
+    for shard_id, engine in get_shard_engines(db, app).items():
+        if shard_id != global_shard_id:
+            db.metadata.create_all(engine, tables=tables)
+
+
+def reshard(db, app, new_shard_count):
+    # Moves every user and their messages to the shard they belong on with new_shard_count shards
+    # Users get new ids (so they point at their new shard) and messages get new ids on their new shard
+    # Everything is written to new files first, and only swapped in once they are all complete
+    # The server must be stopped while this runs
+
+    user_table = db.metadata.tables['user']
+    message_table = db.metadata.tables['message']
+
+    source_engines = get_shard_engines(db, app)
+    source_paths = {shard_id: engine.url.database for shard_id, engine in source_engines.items()}
+    database_folder = os.path.dirname(source_paths[global_shard_id])
+
+    target_paths = {}
+    for shard_id in shard_ids(new_shard_count):
+        if shard_id == global_shard_id:
+            file_name = shard_database_file
+        else:
+            file_name = shard_database_file_pattern.format(shard_id)
+        target_paths[shard_id] = os.path.join(database_folder, file_name)
+    temporary_paths = {shard_id: f"{path}.reshard" for shard_id, path in target_paths.items()}
+
+    # The new shard 0 starts as a copy of the current one, so beta codes and migration history come across
+    for path in temporary_paths.values():
+        if os.path.exists(path):
+            os.remove(path)
+    with sqlite3.connect(source_paths[global_shard_id]) as source, sqlite3.connect(temporary_paths[global_shard_id]) as target:
+        source.backup(target)
+
+    target_engines = {shard_id: create_engine(f"sqlite:///{path}") for shard_id, path in temporary_paths.items()}
+    for engine in target_engines.values():
+        db.metadata.create_all(engine, tables=[user_table, message_table])
+
+    users_moved = 0
+    messages_moved = 0
+    next_user_ids = {shard_id: first_user_id_after(0, shard_id, new_shard_count) for shard_id in target_engines}
+
+    target_connections = {shard_id: engine.connect() for shard_id, engine in target_engines.items()}
+    try:
+        transactions = [connection.begin() for connection in target_connections.values()]
+        target_connections[global_shard_id].execute(delete(message_table))
+        target_connections[global_shard_id].execute(delete(user_table))
+
+        for source_engine in source_engines.values():
+            with source_engine.connect() as source:
+                for user in source.execute(select(user_table).order_by(user_table.c.id)).mappings().all():
+                    shard_id = shard_for_key(user['provider_id'] or user['token'], new_shard_count)
+                    new_user_id = next_user_ids[shard_id]
+                    next_user_ids[shard_id] += new_shard_count
+
+                    target = target_connections[shard_id]
+                    target.execute(insert(user_table), dict(user, id=new_user_id))
+                    users_moved += 1
+
+                    messages = source.execute(
+                        select(message_table).where(message_table.c.user_id == str(user['id']))
+                    ).mappings().all()
+                    if messages:
+                        target.execute(
+                            insert(message_table),
+                            [dict(message, id=None, user_id=str(new_user_id)) for message in messages]
+                        )
+                        messages_moved += len(messages)
+
+        for transaction in transactions:
+            transaction.commit()
+    finally:
+        for connection in target_connections.values():
+            connection.close()
+        for engine in list(target_engines.values()) + list(source_engines.values()):
+            engine.dispose()
+
+    # Swap the new files in, and remove any shards we no longer need
+    for shard_id, path in temporary_paths.items():
+        os.replace(path, target_paths[shard_id])
+    for shard_id, path in source_paths.items():
+        if shard_id not in target_paths and os.path.exists(path):
+            os.remove(path)
+
+    logging.info(f"Resharded {users_moved} users and {messages_moved} messages into {new_shard_count} shards")
+    return users_moved, messages_moved
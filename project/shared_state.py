@@ -0,0 +1,176 @@
+# This library holds state that every worker should agree on, such as the latest plugin version
+# Module globals are private to each gunicorn worker, so anything kept in them is refreshed once per worker and can
+# disagree between workers. With the Redis backend all workers share one copy, so they behave like one server
+# Values must be JSON serialisable, and can be given a time to live after which they disappear
+
+import json
+import time
+import logging
+import threading
+
+from . import envars
+
+# Shared state settings
+shared_state_backend = "redis" if envars.redis_url else "memory"
+redis_key_prefix = "loglink:shared_state:"
+memory_prune_interval_seconds = 60  # how often the memory backend drops expired values nobody has read since
+
+
+class MemoryBackend:
+    # Only shared between threads in this process - fine for a single worker
+
+    def __init__(self):
+        self.values = {}  # key -> (value, expires_at or None)
+        self._lock = threading.Lock()
+        self._last_pruned = time.monotonic()
+
+    def _get_live_entry(self, key):
+        # Must be called with the lock held
+        entry = self.values.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self.values[key]
+            return None
+        return entry
+
+    def _prune_expired(self):
+        # Must be called with the lock held - values with a time to live would otherwise stay until they were next read
+        now = time.monotonic()
+        if now - self._last_pruned < memory_prune_interval_seconds:
+            return
+        self._last_pruned = now
+        expired = [key for key, (value, expires_at) in self.values.items() if expires_at is not None and expires_at <= now]
+        for key in expired:
+            del self.values[key]
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._get_live_entry(key)
+        return default if entry is None else entry[0]
+
+    def set(self, key, value, ttl_seconds=None):
+        expires_at = time.monotonic() + ttl_seconds if ttl_seconds else None
+        with self._lock:
+            self._prune_expired()
+            self.values[key] = (value, expires_at)
+
+    def set_if_absent(self, key, value, ttl_seconds=None):
+        # Returns True if the value was set, ie nobody else had set it first
+        expires_at = time.monotonic() + ttl_seconds if ttl_seconds else None
+        with self._lock:
+            self._prune_expired()
+            if self._get_live_entry(key) is not None:
+                return False
+            self.values[key] = (value, expires_at)
+        return True
+
+    def increment(self, key, amount=1, ttl_seconds=None):
+        # The time to live starts when the key is created, and isn't extended by later increments
+        with self._lock:
+            self._prune_expired()
+            entry = self._get_live_entry(key)
+            if entry is None:
+                entry = (0, time.monotonic() + ttl_seconds if ttl_seconds else None)
+            self.values[key] = (entry[0] + amount, entry[1])
+            return self.values[key][0]
+
+    def delete(self, key):
+        with self._lock:
+            self.values.pop(key, None)
+
+
+class RedisBackend:
+    # Shared between every worker that points at the same Redis
+    # If Redis goes away we carry on with a per-process copy, which is how things worked before there was shared state
+
+    def __init__(self, redis_url=None):
+        self.client = get_redis_client(redis_url)
+        self.fallback = MemoryBackend()
+
+    def get(self, key, default=None):
+        try:
+            value = self.client.get(redis_key_prefix + key)
+        except Exception as e:
+            logging.error(f"Shared state read failed, using local copy: {e}")
+            return self.fallback.get(key, default)
+        return default if value is None else json.loads(value)
+
+    def set(self, key, value, ttl_seconds=None):
+        try:
+            self.client.set(redis_key_prefix + key, json.dumps(value), ex=ttl_seconds)
+        except Exception as e:
+            logging.error(f"Shared state write failed, using local copy: {e}")
+            self.fallback.set(key, value, ttl_seconds)
+
+    def set_if_absent(self, key, value, ttl_seconds=None):
+        try:
+            return bool(self.client.set(redis_key_prefix + key, json.dumps(value), ex=ttl_seconds, nx=True))
+        except Exception as e:
+            logging.error(f"Shared state write failed, using local copy: {e}")
+            return self.fallback.set_if_absent(key, value, ttl_seconds)
+
+    def increment(self, key, amount=1, ttl_seconds=None):
+        try:
+            value = self.client.incrby(redis_key_prefix + key, amount)
+            if value == amount and ttl_seconds:
+                self.client.expire(redis_key_prefix + key, int(ttl_seconds))
+            return value
+        except Exception as e:
+            logging.error(f"Shared state write failed, using local copy: {e}")
+            return self.fallback.increment(key, amount, ttl_seconds)
+
+    def delete(self, key):
+        try:
+            self.client.delete(redis_key_prefix + key)
+        except Exception as e:
+            logging.error(f"Shared state delete failed: {e}")
+        self.fallback.delete(key)
+
+
+_redis_clients = {}
+_backend = None
+_lock = threading.Lock()
+
+
+def get_redis_client(redis_url=None):
+    # One connection pool per Redis URL, shared by everything in the project that talks to Redis
+
+    import redis
+
+    redis_url = redis_url or envars.redis_url
+    with _lock:
+        if redis_url not in _redis_clients:
+            _redis_clients[redis_url] = redis.Redis.from_url(redis_url)
+        return _redis_clients[redis_url]
+
+
+def get_backend():
+    global _backend
+
+    if _backend is None:
+        backend = RedisBackend() if shared_state_backend == "redis" else MemoryBackend()
+        with _lock:
+            if _backend is None:
+                _backend = backend
+    return _backend
+
+
+def get_value(key, default=None):
+    return get_backend().get(key, default)
+
+
+def set_value(key, value, ttl_seconds=None):
+    get_backend().set(key, value, ttl_seconds)
+
+
+def set_value_if_absent(key, value, ttl_seconds=None):
+    # Returns True if this caller set the value - useful as a lock so only one worker does a piece of work
+    return get_backend().set_if_absent(key, value, ttl_seconds)
+
+
+def increment_value(key, amount=1, ttl_seconds=None):
+    # Adds to a counter atomically and returns its new value - the time to live is set when the counter is created
+    return get_backend().increment(key, amount, ttl_seconds)
+
+
+def delete_value(key):
+    get_backend().delete(key)
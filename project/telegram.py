@@ -4,7 +4,7 @@ import requests
 import pprint  # for debug
 from flask import Flask, request
 
-from . import app
+from . import routes
 from . import add_new_message, compose_location_message_contents, compose_image_message_contents
 
 from . import db
@@ -25,9 +25,21 @@ from . import media_urls
 from . import envars
 
 from . import imgbb
+from . import image_policy
+from . import image_storage
+from . import http_client
+from . import async_bridge
 
 from . import escape_markdown
 
+from . import rate_limit
+from . import instrumentation
+from . import queries
+from . import lifecycle
+from . import request_guard
+
+from . import telegram_updates
+
 
 telegram_base_api_url = 'https://api.telegram.org'
 telegram_api_url = f"{telegram_base_api_url}/{envars.telegram_full_token}"
@@ -45,6 +57,8 @@ command_list = [
     "/readme",
     "/delete_account",
     "/delete_account_confirm",
+    "/storage",
+    "/digest",
 ]
 
 supported_message_types = [
@@ -66,38 +80,60 @@ def download_file_from_telegram(
 
     # Download the file
     url = f"{telegram_base_api_url}/file/{envars.telegram_full_token}/{file_path}"
-    r = requests.get(url)
+    with lifecycle.in_flight('telegram_download'):
+        try:
+            r = http_client.get(url, timeout=(3.05, 30))
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Error downloading file from Telegram: {e}")
+            return False
 
-    if r.status_code == 200:
-        file_save_path = f"{media_uploads_folder}/{save_name}"
-        with open(file_save_path, 'wb') as f:
-            f.write(r.content)
-        logging.info("File successfully downloaded from Telegram")
+        if r.status_code == 200:
+            file_save_path = f"{media_uploads_folder}/{save_name}"
+            with open(file_save_path, 'wb') as f:
+                f.write(r.content)
+            logging.info("File successfully downloaded from Telegram")
 
-        return save_name
-    else:
-        logging.error("Error downloading file from Telegram")
-        return False
+            return save_name
+        else:
+            logging.error("Error downloading file from Telegram")
+            return False
 
 
-def send_telegram_message(
+def compose_telegram_message_payload(
         telegram_chat_id,
         message_contents,
         disable_notification=False,
 ):
-    # This sends a message from the server to the Telegram user
-
-    message_contents = escape_markdown(message_contents)
+    # Builds the sendMessage payload, shared by the sync and async senders
 
-    payload = {
+    return {
         'chat_id': telegram_chat_id,
-        'text': message_contents,
+        'text': escape_markdown(message_contents),
         'parse_mode': 'MarkdownV2',
         'disable_notification': disable_notification
     }
+
+
+def send_telegram_message(
+        telegram_chat_id,
+        message_contents,
+        disable_notification=False,
+):
+    # This sends a message from the server to the Telegram user
+
+    payload = compose_telegram_message_payload(
+        telegram_chat_id,
+        message_contents,
+        disable_notification
+    )
     url = telegram_api_url + '/sendMessage'
 
-    response = requests.post(url, json=payload)
+    try:
+        with lifecycle.in_flight('telegram_send'):
+            response = http_client.post(url, json=payload)
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Error sending message to Telegram user: {e}")
+        return False
 
     if response.status_code == 200:
         logging.info("Message sent to Telegram webhook")
@@ -127,7 +163,13 @@ def send_telegram_picture_message(
         payload['photo'] = image_url
         url = telegram_api_url + '/sendPhoto'
 
-    response = requests.post(url, json=payload)
+    try:
+        with lifecycle.in_flight('telegram_send'):
+            response = http_client.post(url, json=payload)
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Error sending picture message to Telegram user: {e}")
+        return False
+
     logging.info("Message sent to Telegram webhook")
     if response.status_code == 200:
         return True
@@ -135,303 +177,348 @@ def send_telegram_picture_message(
         return False
 
 
-@app.post('/telegram/webhook/')
+@routes.post('/telegram/webhook/')
 def telegram_webhook():
+    return process_webhook(
+        request.headers.get(request_guard.webhook_secret_header),
+        request.get_json(silent=True)
+    )
+
+
+def process_webhook(auth_token_received_from_webhook, data):
+    # The Telegram webhook, shared by the route above and asgi.py
+    # Takes the secret token header and the posted JSON (None if it couldn't be parsed), and returns what a Flask view
+    # would
+
+    # Check the headers (request_guard has already done this, unless it has been turned off)
+    if not auth_token_received_from_webhook:
+        logging.error("No auth token received from Telegram webhook")
+        return {
+            'status': 'error',
+            'message': 'No webhook verification token received'
+        }, 401
+
+    if not request_guard.is_webhook_secret_valid(auth_token_received_from_webhook):
+        logging.error("Token received from Telegram webhook did not match expected")
+        return {
+            'status': 'error',
+            'message': 'Webhook verification token did not match expected'
+        }, 401
+
+    # Parse the update, turning away anything malformed before we go anywhere near the database
+    try:
+        update = telegram_updates.parse_update(data)
+    except telegram_updates.MalformedUpdateError as e:
+        logging.error(f"Error parsing JSON received from Telegram: {e}")
+        return malformed_update_response()
 
-    if request.method == 'POST':
-
-        # Check the headers
-        auth_token_received_from_webhook = request.headers.get(
-            'X-Telegram-Bot-Api-Secret-Token')
-
-        if not auth_token_received_from_webhook:
-            logging.error("No auth token received from Telegram webhook")
-            return {
-                'status': 'error',
-                'message': 'No webhook verification token received'
-            }, 401
-
-        if auth_token_received_from_webhook != envars.telegram_webhook_auth:
-            logging.error(
-                "Token " + auth_token_received_from_webhook + " did not match expected")
-            return {
-                'status': 'error',
-                'message': 'Webhook verification token did not match expected'
-            }, 401
+    # Drop updates from chats that are flooding us, telling them once
+    # Telegram gets a 200 regardless, as it redelivers an update that gets anything else, which would add to the flood
+    if update and not rate_limit.check('webhook', update.chat_id):
+        instrumentation.increment('telegram_updates_dropped_rate_limited')
+        if rate_limit.should_send_flood_notice(f"telegram:{update.chat_id}"):
+            send_message(provider, update.chat_id, message_string['sending_too_fast'])
+        return "ok", 200
 
-        # Get the message from the user
-        data = request.get_json()
+    return handle_update(update)
 
-        # Check if this update contains a message, and if not ignore it
-        if 'message' not in data:
-            logging.info("There is no message in the data received")
-            return "nothing to do"
 
-        # Start putting the mandatory fields into the message_received dictionary, return an error if there's a problem
-        try:
-            message_received = {
-                'telegram_message_id': data['message']['message_id'],
-                'telegram_chat_id': data['message']['chat']['id'],
-                'mobile': data['message']['from']['id'],
-            }
-        except:
-            logging.error("Error parsing JSON received from Telegram")
-            return {
-                'status': 'error',
-                'message': 'JSON received from Telegram webhook could not be parsed'
-            }, 401
-
-        # Check if this is a new user and if so run the onboarding workflow
-        user = User.query.filter_by(
-            provider_id=message_received['telegram_chat_id']).first()
-        if not user:
-            if 'text' in data['message']:
-                new_user_message_contents = data['message']['text']
-                if new_user_message_contents.startswith('/start'):
-                    beta_code_provided = new_user_message_contents[7:].strip()
-
-                    result = onboarding_result = onboarding_workflow(
-                        provider=provider,
-                        provider_id=message_received['telegram_chat_id'],
-                        beta_code=beta_code_provided,
-                    )
-                    if result:
-                        logging.info("New user successfully onboarded")
-                        return "ok", 200
-                    else:
-                        logging.error("Error onboarding user")
-                        return "error onboarding", 200
-                send_message(
-                    provider=provider,
-                    provider_id=message_received['telegram_chat_id'],
-                    contents=message_string['start_with_start_please']
+def malformed_update_response():
+    return {
+        'status': 'error',
+        'message': 'JSON received from Telegram webhook could not be parsed'
+    }, 401
+
+
+def handle_command(update, user):
+    # Returns True if the command was handled
+
+    result = False
+    command = update.command
+    argument = update.argument
+
+    if command == '/help':
+        result = send_message(
+            provider,
+            update.chat_id,
+            message_string['telegram_help_message']
+        )
+
+    if command == '/token_refresh':
+        result = send_message(
+            provider,
+            update.chat_id,
+            f"{message_string['danger_zone']}^^{message_string['confirm_refresh_token']}{message_string['confirm_refresh_token_telegram_suffix']}"
+        )
+
+    if command == '/token_refresh_confirm':
+        result = help_send_new_token(
+            user.id, provider, update.chat_id)
+
+    if command == "/more_help":
+        result = help_more_help(
+            user.id, provider, update.chat_id)
+
+    if command == "/delete_account":
+        result = send_message(
+            provider,
+            update.chat_id,
+            f"{message_string['danger_zone']}^^{message_string['confirm_delete_account']}{message_string['confirm_delete_account_telegram_suffix']}"
+        )
+
+    if command == "/imgbb":
+        if not argument:
+            result = send_message(
+                provider,
+                update.chat_id,
+                message_string['imgbb_no_argument']
+            )
+        if argument:
+            if imgbb.is_api_key_valid(argument):
+                user.imgbb_api_key = argument
+                db.session.commit()
+                result = send_message(
+                    provider,
+                    update.chat_id,
+                    message_string['imgbb_key_set']
                 )
-                return "done"
-
-        # If it's not a new user, process the message and add it to the database
-        if user:
-
-            # Work out the message type and get the relevant information
-            result = False
-
-            if 'text' in data['message']:
-                message_received['message_type'] = 'text'
-                message_received['message_contents'] = data['message']['text']
-
-                # Check if this is a command (other than /start, which is handled above)
-                if message_received['message_contents'].startswith('/'):
-
-                    # Split the command into the base command (eg /help) and any argument (eg /help more)
-                    command_contents = message_received['message_contents'].split(
-                        " ")
-                    command = str(command_contents[0]).lower()
-                    argument = str(command_contents[1]).lower() if len(
-                        command_contents) > 1 else None
-
-                    if command == '/help':
-                        result = send_message(
-                            provider,
-                            message_received['telegram_chat_id'],
-                            message_string['telegram_help_message']
-                        )
-
-                    if command == '/token_refresh':
-                        result = send_message(
-                            provider,
-                            message_received['telegram_chat_id'],
-                            f"{message_string['danger_zone']}^^{message_string['confirm_refresh_token']}{message_string['confirm_refresh_token_telegram_suffix']}"
-                        )
-
-                    if command == '/token_refresh_confirm':
-                        result = help_send_new_token(
-                            user.id, provider, message_received['telegram_chat_id'])
-
-                    if command == "/more_help":
-                        result = help_more_help(
-                            user.id, provider, message_received['telegram_chat_id'])
-
-                    if command == "/delete_account":
-                        result = send_message(
-                            provider,
-                            message_received['telegram_chat_id'],
-                            f"{message_string['danger_zone']}^^{message_string['confirm_delete_account']}{message_string['confirm_delete_account_telegram_suffix']}"
-                        )
-
-                    if command == "/imgbb":
-                        if not argument:
-                            result = send_message(
-                                provider,
-                                message_received['telegram_chat_id'],
-                                message_string['imgbb_no_argument']
-                            )
-                        if argument:
-                            if imgbb.is_api_key_valid(argument):
-                                user.imgbb_api_key = argument
-                                db.session.commit()
-                                result = send_message(
-                                    provider,
-                                    message_received['telegram_chat_id'],
-                                    message_string['imgbb_key_set']
-                                )
-                                send_picture_message(
-                                    provider,
-                                    message_received['telegram_chat_id'],
-                                    media_urls['toast'],
-                                    animation=True
-                                )
-                            else:
-                                result = send_message(
-                                    provider,
-                                    message_received['telegram_chat_id'],
-                                    message_string['imgbb_invalid_key']
-                                )
-                                send_picture_message(
-                                    provider,
-                                    message_received['telegram_chat_id'],
-                                    media_urls['sad_pam'],
-                                    animation=True
-                                )
-
-                    if message_received['message_contents'] == "/delete_account_confirm":
-                        result = offboarding_workflow(
-                            provider, message_received['telegram_chat_id'])
-
-                    if not result:
-                        result = send_message(
-                            provider,
-                            message_received['telegram_chat_id'],
-                            message_string["sorry_didnt_understand_command"]
-                        )
-                        send_message(
-                            provider,
-                            message_received['telegram_chat_id'],
-                            message_string['telegram_help_message']
-                        )
-
-                else:
-                    # Add the message to the database
-                    result = add_new_message(
-                        user_id=user.id,
-                        provider=provider,
-                        message_contents=message_received['message_contents'],
-                        provider_message_id=message_received['telegram_message_id'],
-                    )
-
-            if 'photo' in data['message']:
-
-                if 'photo' in data['message']:
-                    message_received['message_type'] = 'photo'
-                    message_received['file_id'] = data['message']['photo'][-1]['file_id']
-
-                # if 'video' in data['message']:
-                # message_received['message_type'] = 'video'
-                # message_received['file_id'] = data['message']['video']['file_id']
-                # message_received['file_name'] = f"{secrets.token_hex(6)}{['message']['video']['file_name']}"
-
-                # Get the caption if there is one
-                if 'caption' in data['message']:
-                    message_received['caption'] = data['message']['caption']
-                else:
-                    message_received['caption'] = None
-
-                # Download the file from telegram
-
-                # Get the file path from the Telegram API
-                r = requests.get(
-                    telegram_api_url + '/getFile?file_id=' + message_received['file_id'])
-                message_received['file_path'] = r.json()['result']['file_path']
-
-                # Download the file from Telegram
-                download_result = False
-                if message_received['message_type'] == 'photo':
-                    download_result = download_file_from_telegram(
-                        file_path=message_received['file_path'],
-                        extension="jpg",
-                    )
-                # if message_received['message_type'] == 'video':
-                # download_result = download_file_from_telegram(
-                # file_path=message_received['file_path'],
-                # save_name=message_received['file_name'],
-                # )
-
-                if download_result:
-                    message_received['local_file_name'] = download_result
-                    message_received['local_file_path'] = f"{media_uploads_folder}/{download_result}"
-
-                    # Check the user can upload this type of file
-                    if is_user_able_to_upload_to_cloud(user.id):
-                        # Add the message to the database
-                        message_received['message_contents'] = compose_image_message_contents(
-                            image_file_path=message_received['local_file_path'],
-                            imgbb_api_key=user.imgbb_api_key,
-                            caption=message_received['caption']
-                        )
-                        if message_received['message_contents']:
-                            result = add_new_message(
-                                user_id=user.id,
-                                provider=provider,
-                                message_contents=message_received['message_contents'],
-                                provider_message_id=message_received['telegram_message_id']
-                            )
-                        else:
-                            logging.error("Failed to upload image to cloud")
-                    else:
-                        logging.error("User cannot upload to cloud")
-                        result = send_message(
-                            provider,
-                            message_received['telegram_chat_id'],
-                            message_string['cannot_upload_to_cloud']
-                        )
-                else:
-                    logging.error("Error downloading file from Telegram")
-
-            if 'location' in data['message']:
-                message_received['message_type'] = 'location'
-                message_received['location_latitude'] = data['message']['location']['latitude']
-                message_received['location_longitude'] = data['message']['location']['longitude']
-
-                if "venue" in data['message']:
-                    message_received['location_title'] = data['message']['venue'].get(
-                        'title')
-                    message_received['location_address'] = data['message']['venue'].get(
-                        'address')
-                else:
-                    message_received['location_title'] = None
-                    message_received['location_address'] = None
-
-                # Add the message to the database
-                message_received['message_contents'] = compose_location_message_contents(
-                    location_latitude=message_received['location_latitude'],
-                    location_longitude=message_received['location_longitude'],
-                    location_name=message_received['location_title'],
-                    location_address=message_received['location_address']
+                send_picture_message(
+                    provider,
+                    update.chat_id,
+                    media_urls['toast'],
+                    animation=True
                 )
-
-                result = add_new_message(
-                    user_id=user.id,
-                    provider=provider,
-                    message_contents=message_received['message_contents'],
-                    provider_message_id=message_received['telegram_message_id'],
+            else:
+                result = send_message(
+                    provider,
+                    update.chat_id,
+                    message_string['imgbb_invalid_key']
                 )
-
-            if 'document' in data['message']:
-                send_message(
+                send_picture_message(
                     provider,
-                    message_received['telegram_chat_id'],
-                    message_string['message_type_not_supported']
+                    update.chat_id,
+                    media_urls['sad_pam'],
+                    animation=True
                 )
-                result = True
 
-            # If message type has not been set then return an error
+    if command == "/storage":
+        if argument not in image_storage.user_selectable_backends:
+            result = send_message(
+                provider,
+                update.chat_id,
+                message_string['storage_options'] + ", ".join(image_storage.user_selectable_backends)
+            )
+        elif not image_storage.backends[argument].is_available_for_user(user):
+            result = send_message(
+                provider,
+                update.chat_id,
+                message_string['storage_not_available']
+            )
+        else:
+            user.image_storage_backend = argument
+            db.session.commit()
+            result = send_message(
+                provider,
+                update.chat_id,
+                message_string['storage_set'] + argument
+            )
+
+    if command == "/digest":
+        if argument not in ("on", "off"):
+            result = send_message(
+                provider,
+                update.chat_id,
+                message_string['digest_options']
+            )
+        else:
+            user.digest_mode = argument == "on"
+            db.session.commit()
+            result = send_message(
+                provider,
+                update.chat_id,
+                message_string['digest_on'] if user.digest_mode else message_string['digest_off']
+            )
+
+    if update.text == "/delete_account_confirm":
+        result = offboarding_workflow(
+            provider, update.chat_id)
+
+    if not result:
+        result = send_message(
+            provider,
+            update.chat_id,
+            message_string["sorry_didnt_understand_command"]
+        )
+        send_message(
+            provider,
+            update.chat_id,
+            message_string['telegram_help_message']
+        )
+
+    return result
+
+
+def handle_photo(update, user, commit=True):
+    # Downloads the photo from Telegram, uploads it to the user's image storage and adds a message linking to it
+
+    # Telegram offers several sizes of each photo, the image policy decides which one we download
+    photo_size = image_policy.choose_photo_size(update.photo_sizes)
+
+    # Get the file path from the Telegram API
+    try:
+        r = http_client.get(
+            telegram_api_url + '/getFile?file_id=' + photo_size.file_id)
+        file_path = r.json()['result']['file_path']
+    except Exception as e:
+        logging.error(f"Error getting file path from Telegram: {e}")
+        file_path = None
+
+    # Download the file from Telegram
+    download_result = False
+    if file_path:
+        download_result = download_file_from_telegram(
+            file_path=file_path,
+            extension="jpg",
+        )
+
+    if not download_result:
+        logging.error("Error downloading file from Telegram")
+        return False
+
+    local_file_path = f"{media_uploads_folder}/{download_result}"
+
+    # Shrink the image before upload if the policy allows it (off the event loop under asgi.py, as it is CPU bound)
+    async_bridge.blocking(image_policy.reencode_image, local_file_path)
+
+    # Check the user can upload this type of file
+    if not is_user_able_to_upload_to_cloud(user.id):
+        logging.error("User cannot upload to cloud")
+        return send_message(
+            provider,
+            update.chat_id,
+            message_string['cannot_upload_to_cloud']
+        )
+
+    # Add the message to the database
+    message_contents = compose_image_message_contents(
+        image_file_path=local_file_path,
+        caption=update.caption,
+        user=user
+    )
+    if not message_contents:
+        logging.error("Failed to upload image to cloud")
+        return False
+
+    return add_new_message(
+        user_id=user.id,
+        provider=provider,
+        message_contents=message_contents,
+        provider_message_id=update.message_id,
+        commit=commit,
+    )
+
+
+def handle_update(update, commit=True):
+    # Process a single parsed update from Telegram (see telegram_updates.py), whether it arrived by webhook or some
+    # other route
+    # With commit=False new messages are only flushed, so the caller can commit them along with its own changes, and
+    # a failure to store them is raised for the caller to roll back (commands and onboarding still commit as they go)
+
+    # Check if this update contains a message, and if not ignore it
+    if not update:
+        logging.info("There is no message in the data received")
+        return "nothing to do"
+
+    # Check if this is a new user and if so run the onboarding workflow
+    user = queries.get_user_by_provider_id(update.chat_id)
+    if not user:
+        if update.text is not None and update.text.startswith('/start'):
+            beta_code_provided = update.text[7:].strip()
+
+            result = onboarding_workflow(
+                provider=provider,
+                provider_id=update.chat_id,
+                beta_code=beta_code_provided,
+            )
             if result:
-                logging.info("Message successfully handled")
+                logging.info("New user successfully onboarded")
                 return "ok", 200
             else:
-                logging.error(
-                    "Failed to add message to database in a way that was unhandled")
-                send_message(
-                    provider, message_received['telegram_chat_id'], message_string["error_with_message"])
-                return "Failed to add message to database", 400
+                logging.error("Error onboarding user")
+                return "error onboarding", 200
+        send_message(
+            provider=provider,
+            provider_id=update.chat_id,
+            contents=message_string['start_with_start_please']
+        )
+        return "done"
+
+    # If it's not a new user, process the message and add it to the database
+
+    # Check the user has room in their queue before we download or store anything
+    if not update.command and rate_limit.is_user_over_quota(user.id):
+        send_message(
+            provider,
+            update.chat_id,
+            message_string['message_queue_full']
+        )
+        return "ok", 200
+
+    # Work out the message type and handle it
+    result = False
+
+    if update.command:
+        # Commands other than /start, which is handled above
+        result = handle_command(update, user)
+
+    elif update.text is not None:
+        # Add the message to the database
+        result = add_new_message(
+            user_id=user.id,
+            provider=provider,
+            message_contents=update.text,
+            provider_message_id=update.message_id,
+            commit=commit,
+        )
+
+    if update.photo_sizes:
+        result = handle_photo(update, user, commit)
+
+    if update.location:
+        # Add the message to the database
+        message_contents = compose_location_message_contents(
+            location_latitude=update.location.latitude,
+            location_longitude=update.location.longitude,
+            location_name=update.location.title,
+            location_address=update.location.address
+        )
+
+        result = add_new_message(
+            user_id=user.id,
+            provider=provider,
+            message_contents=message_contents,
+            provider_message_id=update.message_id,
+            commit=commit,
+        )
+
+    if update.has_document:
+        send_message(
+            provider,
+            update.chat_id,
+            message_string['message_type_not_supported']
+        )
+        result = True
+
+    # If message type has not been set then return an error
+    if result:
+        logging.info("Message successfully handled")
+        return "ok", 200
+    else:
+        logging.error(
+            "Failed to add message to database in a way that was unhandled")
+        send_message(
+            provider, update.chat_id, message_string["error_with_message"])
+        return "Failed to add message to database", 400
 
 
 def check_webhook_health():
@@ -439,7 +526,7 @@ def check_webhook_health():
     url = f"{telegram_api_url}/getWebhookInfo"
 
     try:
-        r = requests.get(url)
+        r = http_client.get(url)
         response_json = r.json()
     except:
         return False
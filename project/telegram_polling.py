@@ -0,0 +1,205 @@
+# This library fetches updates from Telegram with getUpdates instead of waiting for the webhook, which is handy for
+# local and staging servers (no public URL needed) and for catching up on whatever piled up while the server was down
+# - updates are fetched up to 100 at a time and go through the same parser and handle_update as the webhook
+# - each update is ingested in its own short database transaction, which is only started once any network work for
+#   the update (eg downloading a photo) is done, so the SQLite write lock is never held while we wait on the network
+# - the next update id is stored in the database in the same transaction as the update's messages, so after a crash we
+#   carry on from the last update that was saved rather than ingesting anything twice (commands, which commit as they
+#   go, may be repeated)
+# - an update that fails is rolled back on its own, and the rest of the batch carries on
+# Telegram won't hand out updates while a webhook is set, so pass --delete-webhook (and set it again afterwards)
+# Run with: flask --app project poll-telegram
+#      or: flask --app project poll-telegram --once (to catch up and then stop)
+# Saved updates (eg a getUpdates response) can also be replayed by posting them to /admin/telegram/replay
+
+import time
+import logging
+from timeit import default_timer as timer
+
+import click
+import requests
+from flask import request
+
+from . import routes
+from . import db
+from . import UpdateOffset
+from . import telegram
+from . import telegram_updates
+from . import http_client
+from . import instrumentation
+from . import admin_auth
+
+# Polling settings
+update_offset_name = "telegram"
+updates_per_batch = 100  # the most Telegram will return at once
+long_poll_seconds = 50
+poll_error_backoff_seconds = 5
+allowed_updates = ["message"]
+
+
+def get_next_update_id():
+    offset = UpdateOffset.query.filter_by(name=update_offset_name).first()
+    return offset.next_update_id if offset else 0
+
+
+def fetch_updates(next_update_id, timeout_seconds=None):
+    # Returns a list of updates (waiting up to timeout_seconds for one to arrive), or False if Telegram refused
+
+    timeout_seconds = long_poll_seconds if timeout_seconds is None else timeout_seconds
+    try:
+        r = http_client.get(
+            f"{telegram.telegram_api_url}/getUpdates",
+            params={
+                'offset': next_update_id,
+                'limit': updates_per_batch,
+                'timeout': timeout_seconds,
+                'allowed_updates': ",".join(allowed_updates),
+            },
+            timeout=(3.05, timeout_seconds + 10)
+        )
+        response_json = r.json()
+    except (requests.exceptions.RequestException, ValueError) as e:
+        logging.error(f"Error getting updates from Telegram: {e}")
+        return False
+
+    if r.status_code == 409:
+        logging.error("Telegram won't return updates while a webhook is set - run with --delete-webhook")
+        return False
+    if not response_json.get('ok'):
+        logging.error(f"Telegram returned an error getting updates: {response_json.get('description')}")
+        return False
+
+    return response_json['result']
+
+
+def delete_webhook():
+    # Pending updates are kept, so they can be collected with getUpdates
+    try:
+        r = http_client.post(f"{telegram.telegram_api_url}/deleteWebhook", json={'drop_pending_updates': False})
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Error deleting Telegram webhook: {e}")
+        return False
+    return r.status_code == 200
+
+
+def store_next_update_id(next_update_id):
+    # Only adds to the session, so it is committed along with the update it follows
+
+    offset = UpdateOffset.query.filter_by(name=update_offset_name).first()
+    if not offset:
+        offset = UpdateOffset(name=update_offset_name)
+        db.session.add(offset)
+    offset.next_update_id = next_update_id
+
+
+def ingest_updates(updates):
+    # Hands each update to the webhook's handler and commits it, along with the new offset, before moving on to the next
+    # Updates below the stored offset have already been ingested, so are skipped
+
+    started = timer()
+    result = {'ingested': 0, 'skipped': 0, 'failed': 0}
+    next_update_id = get_next_update_id()
+
+    for update in sorted(updates, key=lambda update: update.get('update_id') if isinstance(update.get('update_id'), int) else -1):
+        update_id = update.get('update_id')
+        if not isinstance(update_id, int) or update_id < next_update_id:
+            result['skipped'] += 1
+            continue
+
+        try:
+            parsed_update = telegram_updates.parse_update(update)
+            # New messages are only flushed, so they are committed together with the offset below
+            telegram.handle_update(parsed_update, commit=False)
+            result['ingested'] += 1
+        except telegram_updates.MalformedUpdateError as e:
+            logging.error(f"Telegram update {update_id} is malformed, skipping it: {e}")
+            result['failed'] += 1
+        except Exception as e:
+            logging.error(f"Error ingesting Telegram update {update_id}, skipping it: {e}")
+            db.session.rollback()
+            result['failed'] += 1
+
+        next_update_id = update_id + 1
+        store_next_update_id(next_update_id)
+        db.session.commit()
+
+    result['next_update_id'] = next_update_id
+    instrumentation.increment('telegram_updates_ingested', result['ingested'])
+    instrumentation.increment('telegram_updates_failed', result['failed'])
+    instrumentation.record_timing('telegram_update_batch', timer() - started)
+    return result
+
+
+def poll_once(timeout_seconds=None):
+    # Fetches and ingests one batch, returns the ingest result or False if nothing could be fetched
+
+    updates = fetch_updates(get_next_update_id(), timeout_seconds)
+    if updates is False:
+        return False
+    return ingest_updates(updates)
+
+
+def poll(once=False):
+    # Ingests updates until stopped, or with once=True until we have caught up
+
+    while True:
+        # When catching up there is no point waiting for new updates to arrive
+        result = poll_once(timeout_seconds=0 if once else None)
+
+        if result is False:
+            if once:
+                return False
+            time.sleep(poll_error_backoff_seconds)
+            continue
+
+        if result['ingested'] or result['failed']:
+            logging.info(f"Ingested Telegram updates: {result}")
+
+        if once and result['ingested'] + result['failed'] + result['skipped'] < updates_per_batch:
+            return True
+
+
+@routes.cli.command('poll-telegram')
+@click.option('--once', is_flag=True, help="Catch up on pending updates and then stop")
+@click.option('--delete-webhook', 'should_delete_webhook', is_flag=True, help="Remove the webhook first, as Telegram requires")
+def poll_telegram_command(once, should_delete_webhook):
+    if should_delete_webhook and not delete_webhook():
+        print("Could not delete the Telegram webhook")
+        return
+
+    print(f"Polling Telegram for updates from update {get_next_update_id()}")
+    try:
+        caught_up = poll(once=once)
+    except KeyboardInterrupt:
+        caught_up = True
+
+    if caught_up:
+        print(f"Stopped, next update is {get_next_update_id()}")
+    else:
+        print("Could not get updates from Telegram")
+
+
+@routes.post('/admin/telegram/replay')
+@admin_auth.admin_required
+def replay_updates_route():
+    # Accepts a list of updates, or a saved getUpdates response, and ingests them as if they had been polled
+
+    data = request.get_json(silent=True)
+    updates = data.get('result') if isinstance(data, dict) else data
+
+    if not isinstance(updates, list) or not all(isinstance(update, dict) for update in updates):
+        return {
+            'status': 'error',
+            'message': 'Expected a list of Telegram updates'
+        }, 400
+
+    if len(updates) > updates_per_batch:
+        return {
+            'status': 'error',
+            'message': f"At most {updates_per_batch} updates can be replayed at once"
+        }, 400
+
+    return {
+        'status': 'success',
+        **ingest_updates(updates)
+    }
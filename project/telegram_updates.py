@@ -0,0 +1,130 @@
+# This library turns the JSON Telegram sends us into small typed objects, once, before anything else happens
+# The handlers then work with these objects instead of digging through nested dicts, and an update that is missing
+# something we need is rejected here, before we go anywhere near the database or the network
+# Parsing has no side effects, so it can be tested on its own
+
+from dataclasses import dataclass
+
+
+class MalformedUpdateError(ValueError):
+    # Raised when an update has a message but it is missing something we need, or has it in the wrong shape
+    pass
+
+
+@dataclass(slots=True)
+class PhotoSize:
+    file_id: str
+    width: int
+    height: int
+    file_size: int  # None if Telegram didn't tell us
+
+
+@dataclass(slots=True)
+class Location:
+    latitude: float
+    longitude: float
+
+    # Only set when the user shared a venue rather than a bare location
+    title: str
+    address: str
+
+
+@dataclass(slots=True)
+class TelegramMessage:
+    update_id: int
+    message_id: int
+    chat_id: int
+    sender_id: int
+
+    text: str
+    command: str  # eg /help, lower case, if the text is a command
+    argument: str  # the second word of a command, lower case, if there is one
+
+    photo_sizes: tuple  # of PhotoSize, smallest first
+    caption: str
+    location: Location
+    has_document: bool
+
+
+def require(container, key, expected_type):
+    try:
+        value = container[key]
+    except (KeyError, TypeError):
+        raise MalformedUpdateError(f"Update is missing {key}")
+    if not isinstance(value, expected_type) or isinstance(value, bool):
+        raise MalformedUpdateError(f"Update has a {type(value).__name__} for {key}")
+    return value
+
+
+def optional(container, key, expected_type):
+    value = container.get(key)
+    if value is not None and not isinstance(value, expected_type):
+        raise MalformedUpdateError(f"Update has a {type(value).__name__} for {key}")
+    return value
+
+
+def parse_photo_sizes(photo):
+    if not isinstance(photo, list):
+        raise MalformedUpdateError("Update has a photo that isn't a list of sizes")
+
+    return tuple(
+        PhotoSize(
+            file_id=require(size, 'file_id', str),
+            width=optional(size, 'width', int) or 0,
+            height=optional(size, 'height', int) or 0,
+            file_size=optional(size, 'file_size', int),
+        )
+        for size in photo
+    )
+
+
+def parse_location(message):
+    location = require(message, 'location', dict)
+    venue = optional(message, 'venue', dict) or {}
+
+    return Location(
+        latitude=require(location, 'latitude', (int, float)),
+        longitude=require(location, 'longitude', (int, float)),
+        title=optional(venue, 'title', str),
+        address=optional(venue, 'address', str),
+    )
+
+
+def parse_command(text):
+    # Splits a command into the base command (eg /help) and any argument (eg /help more)
+    if text is None or not text.startswith('/'):
+        return None, None
+
+    words = text.split(" ")
+    argument = words[1].lower() if len(words) > 1 else None
+    return words[0].lower(), argument
+
+
+def parse_update(data):
+    # Returns a TelegramMessage, or None if the update doesn't contain a message (eg an edited message)
+
+    if not isinstance(data, dict):
+        raise MalformedUpdateError("Update is not a JSON object")
+
+    message = data.get('message')
+    if message is None:
+        return None
+    if not isinstance(message, dict):
+        raise MalformedUpdateError("Update has a message that isn't a JSON object")
+
+    text = optional(message, 'text', str)
+    command, argument = parse_command(text)
+
+    return TelegramMessage(
+        update_id=optional(data, 'update_id', int),
+        message_id=require(message, 'message_id', int),
+        chat_id=require(require(message, 'chat', dict), 'id', int),
+        sender_id=require(require(message, 'from', dict), 'id', int),
+        text=text,
+        command=command,
+        argument=argument,
+        photo_sizes=parse_photo_sizes(message['photo']) if 'photo' in message else (),
+        caption=optional(message, 'caption', str),
+        location=parse_location(message) if 'location' in message else None,
+        has_document='document' in message,
+    )
@@ -1,4 +1,7 @@
 from project import app
+from project import lifecycle
 
 if __name__ == "__main__":
+    # Under gunicorn the worker is started by gunicorn.conf.py
+    lifecycle.start_worker(app)
     app.run()